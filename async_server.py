@@ -0,0 +1,550 @@
+"""
+基于 asyncio 的套接字聊天服务器
+单线程事件循环处理所有连接，协议、管理命令和文件存储与 ChatServer 一致；
+磁盘读写（接收文件的写入、完成时的摘要计算、并行上传的区间写入）在后台线程中进行，不阻塞事件循环
+"""
+
+import asyncio
+import struct
+import sys
+import threading
+from collections import deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import os
+import zlib
+from utils import SocketUtils, MessageType, FileRegion, OutboundQueue, SlowConsumerPolicy, RelayMode
+from blob_store import ChunkSpool
+from server import ChatServer
+
+
+class StreamSocket:
+    """
+    代表一个 asyncio 连接的类似套接字的对象
+    
+    ChatServer 以它作为客户端字典的键，并在断开连接时调用 close()；
+    数据统一经由 AsyncOutbox 写出。
+    """
+    
+    def __init__(self, writer, loop):
+        """
+        初始化连接包装
+        
+        Args:
+            writer: asyncio.StreamWriter
+            loop: 连接所属的事件循环
+        """
+        self.writer = writer
+        self.loop = loop
+        self.closed = False
+    
+    def in_loop(self):
+        """当前是否运行在连接所属的事件循环线程中"""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+    
+    def close(self):
+        """关闭连接（可在任意线程调用）"""
+        if self.closed:
+            return
+        self.closed = True
+        
+        if self.in_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncOutbox:
+    """
+    asyncio 连接的有界出站队列
+    
+    传输层缓冲区本身就是该连接的队列，由事件循环在套接字可写时发送。
+    在事件循环内放入不会阻塞：超过上限时按慢客户端策略丢弃、断开，
+    或登记为拥塞连接，由发送方协程在处理下一条消息前等待其缓冲区回落（背压）。
+    在其他线程（磁盘线程池中的消息处理、管理员线程）中放入则转交给事件循环，同样执行慢客户端策略，
+    不等待；只有要求等待的放入（服务器发送文件）才阻塞调用线程直到缓冲区回落。
+    文件区间用 loop.sendfile 发送，期间写入的帧暂存在 backlog 中，发送完成后再写出。
+    """
+    
+    SEND_TIMEOUT = 30  # 等待缓冲区回落的超时时间（秒）
+    
+    def __init__(self, stream_socket, max_buffer, policy, congested):
+        """
+        初始化出站队列
+        
+        Args:
+            stream_socket: StreamSocket
+            max_buffer: 发送缓冲区上限（字节）
+            policy: 缓冲区已满时的处理策略（SlowConsumerPolicy）
+            congested: 服务器登记拥塞连接的集合
+        """
+        self.stream_socket = stream_socket
+        self.writer = stream_socket.writer
+        self.max_buffer = max_buffer
+        self.policy = policy
+        self.congested = congested
+        self.dropped = 0
+        
+        self.backlog = None      # 发送文件区间期间暂存的帧
+        self.backlog_bytes = 0
+        self.sequence_lock = asyncio.Lock()
+    
+    @property
+    def closed(self):
+        """连接是否已关闭"""
+        return self.stream_socket.closed or self.writer.is_closing()
+    
+    def _full(self):
+        """发送缓冲区是否超过上限"""
+        buffered = self.writer.transport.get_write_buffer_size() + self.backlog_bytes
+        return buffered >= self.max_buffer
+    
+    def _write(self, frame):
+        """写入传输层，发送文件区间期间暂存到 backlog"""
+        if self.backlog is None:
+            self.writer.writelines(frame)
+        else:
+            self.backlog.append(frame)
+            self.backlog_bytes += sum(len(buffer) for buffer in frame)
+    
+    def offer(self, frame):
+        """
+        尝试写入一帧，不等待也不执行慢客户端策略
+        
+        Args:
+            frame: 帧的缓冲区元组
+            
+        Returns:
+            是否已写入
+        """
+        if self.closed or not self.stream_socket.in_loop() or self._full():
+            return False
+        self._write(frame)
+        return True
+    
+    def put(self, frame, wait=False):
+        """
+        写入一帧，缓冲区已满时执行慢客户端策略
+        
+        Args:
+            frame: 帧的缓冲区元组
+            wait: 是否无视策略等待缓冲区回落
+            
+        Returns:
+            是否已写入（DROP 策略下丢弃返回False）
+            
+        Raises:
+            ConnectionError: 连接已关闭或因策略被断开
+        """
+        if self.closed:
+            raise ConnectionError("客户端接收过慢或连接已关闭")
+        
+        if not self.stream_socket.in_loop():
+            try:
+                if not wait:
+                    # 交给事件循环按慢客户端策略写入，调用线程不等待任何一个接收方
+                    self.stream_socket.loop.call_soon_threadsafe(self._put_from_thread, frame)
+                    return True
+                
+                # 服务器发送文件的线程可以阻塞：写入后等待缓冲区回落
+                future = asyncio.run_coroutine_threadsafe(self._write_and_drain(frame),
+                                                          self.stream_socket.loop)
+                future.result(timeout=self.SEND_TIMEOUT)
+                return True
+            except (concurrent.futures.TimeoutError, RuntimeError):
+                # 等待超时或事件循环已关闭
+                self.close()
+                raise ConnectionError("客户端接收过慢或连接已关闭")
+        
+        if self._full():
+            if self.policy == SlowConsumerPolicy.DROP:
+                self.dropped += 1
+                return False
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                self.close()
+                raise ConnectionError("客户端接收过慢或连接已关闭")
+            # 背压：先写入，由发送方协程等待缓冲区回落
+            self.congested.add(self)
+        
+        self._write(frame)
+        return True
+    
+    def _put_from_thread(self, frame):
+        """在事件循环中写入其他线程转交的帧（按慢客户端策略被断开时由连接协程执行断开流程）"""
+        try:
+            self.put(frame)
+        except ConnectionError:
+            pass
+    
+    async def _write_and_drain(self, frame):
+        """在事件循环中写入并等待缓冲区回落"""
+        self._write(frame)
+        await self.writer.drain()
+    
+    def put_sequence(self, items):
+        """
+        连续写入多个帧或文件区间，中间不会插入其他帧
+        
+        发送在事件循环中进行，调用方（管理员线程）不等待文件发送完成。
+        
+        Args:
+            items: 帧的缓冲区元组或 FileRegion 的列表
+            
+        Returns:
+            是否已提交
+            
+        Raises:
+            ConnectionError: 连接已关闭
+        """
+        if self.closed:
+            raise ConnectionError("客户端接收过慢或连接已关闭")
+        asyncio.run_coroutine_threadsafe(self._send_sequence(items), self.stream_socket.loop)
+        return True
+    
+    async def _send_sequence(self, items):
+        """在事件循环中依次发送帧和文件区间"""
+        try:
+            async with self.sequence_lock:
+                for item in items:
+                    if self.closed:
+                        return
+                    if isinstance(item, FileRegion):
+                        await self._send_region(item)
+                    else:
+                        self._write(item)
+        except Exception as e:
+            print(f"发送文件给客户端失败: {e}")
+            self.close()
+    
+    async def _send_region(self, region):
+        """用 loop.sendfile 发送文件区间（传输层在此期间不接受写入）"""
+        self.backlog = deque()
+        try:
+            with open(region.path, 'rb') as f:
+                sent = await self.stream_socket.loop.sendfile(self.writer.transport, f,
+                                                              region.offset, region.count)
+            if sent != region.count:
+                raise OSError(f"文件在发送过程中被截断: {region.path}")
+        finally:
+            backlog, self.backlog = self.backlog, None
+            self.backlog_bytes = 0
+            if not self.closed:
+                for frame in backlog:
+                    self.writer.writelines(frame)
+    
+    async def drain(self):
+        """等待缓冲区回落到上限以下，超时则断开"""
+        try:
+            await asyncio.wait_for(self.writer.drain(), timeout=OutboundQueue.BACKPRESSURE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.close()
+    
+    def close(self):
+        """关闭连接"""
+        self.stream_socket.close()
+
+
+class AsyncChatServer(ChatServer):
+    """
+    asyncio 聊天服务器
+    
+    FILE_DATA 数据块经 ChunkSpool 的写入线程写入磁盘（store 模式也是如此，数据块在转发前放入写入队列），
+    写入队列积压时发送方协程等待写入线程追上；打开文件、完成接收（摘要计算、存入 BlobStore）
+    和连接断开时的收尾在线程池中进行，发送方协程等待其完成后再读取下一条消息。
+    线程池中产生的转发由 AsyncOutbox 交回事件循环，按慢客户端策略写入，不等待接收方；
+    背压策略下拥塞的接收方同样登记到 congested，由发送方协程在处理下一条消息前等待。
+    """
+    
+    DISK_WORKERS = 8                 # 磁盘线程池的线程数
+    SPOOL_HIGH_WATER = 64            # 写入队列中的数据块超过该数量时发送方等待
+    DISK_MESSAGE_TYPES = frozenset({MessageType.FILE, MessageType.FILE_COMPLETE})
+    
+    def __init__(self, host='localhost', port=8888, backlog=1024, max_write_buffer=4 * 1024 * 1024,
+                 slow_consumer_policy=SlowConsumerPolicy.BACKPRESSURE, relay_mode=RelayMode.STORE,
+                 history_size=50, history_path=None, chat_log_dir=None):
+        """
+        初始化 asyncio 聊天服务器
+        
+        Args:
+            host: 服务器主机地址
+            port: 服务器端口
+            backlog: 监听队列长度
+            max_write_buffer: 每个连接的发送缓冲区上限（字节）
+            slow_consumer_policy: 发送缓冲区已满时的处理策略（drop/disconnect/backpressure）
+            relay_mode: 转发客户端上传文件时的存储方式（store/relay/spool）
+            history_size: 新用户加入时回放的最近消息条数（0 表示不保存历史）
+            history_path: 历史消息追加日志的路径，None 表示只保存在内存中
+            chat_log_dir: 聊天记录日志目录，默认 files/chat_log
+        """
+        super().__init__(host, port, slow_consumer_policy=slow_consumer_policy, relay_mode=relay_mode,
+                         backlog=backlog, history_size=history_size, history_path=history_path,
+                         chat_log_dir=chat_log_dir)
+        self.max_write_buffer = max_write_buffer
+        
+        # 接收文件的数据块一律由写入线程写入
+        if self.spool is None and relay_mode != RelayMode.RELAY:
+            self.spool = ChunkSpool()
+        self.disk_executor = ThreadPoolExecutor(max_workers=self.DISK_WORKERS)
+        
+        self.loop = None
+        self.stopped = None
+        self.connection_tasks = set()
+        self.congested = set()  # 需要发送方等待缓冲区回落的连接
+    
+    def start(self):
+        """启动服务器"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(f"启动服务器失败: {e}")
+        finally:
+            self.running = False
+            super().stop()
+            self.disk_executor.shutdown(wait=False)
+    
+    def stop(self):
+        """停止服务器（可在任意线程调用）"""
+        self.running = False
+        
+        if self.loop is None or self.loop.is_closed():
+            return
+        
+        try:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        except RuntimeError:
+            pass
+    
+    async def serve(self):
+        """运行事件循环直到服务器停止"""
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        
+        self.raise_open_file_limit()
+        
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        self.running = True
+        
+        print(f"聊天服务器(asyncio)已启动，监听 {self.host}:{self.port}")
+        print("等待客户端连接...")
+        self.print_commands()
+        print("按 Ctrl+C 停止服务器\n")
+        
+        # 管理员命令仍在独立线程中读取，发送时由 StreamSocket 转交给事件循环
+        input_thread = threading.Thread(target=self.handle_server_input)
+        input_thread.daemon = True
+        input_thread.start()
+        
+        async with server:
+            await self.stopped.wait()
+            
+            # 关闭所有连接并等待连接协程正常结束
+            for client_socket, _ in self.registry.clear():
+                client_socket.close()
+            self.congested.clear()
+            if self.connection_tasks:
+                await asyncio.wait(list(self.connection_tasks), timeout=5)
+    
+    async def handle_connection(self, reader, writer):
+        """
+        处理客户端连接（每个连接一个协程）
+        
+        Args:
+            reader: asyncio.StreamReader
+            writer: asyncio.StreamWriter
+        """
+        address = writer.get_extra_info('peername')
+        client_socket = StreamSocket(writer, self.loop)
+        username = None
+        
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        
+        print(f"新客户端连接: {address}")
+        
+        try:
+            # 等待客户端发送用户名
+            message = await self.receive_message(reader)
+            
+            # 并行上传的数据连接不加入聊天室
+            if message and message.get("type") == MessageType.DATA_CONNECT:
+                await self.handle_data_stream(reader, writer, message)
+                return
+            
+            username = self.register_client(client_socket, address, message)
+            if not username:
+                return
+            
+            # 处理客户端消息
+            while self.running:
+                message = await self.receive_message(reader)
+                if not message:
+                    break
+                
+                if message.get("type") in self.DISK_MESSAGE_TYPES:
+                    # 打开文件或完成接收会访问磁盘，在线程池中处理
+                    await self.loop.run_in_executor(self.disk_executor, self.process_message,
+                                                    client_socket, message, username)
+                else:
+                    self.process_message(client_socket, message, username)
+                
+                # 写入线程落后时等待其追上，排队的数据块有上限，放入队列时也不会阻塞事件循环
+                if self.spool and self.spool.queue.qsize() >= self.SPOOL_HIGH_WATER:
+                    await self.loop.run_in_executor(self.disk_executor, self.spool.flush)
+                
+                # 背压：接收方缓冲区回落之前不再读取该发送方的消息
+                if self.congested:
+                    congested = list(self.congested)
+                    self.congested.clear()
+                    await asyncio.gather(*(outbox.drain() for outbox in congested))
+        
+        except Exception as e:
+            print(f"处理客户端 {address} 时发生错误: {e}")
+        finally:
+            # 客户端断开连接
+            self.disconnect_client(client_socket, username)
+            self.connection_tasks.discard(task)
+    
+    async def handle_data_stream(self, reader, writer, message):
+        """
+        处理并行上传的数据连接（asyncio 版本）
+        
+        Args:
+            reader: asyncio.StreamReader
+            writer: asyncio.StreamWriter
+            message: DATA_CONNECT 消息
+        """
+        claim = self.claim_data_range(message)
+        if not claim:
+            writer.writelines(SocketUtils.encode_message(MessageType.ERROR, "无效的传输令牌或区间"))
+            await writer.drain()
+            return
+        
+        transfer, offset, length, expected_crc = claim
+        received = 0
+        crc = 0
+        fd = self.open_data_range(transfer)
+        
+        def write(data, position, crc):
+            """在线程池中写入一段数据并更新CRC32"""
+            self.write_at(fd, data, position)
+            return zlib.crc32(data, crc) if expected_crc is not None else crc
+        
+        try:
+            while received < length:
+                data = await reader.read(min(SocketUtils.RANGE_SLICE_SIZE, length - received))
+                if not data:
+                    break
+                crc = await self.loop.run_in_executor(self.disk_executor, write, data, offset + received, crc)
+                received += len(data)
+        finally:
+            os.close(fd)
+            received = self.finish_data_range(transfer, offset, received, crc, expected_crc)
+        
+        writer.writelines(SocketUtils.encode_message(MessageType.DATA_CONNECT, "", {
+            "offset": offset,
+            "received": received
+        }))
+        await writer.drain()
+    
+    async def receive_message(self, reader):
+        """
+        从流中接收一条消息
+        
+        Args:
+            reader: asyncio.StreamReader
+            
+        Returns:
+            解析后的消息字典，如果连接断开返回None
+        """
+        try:
+            length_data = await reader.readexactly(4)
+            message_length = struct.unpack('!I', length_data)[0]
+            is_binary = bool(message_length & SocketUtils.BINARY_FRAME_FLAG)
+            message_length &= SocketUtils.LENGTH_MASK
+            
+            # 单帧大小受限，保证每个连接的内存占用有上限
+            if message_length > SocketUtils.MAX_FRAME_SIZE:
+                print(f"消息过大: {message_length} 字节")
+                return None
+            
+            message_data = await reader.readexactly(message_length)
+            return SocketUtils.parse_frame(message_data, is_binary)
+        
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        except Exception as e:
+            print(f"接收消息失败: {e}")
+            return None
+    
+    def abort_file_reception(self, client_socket):
+        """连接断开时的文件收尾（等待写入线程、关闭或删除文件）在线程池中进行"""
+        if client_socket in self.file_transfers and client_socket.in_loop():
+            self.loop.run_in_executor(self.disk_executor, super().abort_file_reception, client_socket)
+        else:
+            super().abort_file_reception(client_socket)
+    
+    def create_outbox(self, client_socket):
+        """
+        为客户端创建出站队列（传输层缓冲区即队列，无需写线程）
+        
+        Args:
+            client_socket: StreamSocket
+            
+        Returns:
+            出站队列
+        """
+        return AsyncOutbox(client_socket, self.max_write_buffer, self.slow_consumer_policy, self.congested)
+
+
+def main():
+    """主函数"""
+    host = 'localhost'
+    port = 8888
+    
+    # 处理命令行参数
+    if len(sys.argv) >= 2:
+        try:
+            port = int(sys.argv[1])
+        except ValueError:
+            print("端口号必须是数字")
+            return
+    
+    if len(sys.argv) >= 3:
+        host = sys.argv[2]
+    
+    policy = SlowConsumerPolicy.BACKPRESSURE
+    if len(sys.argv) >= 4:
+        policy = sys.argv[3]
+        if policy not in SlowConsumerPolicy.ALL:
+            print(f"慢客户端策略必须是: {', '.join(SlowConsumerPolicy.ALL)}")
+            return
+    
+    relay_mode = RelayMode.STORE
+    if len(sys.argv) >= 5:
+        relay_mode = sys.argv[4]
+        if relay_mode not in RelayMode.ALL:
+            print(f"文件转发模式必须是: {', '.join(RelayMode.ALL)}")
+            return
+    
+    # 创建并启动服务器
+    server = AsyncChatServer(host, port, slow_consumer_policy=policy, relay_mode=relay_mode)
+    
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print("\n正在关闭服务器...")
+        server.stop()
+    except Exception as e:
+        print(f"服务器运行错误: {e}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
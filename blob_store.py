@@ -0,0 +1,217 @@
+"""
+内容寻址的文件存储
+服务器接收的文件按内容的SHA-256保存，相同内容只保存一份
+"""
+
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from utils import SocketUtils
+
+# 合法的内容哈希：64位小写十六进制（客户端提供的值用作路径，必须先校验）
+SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class BlobStore:
+    """
+    服务器接收文件的去重存储
+    
+    目录结构（位于 files/received/ 下）:
+        blobs/ab/abcdef...   文件内容，以SHA-256命名，前两位作为子目录
+        tmp/                 正在接收的文件
+        index.jsonl          上传记录，每行一条 {"username", "filename", "time", "sha256", "size"}
+    """
+    
+    def __init__(self, root_dir: str):
+        """
+        初始化存储
+        
+        Args:
+            root_dir: 存储根目录（files/received）
+        """
+        self.root_dir = root_dir
+        self.blobs_dir = os.path.join(root_dir, 'blobs')
+        self.temp_dir = os.path.join(root_dir, 'tmp')
+        self.index_path = os.path.join(root_dir, 'index.jsonl')
+        self.lock = threading.Lock()
+        
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+    
+    @staticmethod
+    def is_valid_hash(sha256) -> bool:
+        """
+        是否为合法的SHA-256十六进制串
+        
+        Args:
+            sha256: 待检查的值
+            
+        Returns:
+            是64位小写十六进制字符串返回True
+        """
+        return isinstance(sha256, str) and SHA256_PATTERN.fullmatch(sha256) is not None
+    
+    def blob_path(self, sha256: str) -> str:
+        """
+        获取内容对应的存储路径
+        
+        Args:
+            sha256: 文件内容的SHA-256（十六进制）
+            
+        Returns:
+            存储路径
+            
+        Raises:
+            ValueError: sha256 不是合法的哈希（防止路径穿越到 blobs/ 之外）
+        """
+        if not self.is_valid_hash(sha256):
+            raise ValueError(f"无效的内容哈希: {sha256!r}")
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+    
+    def has_blob(self, sha256: str, size: int) -> bool:
+        """
+        是否已保存该内容
+        
+        Args:
+            sha256: 文件内容的SHA-256
+            size: 文件大小
+            
+        Returns:
+            存在且大小一致返回True
+        """
+        if not self.is_valid_hash(sha256):
+            return False
+        try:
+            return os.path.getsize(self.blob_path(sha256)) == size
+        except OSError:
+            return False
+    
+    def new_temp_path(self) -> str:
+        """
+        生成接收中文件的临时路径（随机名称，无需检查重名）
+        
+        Returns:
+            临时文件路径
+        """
+        return os.path.join(self.temp_dir, f"{secrets.token_hex(8)}.part")
+    
+    def commit(self, temp_path: str, username: str, filename: str, sha256: str = None) -> str:
+        """
+        把接收完成的临时文件存入存储并登记上传记录
+        
+        Args:
+            temp_path: 临时文件路径
+            username: 上传者
+            filename: 原始文件名
+            sha256: 接收时增量计算的摘要，未提供时读取文件计算
+            
+        Returns:
+            内容的存储路径（内容已存在时丢弃临时文件）
+        """
+        if sha256 is None:
+            sha256 = SocketUtils.file_sha256(temp_path)
+        size = os.path.getsize(temp_path)
+        blob_path = self.blob_path(sha256)
+        
+        with self.lock:
+            if os.path.exists(blob_path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_path, blob_path)
+        
+        self.record(username, filename, sha256, size)
+        return blob_path
+    
+    def record(self, username: str, filename: str, sha256: str, size: int):
+        """
+        追加一条上传记录
+        
+        Args:
+            username: 上传者
+            filename: 原始文件名
+            sha256: 文件内容的SHA-256
+            size: 文件大小
+        """
+        entry = {
+            "username": username,
+            "filename": filename,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "sha256": sha256,
+            "size": size
+        }
+        with self.lock:
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    
+    def discard(self, temp_path: str):
+        """
+        删除未完成且无法续传的临时文件
+        
+        Args:
+            temp_path: 临时文件路径
+        """
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+class ChunkSpool:
+    """
+    异步写入接收文件的后台线程（spool 转发模式）
+    
+    数据块先转发给接收方，再放入有界队列由本线程按顺序写入部分文件并更新摘要，
+    接收线程不等待磁盘。队列已满时接收线程等待，内存占用有上限。
+    """
+    
+    def __init__(self, max_chunks: int = 1024):
+        """
+        初始化写入线程
+        
+        Args:
+            max_chunks: 队列中等待写入的数据块上限
+        """
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def write(self, transfer_info: dict, chunk: bytes):
+        """
+        排队写入一个数据块
+        
+        Args:
+            transfer_info: 服务器的文件接收信息（file_handle, hasher, failed）
+            chunk: 数据块
+        """
+        self.queue.put((transfer_info, chunk))
+    
+    def flush(self):
+        """等待此前排队的数据块全部写入"""
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+    
+    def _run(self):
+        """写入线程：按排队顺序写入数据块"""
+        while True:
+            transfer_info, chunk = self.queue.get()
+            if transfer_info is None:
+                chunk.set()
+                continue
+            
+            if transfer_info["failed"]:
+                continue
+            
+            try:
+                transfer_info["file_handle"].write(chunk)
+                if transfer_info["hasher"]:
+                    transfer_info["hasher"].update(chunk)
+            except Exception as e:
+                print(f"写入文件 '{transfer_info['filename']}' 失败: {e}")
+                transfer_info["failed"] = True
@@ -0,0 +1,437 @@
+"""
+聊天记录日志
+所有 TEXT / USER_JOIN / USER_LEAVE 事件按时间顺序追加到分段日志中，
+每个分段带稀疏时间索引和按用户的索引，查询直接定位到内存映射分段中的记录，不扫描整个日志
+"""
+
+import datetime
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+
+class LogSegment:
+    """
+    日志的一个分段
+    
+    文件（同一前缀）:
+        <序号>.log    记录依次排列: 记录头（体长度, 毫秒时间戳）+ JSON记录体
+        <序号>.idx    稀疏时间索引: 记录每跨过 INDEX_INTERVAL 字节登记一次 (时间戳, 位置)
+        <序号>.uidx   用户索引: 每条记录一项 (位置, 用户名长度, 用户名)
+    
+    日志文件预分配并映射到内存，追加时先写记录体、最后写记录头，未写入的部分为零；
+    索引在记录写入之后追加，重启时截掉索引文件末尾不完整的项，
+    再从最后一条已索引的记录往后扫描，补上崩溃前未写入的索引。
+    """
+    
+    RECORD_HEADER = struct.Struct('!IQ')       # 记录体长度, 时间戳（毫秒）
+    INDEX_ENTRY = struct.Struct('!QQ')         # 时间戳, 记录位置
+    USER_ENTRY_HEADER = struct.Struct('!QH')   # 记录位置, 用户名字节数
+    
+    INDEX_INTERVAL = 4096
+    GROW_SIZE = 1024 * 1024
+    
+    def __init__(self, prefix: str):
+        """
+        打开（或创建）分段
+        
+        Args:
+            prefix: 分段文件路径前缀（不含扩展名）
+        """
+        self.prefix = prefix
+        self.times = array('Q')       # 稀疏索引的时间戳
+        self.positions = array('Q')   # 稀疏索引的记录位置
+        self.users = {}               # {用户名: array('Q') 记录位置}
+        self.next_index = 0           # 下一次登记稀疏索引的位置
+        self.end = 0
+        self.first_time = None
+        self.last_time = None
+        
+        log_path = prefix + '.log'
+        self.file = open(log_path, 'r+b' if os.path.exists(log_path) else 'w+b')
+        if os.path.getsize(log_path) == 0:
+            self.file.truncate(self.GROW_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        
+        self._load_indexes()
+        self.index_file = open(prefix + '.idx', 'ab')
+        self.user_file = open(prefix + '.uidx', 'ab')
+        self._recover()
+    
+    def _load_indexes(self):
+        """
+        读取索引文件
+        
+        进程被终止时索引文件末尾可能只写入了半项，截掉这部分之后再打开追加，
+        否则之后追加的索引项都会错位；截掉的索引由 _recover 从日志补上。
+        """
+        index_path = self.prefix + '.idx'
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            valid = len(data) - len(data) % self.INDEX_ENTRY.size
+            for offset in range(0, valid, self.INDEX_ENTRY.size):
+                timestamp, position = self.INDEX_ENTRY.unpack_from(data, offset)
+                self.times.append(timestamp)
+                self.positions.append(position)
+            if self.positions:
+                self.next_index = self.positions[-1] + self.INDEX_INTERVAL
+            if valid < len(data):
+                os.truncate(index_path, valid)
+        
+        user_path = self.prefix + '.uidx'
+        if os.path.exists(user_path):
+            with open(user_path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + self.USER_ENTRY_HEADER.size <= len(data):
+                position, size = self.USER_ENTRY_HEADER.unpack_from(data, offset)
+                start = offset + self.USER_ENTRY_HEADER.size
+                if start + size > len(data):
+                    break
+                try:
+                    username = data[start:start + size].decode('utf-8')
+                except UnicodeDecodeError:
+                    break
+                self.users.setdefault(username, array('Q')).append(position)
+                offset = start + size
+            if offset < len(data):
+                os.truncate(user_path, offset)
+    
+    def _recover(self):
+        """从最后一条已索引的记录往后扫描，确定日志末尾并补全索引"""
+        last_indexed = max((positions[-1] for positions in self.users.values()), default=None)
+        position = 0 if last_indexed is None else last_indexed
+        
+        while True:
+            record = self._header_at(position)
+            if record is None:
+                break
+            length, timestamp = record
+            if last_indexed is None or position > last_indexed:
+                username = self.read(position)["user"]
+                self._index(position, timestamp, username)
+            self.last_time = timestamp
+            position += self.RECORD_HEADER.size + length
+        
+        self.end = position
+        if self.end:
+            self.first_time = self._header_at(0)[1]
+    
+    def _header_at(self, position: int):
+        """
+        读取记录头
+        
+        Returns:
+            (记录体长度, 时间戳)，该位置没有完整的记录返回None
+        """
+        if position + self.RECORD_HEADER.size > len(self.map):
+            return None
+        length, timestamp = self.RECORD_HEADER.unpack_from(self.map, position)
+        if length == 0 or position + self.RECORD_HEADER.size + length > len(self.map):
+            return None
+        return length, timestamp
+    
+    def _index(self, position: int, timestamp: int, username: str):
+        """为一条记录登记索引"""
+        if position >= self.next_index:
+            self.times.append(timestamp)
+            self.positions.append(position)
+            self.index_file.write(self.INDEX_ENTRY.pack(timestamp, position))
+            self.next_index = position + self.INDEX_INTERVAL
+        
+        name = username.encode('utf-8')
+        self.users.setdefault(username, array('Q')).append(position)
+        self.user_file.write(self.USER_ENTRY_HEADER.pack(position, len(name)) + name)
+    
+    def append(self, timestamp: int, body: bytes, username: str):
+        """
+        追加一条记录
+        
+        Args:
+            timestamp: 毫秒时间戳（不小于上一条记录）
+            body: JSON记录体
+            username: 记录所属的用户
+        """
+        size = self.RECORD_HEADER.size + len(body)
+        if self.end + size > len(self.map):
+            self._remap((self.end + size) // self.GROW_SIZE * self.GROW_SIZE + self.GROW_SIZE)
+        
+        position = self.end
+        self.map[position + self.RECORD_HEADER.size:position + size] = body
+        self.map[position:position + self.RECORD_HEADER.size] = self.RECORD_HEADER.pack(len(body), timestamp)
+        self.end += size
+        
+        self._index(position, timestamp, username)
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+    
+    def _remap(self, size: int):
+        """把日志文件调整为指定大小后重新映射"""
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+    
+    def seal(self):
+        """分段写满后去掉预分配的空间，之后只读"""
+        self.index_file.flush()
+        self.user_file.flush()
+        self._remap(self.end)
+    
+    def read(self, position: int) -> dict:
+        """
+        读取一条记录
+        
+        Args:
+            position: 记录位置
+            
+        Returns:
+            {"time": 秒, "type", "user", "data"}
+        """
+        length, timestamp = self.RECORD_HEADER.unpack_from(self.map, position)
+        start = position + self.RECORD_HEADER.size
+        record = json.loads(str(self.map[start:start + length], 'utf-8'))
+        record["time"] = timestamp / 1000
+        return record
+    
+    def records(self, position: int = 0):
+        """
+        从指定位置开始依次读取记录
+        
+        Args:
+            position: 起始记录位置
+            
+        Yields:
+            (记录位置, 记录字典)
+        """
+        while position < self.end:
+            length = self.RECORD_HEADER.unpack_from(self.map, position)[0]
+            yield position, self.read(position)
+            position += self.RECORD_HEADER.size + length
+    
+    def scan(self, since: int, until: int):
+        """
+        按时间顺序读取时间范围内的记录（从稀疏索引定位起点）
+        
+        Args:
+            since: 起始毫秒时间戳
+            until: 结束毫秒时间戳
+            
+        Yields:
+            记录字典
+        """
+        slot = bisect_right(self.times, since) - 1
+        position = self.positions[slot] if slot >= 0 else 0
+        while position < self.end:
+            length, timestamp = self.RECORD_HEADER.unpack_from(self.map, position)
+            if timestamp > until:
+                return
+            if timestamp >= since:
+                yield self.read(position)
+            position += self.RECORD_HEADER.size + length
+    
+    def scan_user(self, username: str, since: int, until: int):
+        """
+        按时间顺序读取某个用户在时间范围内的记录（在用户索引上二分查找起点）
+        
+        Args:
+            username: 用户名
+            since: 起始毫秒时间戳
+            until: 结束毫秒时间戳
+            
+        Yields:
+            记录字典
+        """
+        positions = self.users.get(username)
+        if not positions:
+            return
+        
+        low, high = 0, len(positions)
+        while low < high:
+            middle = (low + high) // 2
+            if self.RECORD_HEADER.unpack_from(self.map, positions[middle])[1] < since:
+                low = middle + 1
+            else:
+                high = middle
+        
+        for position in positions[low:]:
+            if self.RECORD_HEADER.unpack_from(self.map, position)[1] > until:
+                return
+            yield self.read(position)
+    
+    def close(self):
+        """关闭分段"""
+        self.index_file.close()
+        self.user_file.close()
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class ChatLog:
+    """
+    分段的聊天记录日志
+    
+    记录只追加，时间戳单调不减；当前分段超过 SEGMENT_BYTES 后封存，写入新的分段。
+    查询先按各分段的时间范围跳过无关分段，再用稀疏时间索引或用户索引定位，
+    只读取结果附近的记录。
+    
+    每条记录有一个引用号（分段序号 << REF_BITS | 分段内位置），随写入顺序递增。
+    listeners 中的回调在写入锁内按写入顺序收到新记录，用于维护派生的索引。
+    """
+    
+    SEGMENT_BYTES = 64 * 1024 * 1024
+    REF_BITS = 40
+    
+    def __init__(self, directory: str):
+        """
+        打开（或创建）日志目录
+        
+        Args:
+            directory: 日志目录
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        
+        names = sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [LogSegment(os.path.join(directory, name)) for name in names]
+        if not self.segments:
+            self.segments.append(LogSegment(os.path.join(directory, f"{0:08d}")))
+        self.last_time = self.segments[-1].last_time or 0
+        self.listeners = []  # 回调 (引用号, 记录字典)
+    
+    def append(self, msg_type: str, username: str, data: str):
+        """
+        追加一条事件
+        
+        Args:
+            msg_type: TEXT / USER_JOIN / USER_LEAVE
+            username: 发送消息、加入或离开的用户
+            data: 消息内容
+            
+        Returns:
+            记录的引用号，日志已关闭返回None
+        """
+        record = {"type": msg_type, "user": username, "data": data}
+        body = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            if not self.segments:
+                return None
+            timestamp = max(int(time.time() * 1000), self.last_time)
+            segment = self.segments[-1]
+            if segment.end and segment.end + LogSegment.RECORD_HEADER.size + len(body) > self.SEGMENT_BYTES:
+                segment.seal()
+                segment = LogSegment(os.path.join(self.directory, f"{len(self.segments):08d}"))
+                self.segments.append(segment)
+            ref = (len(self.segments) - 1) << self.REF_BITS | segment.end
+            segment.append(timestamp, body, username)
+            self.last_time = timestamp
+            
+            record["time"] = timestamp / 1000
+            for listener in self.listeners:
+                listener(ref, record)
+            return ref
+    
+    def read(self, ref: int) -> dict:
+        """
+        按引用号读取一条记录
+        
+        Args:
+            ref: append 返回的引用号
+            
+        Returns:
+            记录字典
+        """
+        with self.lock:
+            return self.segments[ref >> self.REF_BITS].read(ref & ((1 << self.REF_BITS) - 1))
+    
+    def records_after(self, ref: int = None):
+        """
+        依次读取某条记录之后的所有记录（遍历期间持有日志锁，用于启动时重建索引）
+        
+        Args:
+            ref: 引用号，None 表示从头开始
+            
+        Yields:
+            (引用号, 记录字典)
+        """
+        first = 0 if ref is None else ref >> self.REF_BITS
+        with self.lock:
+            for number in range(first, len(self.segments)):
+                start = ref & ((1 << self.REF_BITS) - 1) if ref is not None and number == first else 0
+                for position, record in self.segments[number].records(start):
+                    current = number << self.REF_BITS | position
+                    if ref is None or current > ref:
+                        yield current, record
+    
+    def query(self, username: str = None, since: float = None, until: float = None, limit: int = 100) -> list:
+        """
+        查询时间范围内的记录
+        
+        Args:
+            username: 只返回该用户的记录，None 表示所有用户
+            since: 起始时间（秒），None 表示最早
+            until: 结束时间（秒），None 表示现在
+            limit: 最多返回的记录数
+            
+        Returns:
+            按时间顺序的记录列表 [{"time", "type", "user", "data"}]
+        """
+        since_ms = int(since * 1000) if since is not None else 0
+        until_ms = int(until * 1000) if until is not None else 2 ** 63
+        
+        results = []
+        with self.lock:
+            for segment in self.segments:
+                if segment.end == 0 or segment.last_time < since_ms:
+                    continue
+                if segment.first_time > until_ms:
+                    break
+                
+                if username is None:
+                    records = segment.scan(since_ms, until_ms)
+                else:
+                    records = segment.scan_user(username, since_ms, until_ms)
+                for record in records:
+                    results.append(record)
+                    if len(results) >= limit:
+                        return results
+        return results
+    
+    def close(self):
+        """关闭所有分段"""
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+
+
+def parse_time(text: str):
+    """
+    解析查询的起始时间
+    
+    Args:
+        text: 相对时间（如 30m、2h、7d）或绝对时间（2024-01-31、2024-01-31 08:00）
+        
+    Returns:
+        时间（秒），无法解析返回None
+    """
+    match = re.fullmatch(r'(\d+)([smhd])', text.strip())
+    if match:
+        seconds = {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return time.time() - int(match.group(1)) * seconds
+    
+    for pattern in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(text.strip(), pattern).timestamp()
+        except ValueError:
+            continue
+    return None
@@ -7,7 +7,9 @@ import socket
 import threading
 import sys
 import os
-from utils import SocketUtils, MessageType, is_valid_file_path
+import queue
+from utils import (SocketUtils, MessageType, Feature, FrameReader, StreamHasher, TransferController,
+                   is_valid_file_path, format_message)
 
 
 class ChatClient:
@@ -30,6 +32,13 @@ class ChatClient:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connected = False
         
+        # 与服务器协商好的协议特性（收到欢迎消息前使用原有协议）
+        self.features = frozenset()
+        
+        # 接收线程转交给发送文件流程的回复（FILE_RESUME、TRANSFER_TOKEN）
+        self.transfer_replies = queue.Queue()
+        self.transfer_controller = None  # 正在进行的上传的自适应传输控制器
+        
         # 文件接收目录
         self.downloads_dir = os.path.join(os.path.dirname(__file__), 'files', 'downloads')
         os.makedirs(self.downloads_dir, exist_ok=True)
@@ -38,15 +47,21 @@ class ChatClient:
         """连接到服务器"""
         try:
             self.socket.connect((self.host, self.port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.connected = True
             
-            # 发送用户名到服务器
-            SocketUtils.send_message(self.socket, MessageType.USER_JOIN, self.username)
+            # 发送用户名到服务器，同时声明支持的协议特性
+            SocketUtils.send_message(self.socket, MessageType.USER_JOIN, self.username, {
+                "features": SocketUtils.encode_features(SocketUtils.SUPPORTED_FEATURES)
+            })
             
             print(f"已连接到服务器 {self.host}:{self.port}")
             print(f"用户名: {self.username}")
             print("\n聊天室命令:")
             print("  /send <文件路径> - 发送文件")
+            print("  /send @用户名[,用户名2] <文件路径> - 只发送给指定用户或群组")
+            print("  /search <关键词> - 搜索聊天消息")
+            print("  @用户名 <消息> - 发送私信")
             print("  /help - 显示帮助信息")
             print("  /quit - 退出聊天室")
             print("  直接输入文本发送消息\n")
@@ -76,10 +91,11 @@ class ChatClient:
         """接收服务器消息"""
         current_file = None
         file_handle = None
+        reader = FrameReader.for_socket(self.socket)
         
         try:
             while self.connected:
-                message = SocketUtils.receive_message(self.socket)
+                message = reader.read_message()
                 if not message:
                     break
                 
@@ -88,11 +104,29 @@ class ChatClient:
                 metadata = message.get("metadata", {})
                 
                 if msg_type == MessageType.TEXT:
-                    print(data)
+                    # 欢迎消息携带服务器协商结果
+                    if "features" in metadata:
+                        self.features = SocketUtils.parse_features(metadata["features"])
+                    if message.get("peer"):
+                        # 其他用户的私信，路由头中的对方用户名是发送者
+                        print(format_message(message.get("peer"), f"[私信] {data}"))
+                    else:
+                        print(data)
+                
+                elif msg_type in (MessageType.FILE_RESUME, MessageType.TRANSFER_TOKEN):
+                    self.transfer_replies.put(message)
+                
+                elif msg_type == MessageType.FILE_ACK:
+                    controller = self.transfer_controller
+                    if controller:
+                        controller.on_ack(metadata)
                 
                 elif msg_type == MessageType.USER_JOIN or msg_type == MessageType.USER_LEAVE:
                     print(f"[系统消息] {data}")
                 
+                elif msg_type == MessageType.SEARCH:
+                    print(data)
+                
                 elif msg_type == MessageType.FILE:
                     # 开始接收文件
                     import time
@@ -102,6 +136,8 @@ class ChatClient:
                     
                     print(f"\n📥 接收文件: {filename}")
                     print(f"👤 发送者: {sender}")
+                    if metadata.get("to"):
+                        print(f"🎯 定向发送: {metadata['to']}")
                     print(f"📊 文件大小: {SocketUtils.format_file_size(file_size)}")
                     
                     # 准备接收文件
@@ -122,35 +158,40 @@ class ChatClient:
                         "filename": filename,
                         "start_time": time.time(),
                         "last_update": time.time(),
-                        "chunk_count": 0
+                        "chunk_count": 0,
+                        "corrupted": False,
+                        "hasher": StreamHasher(file_size)  # 边接收边计算整个文件的摘要
                     }
                     
                     file_handle = open(file_path, 'wb')
+                    
+                    if metadata.get("raw_stream"):
+                        # 文件内容以原始字节流紧跟在 FILE 头之后
+                        def update_progress(received, current_file=current_file):
+                            current_file["received"] = received
+                            self.show_receive_progress(current_file)
+                        
+                        def write_chunk(chunk, file_handle=file_handle, hasher=current_file["hasher"]):
+                            file_handle.write(chunk)
+                            hasher.update(chunk)
+                        
+                        received = reader.read_raw(int(file_size), write_chunk, update_progress)
+                        current_file["chunk_count"] = 1
+                        if received < int(file_size):
+                            print("\n❌ 文件接收中断: 连接已关闭")
+                            break
                 
                 elif msg_type == MessageType.FILE_DATA and current_file and file_handle:
                     # 接收文件数据
-                    import time
-                    chunk_hex = data
-                    chunk = bytes.fromhex(chunk_hex)
+                    chunk = SocketUtils.decode_chunk(data)
+                    if not current_file["corrupted"] and not SocketUtils.verify_chunk(chunk, metadata):
+                        current_file["corrupted"] = True
+                        print(f"\n⚠️ 数据块 {metadata.get('chunk_index')} 校验失败，文件可能已损坏")
                     file_handle.write(chunk)
+                    current_file["hasher"].update(chunk)
                     current_file["received"] += len(chunk)
                     current_file["chunk_count"] += 1
-                    
-                    # 显示接收进度（每0.1秒更新一次）
-                    current_time = time.time()
-                    if current_file["size"] > 0 and (current_time - current_file["last_update"] >= 0.1):
-                        progress = (current_file["received"] / current_file["size"]) * 100
-                        elapsed_time = current_time - current_file["start_time"]
-                        
-                        if elapsed_time > 0:
-                            speed = current_file["received"] / elapsed_time
-                            speed_str = SocketUtils.format_transfer_speed(speed)
-                            progress_bar = SocketUtils.create_progress_bar(progress)
-                            
-                            print(f"\r{progress_bar} {progress:.1f}% | {speed_str} | {SocketUtils.format_file_size(current_file['received'])}/{SocketUtils.format_file_size(current_file['size'])}", 
-                                  end="", flush=True)
-                            
-                            current_file["last_update"] = current_time
+                    self.show_receive_progress(current_file)
                 
                 elif msg_type == MessageType.FILE_COMPLETE and current_file and file_handle:
                     # 文件接收完成
@@ -172,6 +213,13 @@ class ChatClient:
                     
                     print(f"📦 数据块数: {current_file['chunk_count']}")
                     
+                    # 发送方提供了整个文件的摘要时核对
+                    sha256 = current_file["hasher"].hexdigest()
+                    if metadata.get("sha256") and metadata["sha256"] != sha256:
+                        print("⚠️ 文件校验失败: SHA-256 不一致，文件已损坏")
+                    elif metadata.get("sha256"):
+                        print("🔒 文件校验通过 (SHA-256)")
+                    
                     current_file = None
                     file_handle = None
                 
@@ -184,6 +232,31 @@ class ChatClient:
         finally:
             if file_handle:
                 file_handle.close()
+            if current_file:
+                current_file["hasher"].close()
+    
+    def show_receive_progress(self, current_file):
+        """
+        显示文件接收进度（每0.1秒更新一次）
+        
+        Args:
+            current_file: 正在接收的文件信息
+        """
+        import time
+        current_time = time.time()
+        if current_file["size"] > 0 and (current_time - current_file["last_update"] >= 0.1):
+            progress = (current_file["received"] / current_file["size"]) * 100
+            elapsed_time = current_time - current_file["start_time"]
+            
+            if elapsed_time > 0:
+                speed = current_file["received"] / elapsed_time
+                speed_str = SocketUtils.format_transfer_speed(speed)
+                progress_bar = SocketUtils.create_progress_bar(progress)
+                
+                print(f"\r{progress_bar} {progress:.1f}% | {speed_str} | {SocketUtils.format_file_size(current_file['received'])}/{SocketUtils.format_file_size(current_file['size'])}", 
+                      end="", flush=True)
+                
+                current_file["last_update"] = current_time
     
     def send_text_message(self, message):
         """
@@ -193,16 +266,177 @@ class ChatClient:
             message: 消息内容
         """
         try:
-            SocketUtils.send_message(self.socket, MessageType.TEXT, message)
+            SocketUtils.send_message(self.socket, MessageType.TEXT, message,
+                                     compress=Feature.ZLIB in self.features,
+                                     routed=Feature.ROUTED_HEADER in self.features,
+                                     compact=Feature.COMPACT_CODEC in self.features)
         except Exception as e:
             print(f"发送消息失败: {e}")
     
-    def send_file(self, file_path):
+    def send_private_message(self, target, message):
+        """
+        发送私信
+        
+        协商了路由头时接收者写在路由头中，服务器不解析消息体即可转发；
+        否则放在元数据的 to 字段中。
+        
+        Args:
+            target: 接收者用户名
+            message: 消息内容
+        """
+        try:
+            if Feature.ROUTED_HEADER in self.features:
+                SocketUtils.send_message(self.socket, MessageType.TEXT, message,
+                                         compress=Feature.ZLIB in self.features, routed=True, peer=target,
+                                         compact=Feature.COMPACT_CODEC in self.features)
+            else:
+                SocketUtils.send_message(self.socket, MessageType.TEXT, message, {"to": target},
+                                         compact=Feature.COMPACT_CODEC in self.features)
+        except Exception as e:
+            print(f"发送私信失败: {e}")
+    
+    def wait_for_reply(self, msg_type, filename, timeout=30):
+        """
+        等待服务器对文件上传的回复
+        
+        Args:
+            msg_type: 回复的消息类型
+            filename: 文件名
+            timeout: 超时时间（秒）
+            
+        Returns:
+            回复的元数据
+            
+        Raises:
+            TimeoutError: 超时未收到回复
+        """
+        while True:
+            try:
+                reply = self.transfer_replies.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("等待服务器回复超时")
+            
+            # 忽略之前超时的上传遗留的回复
+            metadata = reply.get("metadata", {})
+            if reply.get("type") == msg_type and metadata.get("filename") == filename:
+                return metadata
+    
+    def wait_for_resume(self, filename):
+        """
+        等待服务器对文件上传的 FILE_RESUME 回复
+        
+        Args:
+            filename: 文件名
+            
+        Returns:
+            续传位置（已被服务器接收的字节数）
+        """
+        return int(self.wait_for_reply(MessageType.FILE_RESUME, filename).get("offset", 0))
+    
+    def send_file_parallel(self, file_path, recipients=None):
+        """
+        经多个数据连接并行上传大文件，聊天连接只用于获取令牌和发送完成信号
+        
+        Args:
+            file_path: 文件路径
+            recipients: 逗号分隔的接收者用户名或群组名，None 表示发给所有人
+            
+        Raises:
+            ConnectionError: 有区间没有被服务器完整接收
+        """
+        import time
+        filename = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        
+        file_info = {
+            "filename": filename,
+            "size": file_size,
+            "sender": self.username,
+            "streams": SocketUtils.PARALLEL_STREAMS
+        }
+        if recipients:
+            file_info["to"] = recipients
+        
+        compact = Feature.COMPACT_CODEC in self.features
+        SocketUtils.send_message(self.socket, MessageType.FILE, "", file_info, compact=compact)
+        reply = self.wait_for_reply(MessageType.TRANSFER_TOKEN, filename)
+        ranges = [(int(offset), int(length)) for offset, length in reply["ranges"]]
+        
+        print(f"📤 开始并行发送文件: {filename}（{len(ranges)} 个数据连接）")
+        print(f"📊 文件大小: {SocketUtils.format_file_size(file_size)}")
+        
+        start_time = time.time()
+        progress_lock = threading.Lock()
+        progress = {"sent": 0}
+        results = {}
+        
+        # 协商了完整性校验时各区间带CRC32，整个文件的SHA-256在发送的同时由另一个线程计算
+        integrity = Feature.INTEGRITY in self.features
+        digest = {}
+        hash_thread = None
+        if integrity:
+            def compute_digest():
+                digest["sha256"] = SocketUtils.file_sha256(file_path)
+            hash_thread = threading.Thread(target=compute_digest)
+            hash_thread.daemon = True
+            hash_thread.start()
+        
+        def on_progress(count):
+            with progress_lock:
+                progress["sent"] += count
+        
+        def send_range(offset, length):
+            try:
+                results[offset] = SocketUtils.send_file_range((self.host, self.port), reply["token"],
+                                                              file_path, offset, length, on_progress, integrity)
+            except OSError as e:
+                print(f"\n数据连接发送失败: {e}")
+                results[offset] = 0
+        
+        threads = [threading.Thread(target=send_range, args=item) for item in ranges]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        
+        # 等待所有区间发送完成，期间显示总进度
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.1)
+            elapsed_time = time.time() - start_time
+            if elapsed_time > 0 and file_size > 0:
+                sent = progress["sent"]
+                speed_str = SocketUtils.format_transfer_speed(sent / elapsed_time)
+                progress_bar = SocketUtils.create_progress_bar(sent / file_size * 100)
+                print(f"\r{progress_bar} {sent / file_size * 100:.1f}% | {speed_str} | {SocketUtils.format_file_size(sent)}/{SocketUtils.format_file_size(file_size)}", 
+                      end="", flush=True)
+        
+        total_time = time.time() - start_time
+        complete_metadata = {
+            "filename": filename,
+            "total_size": file_size,
+            "transfer_time": total_time,
+            "token": reply["token"]
+        }
+        if hash_thread:
+            hash_thread.join()
+            complete_metadata["sha256"] = digest.get("sha256")
+        SocketUtils.send_message(self.socket, MessageType.FILE_COMPLETE, "", complete_metadata, compact=compact)
+        
+        print()  # 换行
+        if any(results.get(offset) != length for offset, length in ranges):
+            raise ConnectionError("部分数据没有被服务器完整接收")
+        
+        print(f"✅ 文件发送完成: {filename}")
+        print(f"⏱️  传输时间: {SocketUtils.format_time(total_time)}")
+        if total_time > 0:
+            print(f"🚀 平均速度: {SocketUtils.format_transfer_speed(file_size / total_time)}")
+    
+    def send_file(self, file_path, recipients=None):
         """
         发送文件
         
         Args:
             file_path: 文件路径
+            recipients: 逗号分隔的接收者用户名或群组名，None 表示发给所有人
         """
         try:
             # 处理相对路径
@@ -216,8 +450,23 @@ class ChatClient:
             
             print(f"开始发送文件: {os.path.basename(file_path)}")
             print(f"文件大小: {os.path.getsize(file_path)} 字节")
+            if recipients:
+                print(f"接收者: {recipients}")
             
-            SocketUtils.send_file(self.socket, file_path, self.username)
+            if (Feature.PARALLEL_UPLOAD in self.features and
+                    os.path.getsize(file_path) >= SocketUtils.PARALLEL_MIN_SIZE):
+                self.send_file_parallel(file_path, recipients)
+            else:
+                # 协商了自适应分块时按测得的往返时间和吞吐量调整数据块大小和发送窗口
+                if Feature.ADAPTIVE_CHUNKS in self.features:
+                    initial = SocketUtils.get_optimal_buffer_size(os.path.getsize(file_path))
+                    self.transfer_controller = TransferController(initial)
+                try:
+                    SocketUtils.send_file(self.socket, file_path, self.username, features=self.features,
+                                          wait_resume=self.wait_for_resume, recipients=recipients,
+                                          controller=self.transfer_controller)
+                finally:
+                    self.transfer_controller = None
             print(f"✅ 文件 '{os.path.basename(file_path)}' 发送成功")
             return True
             
@@ -251,23 +500,53 @@ class ChatClient:
         elif command.lower() == '/help':
             print("\n聊天室命令:")
             print("  /send <文件路径> - 发送文件")
+            print("  /send @用户名[,用户名2] <文件路径> - 只发送给指定用户或群组")
+            print("  /search <关键词> - 搜索聊天消息")
+            print("  @用户名 <消息> - 发送私信")
             print("  /help - 显示帮助信息")
             print("  /quit - 退出聊天室")
             print("  直接输入文本发送消息\n")
         
         elif command.lower().startswith('/send '):
-            # 发送文件命令
+            # 发送文件命令（/send @用户1,群组 文件路径 只发送给指定接收者）
             file_path = command[6:].strip()
-            if file_path:
+            recipients = None
+            if file_path.startswith('@'):
+                parts = file_path.split(' ', 1)
+                recipients = parts[0][1:]
+                file_path = parts[1].strip() if len(parts) == 2 else ""
+            
+            if file_path and recipients != "":
                 # 去除可能的引号
                 if file_path.startswith('"') and file_path.endswith('"'):
                     file_path = file_path[1:-1]
                 elif file_path.startswith("'") and file_path.endswith("'"):
                     file_path = file_path[1:-1]
                 
-                self.send_file(file_path)
+                self.send_file(file_path, recipients)
             else:
                 print("请指定要发送的文件路径，例如: /send /path/to/file.txt")
+                print("定向发送: /send @用户名 /path/to/file.txt")
+        
+        elif command.lower().startswith('/search '):
+            # 搜索聊天消息，结果由服务器回复
+            query = command[8:].strip()
+            if query:
+                try:
+                    SocketUtils.send_message(self.socket, MessageType.SEARCH, query,
+                                             compact=Feature.COMPACT_CODEC in self.features)
+                except Exception as e:
+                    print(f"发送搜索请求失败: {e}")
+            else:
+                print("请输入要搜索的关键词，例如: /search 你好")
+        
+        elif command.startswith('@'):
+            # 私信: @用户名 消息内容
+            parts = command[1:].split(None, 1)
+            if len(parts) == 2:
+                self.send_private_message(parts[0], parts[1])
+            else:
+                print("私信格式: @用户名 消息内容")
         
         elif command.startswith('/'):
             print(f"未知命令: {command}，输入 /help 查看可用命令")
@@ -0,0 +1,127 @@
+"""
+在线客户端登记
+成员变化只在锁内修改内存中的字典，广播和查找读取不可变快照，不持有锁
+"""
+
+import threading
+from typing import Dict, List, Optional, Tuple
+from user_index import UsernameIndex
+
+
+class ClientRegistry:
+    """
+    在线客户端的登记表
+    
+    写入（加入、离开）持有锁，但锁内只做字典和索引的修改，从不做网络I/O，
+    因此成员变化不会等待任何发送。
+    读取方使用 snapshot() 返回的元组：成员变化后第一次读取时在锁内重建，
+    之后所有广播共享同一个不可变元组，直到下一次成员变化，遍历时不持有锁。
+    """
+    
+    def __init__(self):
+        """初始化空的登记表"""
+        self.clients = {}  # {socket: {"username": str, "address": tuple, "features": frozenset, "outbox": ...}}
+        self.index = UsernameIndex()
+        self.lock = threading.Lock()
+        self._snapshot = ()
+    
+    def add(self, client_socket, client_info: Dict):
+        """
+        登记一个客户端
+        
+        Args:
+            client_socket: 客户端套接字
+            client_info: 客户端信息（须包含 username）
+        """
+        with self.lock:
+            self.clients[client_socket] = client_info
+            self.index.add(client_info["username"], client_socket)
+            self._snapshot = None
+    
+    def remove(self, client_socket) -> Optional[Dict]:
+        """
+        移除一个客户端（重复移除返回None）
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            被移除的客户端信息
+        """
+        with self.lock:
+            client_info = self.clients.pop(client_socket, None)
+            if client_info is not None:
+                self.index.remove(client_info["username"], client_socket)
+                self._snapshot = None
+            return client_info
+    
+    def clear(self) -> Tuple:
+        """
+        移除所有客户端
+        
+        Returns:
+            移除前的 (客户端套接字, 客户端信息) 元组
+        """
+        with self.lock:
+            removed = tuple(self.clients.items())
+            self.clients.clear()
+            self.index = UsernameIndex()
+            self._snapshot = ()
+            return removed
+    
+    def get(self, client_socket) -> Optional[Dict]:
+        """
+        获取客户端信息
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            客户端信息，不在线返回None
+        """
+        return self.clients.get(client_socket)
+    
+    def snapshot(self) -> Tuple:
+        """
+        获取当前在线客户端的不可变快照
+        
+        Returns:
+            (客户端套接字, 客户端信息) 元组，调用方不得修改
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self.lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self.clients.items())
+                snapshot = self._snapshot
+        return snapshot
+    
+    def find(self, username: str):
+        """
+        根据用户名查找连接
+        
+        Args:
+            username: 用户名
+            
+        Returns:
+            最早加入的同名连接，不在线返回None
+        """
+        with self.lock:
+            return self.index.get(username)
+    
+    def search(self, pattern: str) -> List[str]:
+        """
+        搜索包含指定子串的在线用户名（不区分大小写）
+        
+        Args:
+            pattern: 搜索的子串
+            
+        Returns:
+            匹配的用户名列表
+        """
+        with self.lock:
+            return self.index.search(pattern)
+    
+    def __len__(self) -> int:
+        """在线客户端数量"""
+        return len(self.clients)
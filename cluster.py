@@ -0,0 +1,1005 @@
+"""
+多进程聊天服务器
+启动器创建多个工作进程，通过 SO_REUSEPORT 共享同一端口，由内核把新连接分配给各进程；
+进程之间经本地 Unix 套接字上的消息总线转发广播和在线用户变化
+"""
+
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from utils import (SocketUtils, MessageType, Feature, FrameReader, PreparedMessage, OutboundQueue,
+                   SlowConsumerPolicy, RelayMode, format_message)
+from server import ChatServer
+
+
+class BusKind:
+    """消息总线的信封类型"""
+    HELLO = "BUS_HELLO"                # 工作进程连接总线后第一条消息，metadata["member"] 为进程编号
+    AUTH = "BUS_AUTH"                  # 联邦节点握手的认证 {"mac"}（见 FederatedServer.handshake_mac）
+    JOIN = "BUS_JOIN"                  # 用户加入 {"address", "username"}
+    LEAVE = "BUS_LEAVE"                # 用户离开 {"address"}
+    SYNC = "BUS_SYNC"                  # 某个进程的全部在线用户 {"users": {地址: 用户名}}
+    SYNC_REQUEST = "BUS_SYNC_REQUEST"  # 请求其他进程发送 SYNC
+    BROADCAST = "BUS_BROADCAST"        # 负载消息投递给所有客户端
+    DIRECT = "BUS_DIRECT"              # 负载消息投递给指定用户 {"to", "target"（持有该连接的成员，可选）}
+    SEND_FILE = "BUS_SEND_FILE"        # 发送服务器上的文件 {"path", "file_info", "to"（可选）}
+
+
+# 总线上的负载消息使用二进制 FILE_DATA 帧，不压缩（本机通信，压缩只会增加CPU开销），
+# 数据块不拆分（由接收进程按各自客户端的特性拆分）
+BUS_FEATURES = frozenset({Feature.BINARY_FILE_DATA, Feature.ADAPTIVE_CHUNKS})
+
+
+def format_address(address) -> str:
+    """
+    把客户端地址格式化为总线上使用的字符串
+    
+    Args:
+        address: (主机, 端口) 元组
+        
+    Returns:
+        "主机:端口"
+    """
+    return f"{address[0]}:{address[1]}"
+
+
+class PresenceTable:
+    """
+    其他进程上的在线用户
+    
+    按成员（工作进程）保存 {连接地址: 用户名}，以连接地址为键，
+    重复的加入或离开通知不会造成计数错误；成员断开时整体移除。
+    另按用户名索引所在成员，定向投递时不必遍历所有用户。
+    """
+    
+    def __init__(self):
+        """初始化空表"""
+        self.members = {}  # {成员: {地址: 用户名}}
+        self.owners = {}   # {用户名: [(成员, 地址)]}，按加入顺序
+        self.lock = threading.Lock()
+    
+    def join(self, member: str, address: str, username: str):
+        """
+        登记一个用户
+        
+        Args:
+            member: 用户所在的成员
+            address: 连接地址
+            username: 用户名
+        """
+        with self.lock:
+            users = self.members.setdefault(member, {})
+            if address in users:
+                return
+            users[address] = username
+            self.owners.setdefault(username, []).append((member, address))
+    
+    def leave(self, member: str, address: str):
+        """
+        移除一个用户（不存在时忽略）
+        
+        Args:
+            member: 用户所在的成员
+            address: 连接地址
+        """
+        with self.lock:
+            self._remove(member, address)
+    
+    def replace(self, member: str, users: dict):
+        """
+        用成员的完整在线用户列表替换原有记录
+        
+        Args:
+            member: 成员
+            users: {地址: 用户名}
+        """
+        with self.lock:
+            for address in list(self.members.get(member, {})):
+                self._remove(member, address)
+            for address, username in users.items():
+                self.members.setdefault(member, {})[address] = username
+                self.owners.setdefault(username, []).append((member, address))
+    
+    def drop(self, member: str):
+        """
+        移除成员的所有用户
+        
+        Args:
+            member: 成员
+        """
+        self.replace(member, {})
+        with self.lock:
+            self.members.pop(member, None)
+    
+    def _remove(self, member: str, address: str):
+        """移除一个用户（调用方持有锁）"""
+        username = self.members.get(member, {}).pop(address, None)
+        if username is None:
+            return
+        owners = self.owners[username]
+        owners.remove((member, address))
+        if not owners:
+            del self.owners[username]
+    
+    def locate(self, username: str):
+        """
+        查找用户所在的成员
+        
+        Args:
+            username: 用户名
+            
+        Returns:
+            最早登记的同名用户所在的成员，不在线返回None
+        """
+        owner = self.find(username)
+        return owner[0] if owner else None
+    
+    def find(self, username: str):
+        """
+        查找用户所在的成员和连接地址
+        
+        Args:
+            username: 用户名
+            
+        Returns:
+            最早登记的同名用户的 (成员, 地址)，不在线返回None
+        """
+        with self.lock:
+            owners = self.owners.get(username)
+            return owners[0] if owners else None
+    
+    def entries(self) -> list:
+        """
+        获取所有用户
+        
+        Returns:
+            (成员, 地址, 用户名) 列表
+        """
+        with self.lock:
+            return [(member, address, username)
+                    for member, users in self.members.items()
+                    for address, username in users.items()]
+    
+    def usernames(self) -> list:
+        """获取所有用户名"""
+        with self.lock:
+            return [username for users in self.members.values() for username in users.values()]
+    
+    def __len__(self) -> int:
+        """用户数"""
+        with self.lock:
+            return sum(len(users) for users in self.members.values())
+
+
+class BusLink:
+    """
+    消息总线上的一条连接
+    
+    每条总线消息是一个JSON信封（类型为 BusKind，metadata 携带路由信息），
+    metadata["payload"] 为真时紧跟一条完整的聊天消息帧（FILE_DATA 为二进制帧）。
+    信封和负载作为一个整体放入出站队列，不会与其他消息交错；总线消息不丢弃，队列已满时等待。
+    """
+    
+    MAX_MESSAGES = 4096
+    
+    def __init__(self, sock):
+        """
+        初始化连接并启动写线程
+        
+        Args:
+            sock: 已连接的 Unix 套接字
+        """
+        self.sock = sock
+        self.reader = FrameReader.for_socket(sock)
+        self.outbox = OutboundQueue(sock, self.MAX_MESSAGES, SlowConsumerPolicy.BACKPRESSURE)
+        self.outbox.start()
+    
+    @staticmethod
+    def encode(kind: str, metadata=None, message=None) -> list:
+        """
+        编码一条总线消息
+        
+        Args:
+            kind: BusKind
+            metadata: 路由信息
+            message: 负载（PreparedMessage），没有负载为None
+            
+        Returns:
+            帧列表，可直接放入多个连接的出站队列
+        """
+        metadata = dict(metadata or {})
+        if message is not None:
+            metadata["payload"] = True
+        frames = [SocketUtils.encode_message(kind, "", metadata)]
+        if message is not None:
+            frames.append(message.frame(BUS_FEATURES))
+        return frames
+    
+    def send(self, kind: str, metadata=None, message=None):
+        """
+        发送一条总线消息
+        
+        Args:
+            kind: BusKind
+            metadata: 路由信息
+            message: 负载（PreparedMessage）
+            
+        Raises:
+            ConnectionError: 连接已关闭
+        """
+        self.send_frames(self.encode(kind, metadata, message))
+    
+    def send_frames(self, frames: list):
+        """
+        发送已编码的总线消息
+        
+        Args:
+            frames: encode() 返回的帧列表
+            
+        Raises:
+            ConnectionError: 连接已关闭
+        """
+        self.outbox.put_sequence(frames)
+    
+    def receive(self):
+        """
+        接收一条总线消息
+        
+        Returns:
+            (信封字典, 负载 PreparedMessage 或 None)，连接断开返回None
+        """
+        envelope = self.reader.read_message()
+        if not envelope:
+            return None
+        
+        message = None
+        if envelope.get("metadata", {}).get("payload"):
+            payload = self.reader.read_message()
+            if not payload:
+                return None
+            data = payload.get("data", "")
+            if isinstance(data, (memoryview, bytearray)):
+                # 二进制帧的数据只在下一次读取前有效
+                data = bytes(data)
+            message = PreparedMessage(payload.get("type"), data, payload.get("metadata"))
+        return envelope, message
+    
+    def close(self):
+        """关闭连接"""
+        self.outbox.close()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RemoteTarget:
+    """
+    其他工作进程或节点上的投递目标：指定用户，或该节点上的所有客户端（username 为None）
+    
+    find_user_socket 和 get_client_snapshot 返回它代替本地套接字，
+    对应的客户端信息中的 outbox 把帧加上总线消息信封后放入总线或节点连接的出站队列，
+    因此私信、定向上传、广播和服务器发送文件的代码无需区分本地和远程目标。
+    """
+    
+    __slots__ = ("node", "username")
+    
+    def __init__(self, node: str, username: str = None):
+        """
+        初始化投递目标
+        
+        Args:
+            node: 工作进程编号或节点名称
+            username: 用户名，None 表示该节点上的所有客户端
+        """
+        self.node = node
+        self.username = username
+    
+    def __eq__(self, other):
+        return (isinstance(other, RemoteTarget)
+                and self.node == other.node and self.username == other.username)
+    
+    def __hash__(self):
+        return hash((self.node, self.username))
+
+
+class RemoteOutbox:
+    """
+    发往其他工作进程或节点的出站队列
+    
+    信封与消息帧拼接为一项放入总线或节点连接的出站队列，两者不会被其他消息隔开；
+    总线消息不丢弃，队列已满时等待。
+    """
+    
+    def __init__(self, link: BusLink, kind: str, metadata=None):
+        """
+        初始化出站队列
+        
+        Args:
+            link: 消息总线或节点连接
+            kind: BusKind.BROADCAST 或 BusKind.DIRECT
+            metadata: 信封的路由信息
+        """
+        self.link = link
+        self.envelope = SocketUtils.encode_message(kind, "", dict(metadata or {}, payload=True))
+    
+    def offer(self, frame: tuple) -> bool:
+        """尝试放入一帧，不等待"""
+        return self.link.outbox.offer(self.envelope + tuple(frame))
+    
+    def put(self, frame: tuple, wait: bool = False) -> bool:
+        """
+        放入一帧，队列已满时等待
+        
+        Raises:
+            ConnectionError: 总线或节点连接已断开
+        """
+        return self.link.outbox.put(self.envelope + tuple(frame), wait=True)
+    
+    def close(self):
+        """连接由服务器管理，不随单个目标关闭"""
+
+
+class MessageBus:
+    """
+    启动器进程中的消息总线
+    
+    工作进程通过 Unix 套接字连接总线，总线把每条消息转发给其他所有工作进程，
+    并根据途经的加入、离开消息维护全局在线用户表，供启动器的管理命令使用。
+    """
+    
+    def __init__(self, path: str):
+        """
+        创建总线并开始监听（在创建工作进程之前调用，工作进程启动后即可连接）
+        
+        Args:
+            path: Unix 套接字路径
+        """
+        self.path = path
+        self.links = {}  # {成员: BusLink}
+        self.lock = threading.Lock()
+        self.presence = PresenceTable()
+        self.closed = False
+        
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(128)
+    
+    def start(self):
+        """启动接受连接的线程"""
+        accept_thread = threading.Thread(target=self.accept_members)
+        accept_thread.daemon = True
+        accept_thread.start()
+    
+    def accept_members(self):
+        """接受工作进程的连接"""
+        while True:
+            try:
+                member_socket, _ = self.socket.accept()
+            except OSError:
+                return
+            
+            member_thread = threading.Thread(target=self.handle_member, args=(member_socket,))
+            member_thread.daemon = True
+            member_thread.start()
+    
+    def handle_member(self, member_socket):
+        """
+        处理一个工作进程的总线连接
+        
+        Args:
+            member_socket: 工作进程的 Unix 套接字
+        """
+        link = BusLink(member_socket)
+        received = link.receive()
+        if not received or received[0].get("type") != BusKind.HELLO:
+            link.close()
+            return
+        
+        member = str(received[0].get("metadata", {}).get("member"))
+        with self.lock:
+            self.links[member] = link
+        
+        try:
+            while True:
+                received = link.receive()
+                if not received:
+                    break
+                self.route(member, *received)
+        except Exception as e:
+            print(f"处理工作进程 {member} 的总线消息时发生错误: {e}")
+        finally:
+            with self.lock:
+                if self.links.get(member) is link:
+                    del self.links[member]
+            link.close()
+            if self.closed:
+                return
+            
+            # 该进程上的用户全部离线
+            self.presence.drop(member)
+            self.publish(BusKind.SYNC, {"member": member, "users": {}})
+            print(f"⚠️ 工作进程 {member} 已断开消息总线")
+    
+    def route(self, member: str, envelope: dict, message):
+        """
+        记录在线用户变化并把消息转发给其他工作进程
+        
+        Args:
+            member: 发送消息的成员
+            envelope: 信封字典
+            message: 负载（PreparedMessage 或 None）
+        """
+        kind = envelope.get("type")
+        metadata = dict(envelope.get("metadata", {}), member=member)
+        
+        if kind == BusKind.JOIN:
+            self.presence.join(member, metadata["address"], metadata["username"])
+        elif kind == BusKind.LEAVE:
+            self.presence.leave(member, metadata["address"])
+        elif kind == BusKind.SYNC:
+            self.presence.replace(member, metadata.get("users", {}))
+        
+        # 发给某个用户的消息只转发给持有该连接的成员
+        target = metadata.get("target") if kind == BusKind.DIRECT else None
+        self.publish(kind, metadata, message, exclude=member, member=target)
+    
+    def publish(self, kind: str, metadata=None, message=None, exclude=None, member=None):
+        """
+        向工作进程发送总线消息（消息只编码一次）
+        
+        Args:
+            kind: BusKind
+            metadata: 路由信息
+            message: 负载（PreparedMessage）
+            exclude: 不发送给该成员
+            member: 只发送给该成员
+            
+        Returns:
+            发送到的成员数
+        """
+        frames = BusLink.encode(kind, metadata, message)
+        with self.lock:
+            links = list(self.links.items())
+        
+        sent = 0
+        for name, link in links:
+            if name == exclude or (member is not None and name != member):
+                continue
+            try:
+                link.send_frames(frames)
+                sent += 1
+            except ConnectionError as e:
+                print(f"向工作进程 {name} 发送总线消息失败: {e}")
+        return sent
+    
+    def close(self):
+        """关闭总线和所有连接"""
+        self.closed = True
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        with self.lock:
+            links = list(self.links.values())
+            self.links.clear()
+        for link in links:
+            link.close()
+
+
+class ShardServer(ChatServer):
+    """
+    集群中的一个工作进程
+    
+    与其他工作进程通过 SO_REUSEPORT 共享监听端口，每个进程只管理自己接受的连接；
+    广播在本进程投递后经消息总线发给其他进程，由它们投递给各自的客户端。
+    管理命令在启动器的控制台输入。
+    """
+    
+    def __init__(self, member, bus_path, host='localhost', port=8888, **kwargs):
+        """
+        初始化工作进程的服务器
+        
+        Args:
+            member: 进程编号
+            bus_path: 消息总线的 Unix 套接字路径
+            host: 服务器主机地址
+            port: 服务器端口
+            **kwargs: 传给 ChatServer 的其他参数
+        """
+        # 每个进程写自己的聊天记录日志（记录本进程客户端的事件）
+        kwargs.setdefault("chat_log_dir", os.path.join(os.path.dirname(__file__), 'files', 'chat_log', f"shard{member}"))
+        super().__init__(host, port, **kwargs)
+        self.member = str(member)
+        self.bus_path = bus_path
+        self.bus = None
+        self.presence = PresenceTable()
+        
+        # 所有工作进程绑定同一端口，由内核分配新连接
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    
+    def start(self):
+        """连接消息总线后启动服务器"""
+        try:
+            self.connect_bus()
+        except OSError as e:
+            print(f"工作进程 {self.member} 连接消息总线失败: {e}")
+            return
+        super().start()
+    
+    def stop(self):
+        """停止服务器并断开消息总线"""
+        super().stop()
+        if self.bus:
+            self.bus.close()
+    
+    def print_commands(self):
+        """管理命令由启动器处理"""
+        print(f"工作进程 {self.member} 已就绪，管理命令请在启动器控制台输入")
+    
+    def connect_bus(self):
+        """连接消息总线，请求其他进程的在线用户"""
+        bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bus_socket.connect(self.bus_path)
+        self.bus = BusLink(bus_socket)
+        self.bus.send(BusKind.HELLO, {"member": self.member})
+        self.bus.send(BusKind.SYNC_REQUEST)
+        
+        bus_thread = threading.Thread(target=self.handle_bus)
+        bus_thread.daemon = True
+        bus_thread.start()
+    
+    def handle_bus(self):
+        """总线线程：处理其他进程和启动器发来的消息"""
+        while True:
+            received = self.bus.receive()
+            if not received:
+                break
+            try:
+                self.process_bus_message(*received)
+            except Exception as e:
+                print(f"处理总线消息时发生错误: {e}")
+        
+        if self.running:
+            print(f"工作进程 {self.member} 与消息总线的连接已断开")
+            self.stop()
+    
+    def process_bus_message(self, envelope, message):
+        """
+        处理一条总线消息
+        
+        Args:
+            envelope: 信封字典
+            message: 负载（PreparedMessage 或 None）
+        """
+        kind = envelope.get("type")
+        metadata = envelope.get("metadata", {})
+        member = str(metadata.get("member"))
+        
+        if kind == BusKind.BROADCAST:
+            # 只投递给本进程的客户端，不再发回总线
+            super().broadcast_prepared(message)
+        
+        elif kind == BusKind.DIRECT:
+            # 只查找本进程的连接，不再转发给其他进程
+            user_socket = self.registry.find(metadata.get("to"))
+            client_info = self.clients.get(user_socket) if user_socket else None
+            if client_info:
+                self._send(user_socket, client_info, message)
+        
+        elif kind == BusKind.SEND_FILE:
+            if metadata.get("to"):
+                user_socket = self.registry.find(metadata["to"])
+                client_info = self.clients.get(user_socket) if user_socket else None
+                targets = [(user_socket, client_info)] if client_info else []
+            else:
+                targets = self.get_client_snapshot()
+            if targets:
+                file_thread = threading.Thread(
+                    target=self.send_stored_file,
+                    args=(metadata["path"], metadata["file_info"], targets)
+                )
+                file_thread.daemon = True
+                file_thread.start()
+        
+        elif kind == BusKind.JOIN:
+            self.presence.join(member, metadata["address"], metadata["username"])
+        
+        elif kind == BusKind.LEAVE:
+            self.presence.leave(member, metadata["address"])
+        
+        elif kind == BusKind.SYNC:
+            self.presence.replace(member, metadata.get("users", {}))
+        
+        elif kind == BusKind.SYNC_REQUEST:
+            self.publish_presence()
+    
+    def publish(self, kind, metadata=None, message=None):
+        """
+        向消息总线发送消息
+        
+        Args:
+            kind: BusKind
+            metadata: 路由信息
+            message: 负载（PreparedMessage）
+        """
+        if not self.bus:
+            return
+        try:
+            self.bus.send(kind, metadata, message)
+        except ConnectionError as e:
+            print(f"发送总线消息失败: {e}")
+    
+    def publish_presence(self):
+        """向其他进程发送本进程的全部在线用户"""
+        users = {format_address(client_info["address"]): client_info["username"]
+                 for _, client_info in self.registry.snapshot()}
+        self.publish(BusKind.SYNC, {"users": users})
+    
+    def register_client(self, client_socket, address, message):
+        """加入聊天室后通知其他进程"""
+        username = super().register_client(client_socket, address, message)
+        if username:
+            self.publish(BusKind.JOIN, {"address": format_address(address), "username": username})
+        return username
+    
+    def disconnect_client(self, client_socket, username):
+        """断开连接后通知其他进程（重复的离开通知会被忽略；其他进程上的用户由其所在进程管理）"""
+        if isinstance(client_socket, RemoteTarget):
+            return
+        client_info = self.clients.get(client_socket)
+        super().disconnect_client(client_socket, username)
+        if client_info:
+            self.publish(BusKind.LEAVE, {"address": format_address(client_info["address"])})
+    
+    def broadcast_prepared(self, message, exclude_socket=None, wait=False):
+        """投递给本进程的客户端，再经总线发给其他进程"""
+        super().broadcast_prepared(message, exclude_socket, wait)
+        self.publish(BusKind.BROADCAST, message=message)
+    
+    def relay_stored_file(self, sender_socket, file_path, file_info, targets=None):
+        """广播的文件由各进程从共享的存储目录读取后发送给自己的客户端"""
+        if targets is None:
+            self.publish(BusKind.SEND_FILE, {"path": file_path, "file_info": file_info})
+        super().relay_stored_file(sender_socket, file_path, file_info, targets)
+    
+    def find_user_socket(self, username):
+        """
+        根据用户名查找连接，本进程没有时查询其他进程的在线用户表
+        
+        Returns:
+            本地套接字、其他进程上用户的 RemoteTarget，不在线返回None
+        """
+        user_socket = super().find_user_socket(username)
+        if user_socket is not None:
+            return user_socket
+        
+        member = self.presence.locate(username)
+        if member is None:
+            return None
+        return RemoteTarget(member, username)
+    
+    def get_client_info(self, client_socket):
+        """获取客户端信息，其他进程上用户的出站队列经消息总线发给其所在进程"""
+        if not isinstance(client_socket, RemoteTarget):
+            return super().get_client_info(client_socket)
+        
+        owner = self.presence.find(client_socket.username)
+        if self.bus is None or owner is None:
+            return None
+        
+        host, _, port = owner[1].rpartition(':')
+        return {
+            "username": client_socket.username,
+            "address": (host, int(port)),
+            "features": BUS_FEATURES,
+            "outbox": RemoteOutbox(self.bus, BusKind.DIRECT, {"to": client_socket.username,
+                                                              "target": client_socket.node}),
+            "node": client_socket.node
+        }
+    
+    def get_online_users(self):
+        """获取所有进程的在线用户列表"""
+        return super().get_online_users() + self.presence.usernames()
+    
+    def online_count(self):
+        """获取所有进程的在线用户数"""
+        return super().online_count() + len(self.presence)
+
+
+def run_shard(member, bus_path, host, port, slow_consumer_policy, relay_mode):
+    """
+    工作进程入口
+    
+    Args:
+        member: 进程编号
+        bus_path: 消息总线的 Unix 套接字路径
+        host: 服务器主机地址
+        port: 服务器端口
+        slow_consumer_policy: 慢客户端策略
+        relay_mode: 文件转发模式
+    """
+    server = ShardServer(member, bus_path, host, port,
+                         slow_consumer_policy=slow_consumer_policy, relay_mode=relay_mode)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+class ClusterLauncher:
+    """
+    集群启动器
+    
+    创建消息总线和工作进程，并提供管理控制台：
+    /list 显示所有进程的在线用户，/msg 和 /send 经总线发给持有目标连接的进程。
+    """
+    
+    def __init__(self, host='localhost', port=8888, workers=None,
+                 slow_consumer_policy=SlowConsumerPolicy.BACKPRESSURE, relay_mode=RelayMode.STORE):
+        """
+        初始化启动器
+        
+        Args:
+            host: 服务器主机地址
+            port: 服务器端口
+            workers: 工作进程数，默认为CPU核数
+            slow_consumer_policy: 慢客户端策略
+            relay_mode: 文件转发模式
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.slow_consumer_policy = slow_consumer_policy
+        self.relay_mode = relay_mode
+        
+        self.bus_dir = None
+        self.bus = None
+        self.processes = []
+        self.running = False
+    
+    def start(self):
+        """创建消息总线和工作进程，然后处理控制台命令"""
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+            print("当前平台不支持 SO_REUSEPORT 或 Unix 套接字，请使用 server.py")
+            return
+        
+        try:
+            self.bus_dir = tempfile.mkdtemp(prefix='chat_bus_')
+            self.bus = MessageBus(os.path.join(self.bus_dir, 'bus.sock'))
+            
+            # spawn 方式创建的进程不继承启动器的线程和套接字
+            context = multiprocessing.get_context('spawn')
+            for index in range(self.workers):
+                process = context.Process(
+                    target=run_shard,
+                    args=(str(index + 1), self.bus.path, self.host, self.port,
+                          self.slow_consumer_policy, self.relay_mode)
+                )
+                process.daemon = True
+                process.start()
+                self.processes.append(process)
+            
+            self.bus.start()
+            self.running = True
+            
+            print(f"聊天服务器集群已启动，{self.workers} 个工作进程共同监听 {self.host}:{self.port}")
+            self.print_commands()
+            print("按 Ctrl+C 停止服务器\n")
+            
+            self.handle_console()
+        
+        except Exception as e:
+            print(f"启动集群失败: {e}")
+        finally:
+            self.stop()
+    
+    def stop(self):
+        """停止所有工作进程并关闭消息总线"""
+        if not self.running and not self.processes:
+            return
+        self.running = False
+        
+        # 关闭总线后工作进程自行停止，超时仍未退出的进程强制结束
+        if self.bus:
+            self.bus.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        
+        if self.bus_dir:
+            shutil.rmtree(self.bus_dir, ignore_errors=True)
+        
+        print("服务器集群已关闭")
+    
+    def print_commands(self):
+        """显示管理命令"""
+        print("\n集群管理命令:")
+        print("  /msg <消息内容> - 向所有客户端广播消息")
+        print("  /msg @用户名 <消息内容> - 向指定用户发送私信")
+        print("  /send <文件路径> - 向所有客户端广播文件")
+        print("  /send @用户名 <文件路径> - 向指定用户发送文件")
+        print("  /list - 显示所有进程的在线用户")
+        print("  /help - 显示帮助信息")
+        print("  /quit - 关闭服务器集群")
+    
+    def handle_console(self):
+        """处理管理员输入，标准输入关闭后等待工作进程退出"""
+        while self.running:
+            try:
+                command = input().strip()
+            except EOFError:
+                # 在后台运行时没有控制台，一直运行到工作进程退出
+                for process in self.processes:
+                    process.join()
+                return
+            if command:
+                self.process_command(command)
+    
+    def process_command(self, command):
+        """
+        处理管理命令
+        
+        Args:
+            command: 输入的命令
+        """
+        try:
+            if command.lower() == '/quit':
+                print("正在关闭服务器集群...")
+                self.running = False
+            
+            elif command.lower() == '/help':
+                self.print_commands()
+                print()
+            
+            elif command.lower() == '/list':
+                self.show_online_users()
+            
+            elif command.lower().startswith('/msg '):
+                message = command[5:].strip()
+                if message.startswith('@'):
+                    parts = message.split(' ', 1)
+                    if len(parts) < 2:
+                        print("私信格式: /msg @用户名 消息内容")
+                        return
+                    target_user = parts[0][1:]
+                    server_msg = format_message("服务器", f"[私信] {parts[1]}")
+                    if self.send_to_user(BusKind.DIRECT, target_user, {},
+                                         PreparedMessage(MessageType.TEXT, server_msg)):
+                        print(f"✅ 已向用户 '{target_user}' 发送私信: {parts[1]}")
+                elif message:
+                    server_msg = format_message("服务器", message)
+                    print(server_msg)
+                    self.bus.publish(BusKind.BROADCAST, message=PreparedMessage(MessageType.TEXT, server_msg))
+                else:
+                    print("请输入要发送的消息内容")
+            
+            elif command.lower().startswith('/send '):
+                params = command[6:].strip()
+                target_user = None
+                if params.startswith('@'):
+                    parts = params.split(' ', 1)
+                    if len(parts) < 2:
+                        print("定向发送格式: /send @用户名 文件路径")
+                        return
+                    target_user, params = parts[0][1:], parts[1].strip()
+                self.send_file(params.strip('"\''), target_user)
+            
+            elif command.startswith('/'):
+                print(f"集群模式不支持命令: {command}，输入 /help 查看可用命令")
+        
+        except Exception as e:
+            print(f"处理服务器命令时发生错误: {e}")
+    
+    def send_to_user(self, kind, username, metadata, message=None):
+        """
+        把总线消息发给持有指定用户连接的工作进程
+        
+        Args:
+            kind: BusKind
+            username: 目标用户名
+            metadata: 路由信息（会加上 to）
+            message: 负载（PreparedMessage）
+            
+        Returns:
+            是否已发送
+        """
+        member = self.bus.presence.locate(username)
+        if member is None:
+            print(f"❌ 用户 '{username}' 不在线或不存在")
+            return False
+        return self.bus.publish(kind, dict(metadata, to=username), message, member=member) > 0
+    
+    def send_file(self, file_path, username=None):
+        """
+        发送服务器上的文件（各工作进程从磁盘读取后发给自己的客户端）
+        
+        Args:
+            file_path: 文件路径
+            username: 目标用户名，None 表示所有客户端
+        """
+        if not os.path.isfile(file_path):
+            print(f"❌ 文件不存在或不是文件: {file_path}")
+            return
+        
+        metadata = {
+            "path": os.path.abspath(file_path),
+            "file_info": {
+                "filename": os.path.basename(file_path),
+                "size": os.path.getsize(file_path),
+                "sender": "服务器"
+            }
+        }
+        if username is None:
+            count = self.bus.publish(BusKind.SEND_FILE, metadata)
+            print(f"📤 已通知 {count} 个工作进程发送文件: {metadata['file_info']['filename']}")
+        elif self.send_to_user(BusKind.SEND_FILE, username, metadata):
+            print(f"📤 已通知用户 '{username}' 所在的工作进程发送文件: {metadata['file_info']['filename']}")
+    
+    def show_online_users(self):
+        """显示所有进程的在线用户"""
+        entries = sorted(self.bus.presence.entries())
+        print(f"\n📋 在线用户列表 ({len(entries)}):")
+        if entries:
+            for i, (member, address, username) in enumerate(entries, 1):
+                print(f"  {i}. {username} ({address}) [进程 {member}]")
+        else:
+            print("  暂无在线用户")
+        print()
+
+
+def main():
+    """主函数"""
+    host = 'localhost'
+    port = 8888
+    
+    # 处理命令行参数
+    if len(sys.argv) >= 2:
+        try:
+            port = int(sys.argv[1])
+        except ValueError:
+            print("端口号必须是数字")
+            return
+    
+    if len(sys.argv) >= 3:
+        host = sys.argv[2]
+    
+    policy = SlowConsumerPolicy.BACKPRESSURE
+    if len(sys.argv) >= 4:
+        policy = sys.argv[3]
+        if policy not in SlowConsumerPolicy.ALL:
+            print(f"慢客户端策略必须是: {', '.join(SlowConsumerPolicy.ALL)}")
+            return
+    
+    relay_mode = RelayMode.STORE
+    if len(sys.argv) >= 5:
+        relay_mode = sys.argv[4]
+        if relay_mode not in RelayMode.ALL:
+            print(f"文件转发模式必须是: {', '.join(RelayMode.ALL)}")
+            return
+    
+    workers = None
+    if len(sys.argv) >= 6:
+        try:
+            workers = int(sys.argv[5])
+        except ValueError:
+            print("工作进程数必须是数字")
+            return
+    
+    launcher = ClusterLauncher(host, port, workers, slow_consumer_policy=policy, relay_mode=relay_mode)
+    
+    try:
+        launcher.start()
+    except KeyboardInterrupt:
+        print("\n正在关闭服务器集群...")
+        launcher.stop()
+
+
+if __name__ == "__main__":
+    main()
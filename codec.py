@@ -0,0 +1,306 @@
+"""
+消息编解码器
+消息信封 {"type", "data", "metadata"} 的序列化方式：JSON，或紧凑的二进制编码。
+客户端在 USER_JOIN 中声明 compact_codec 特性，双方都支持时该连接上的消息使用紧凑编码
+"""
+
+import json
+import struct
+from typing import Any
+
+# 紧凑编码的标签字节（见 CompactCodec）
+TAG_NONE = 0xC0
+TAG_FALSE = 0xC1
+TAG_TRUE = 0xC2
+TAG_INT = 0xC3
+TAG_FLOAT = 0xC4
+TAG_STR = 0xC5
+TAG_BYTES = 0xC6
+TAG_LIST = 0xC7
+TAG_MAP = 0xC8
+
+
+class JsonCodec:
+    """JSON 编解码器（原有协议，C++版本使用）"""
+    
+    name = "json"
+    
+    def encode(self, value: Any) -> bytes:
+        """
+        编码为UTF-8 JSON
+        
+        Args:
+            value: 可JSON序列化的值
+            
+        Returns:
+            编码后的字节串
+        """
+        return json.dumps(value, ensure_ascii=False).encode('utf-8')
+    
+    def decode(self, data) -> Any:
+        """
+        解码UTF-8 JSON（str() 直接从缓冲区解码，不复制出中间的 bytes）
+        
+        Args:
+            data: bytes 或 memoryview
+            
+        Returns:
+            解码后的值
+            
+        Raises:
+            ValueError: 不是有效的JSON
+        """
+        return json.loads(str(data, 'utf-8'))
+
+
+class CompactCodec:
+    """
+    紧凑的二进制编解码器（与 msgpack / CBOR 类似，纯 Python 实现）
+    
+    每个值以一个标签字节开始:
+        0x00-0x7F   0 到 127 的整数（标签本身就是值）
+        0x80-0xBF   常用字符串表 COMMON_STRINGS 中的第 n 项（消息字段名、元数据键名、消息类型名）
+        0xC0        None
+        0xC1 / 0xC2 False / True
+        0xC3        其他整数（zigzag 变长整数）
+        0xC4        浮点数（8字节大端）
+        0xC5        字符串（变长整数长度 + UTF-8）
+        0xC6        字节串（变长整数长度 + 原始字节），FILE_DATA 不必十六进制编码
+        0xC7        列表（变长整数元素数 + 各元素）
+        0xC8        字典（变长整数项数 + 各键值）
+    常用字符串表只能在末尾追加，已有项的位置不能改变。
+    解码时字典的键必须是字符串，列表和字典最多嵌套 MAX_DEPTH 层。
+    """
+    
+    name = "compact"
+    
+    COMMON_STRINGS = (
+        "type", "data", "metadata",
+        "TEXT", "FILE", "FILE_REQUEST", "FILE_DATA", "FILE_COMPLETE", "FILE_RESUME",
+        "TRANSFER_TOKEN", "DATA_CONNECT", "USER_JOIN", "USER_LEAVE", "SEARCH", "ERROR",
+        "bytes_sent", "total_size", "chunk_index", "crc32", "filename", "size", "sender",
+        "sha256", "to", "features", "offset", "have_blob", "token", "streams", "length",
+        "transfer_time", "chunk_count", "query", "results", "time", "user", "",
+        "FILE_ACK", "bytes_received", "ack",
+    )
+    
+    FLOAT_FIELD = struct.Struct('!d')
+    MAX_DEPTH = 32  # 解码时列表和字典的最大嵌套层数（消息信封只有两层）
+    
+    def __init__(self):
+        self.string_codes = {value: 0x80 + index for index, value in enumerate(self.COMMON_STRINGS)}
+    
+    def encode(self, value: Any) -> bytes:
+        """
+        编码一个值
+        
+        Args:
+            value: None、bool、int、float、str、bytes、列表/元组、键为字符串的字典
+            
+        Returns:
+            编码后的字节串
+            
+        Raises:
+            TypeError: 值的类型无法编码
+        """
+        out = bytearray()
+        self._encode(value, out)
+        return bytes(out)
+    
+    def _encode(self, value: Any, out: bytearray):
+        """把一个值追加编码到 out（按消息中出现的频率排列类型判断）"""
+        if type(value) is str:
+            code = self.string_codes.get(value)
+            if code is not None:
+                out.append(code)
+            else:
+                raw = value.encode('utf-8')
+                out.append(TAG_STR)
+                _write_varint(len(raw), out)
+                out += raw
+        elif type(value) is dict:
+            out.append(TAG_MAP)
+            _write_varint(len(value), out)
+            string_codes = self.string_codes
+            for key, item in value.items():
+                code = string_codes.get(key)
+                if code is not None:
+                    out.append(code)
+                else:
+                    self._encode(str(key), out)
+                if type(item) is int and 0 <= item < 0x80:
+                    out.append(item)
+                else:
+                    self._encode(item, out)
+        elif value is None:
+            out.append(TAG_NONE)
+        elif value is True:
+            out.append(TAG_TRUE)
+        elif value is False:
+            out.append(TAG_FALSE)
+        elif isinstance(value, int):
+            if 0 <= value < 0x80:
+                out.append(value)
+            else:
+                out.append(TAG_INT)
+                _write_varint(value * 2 if value >= 0 else -value * 2 - 1, out)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            out.append(TAG_BYTES)
+            _write_varint(len(value), out)
+            out += value
+        elif isinstance(value, float):
+            out.append(TAG_FLOAT)
+            out += self.FLOAT_FIELD.pack(value)
+        elif isinstance(value, (list, tuple)):
+            out.append(TAG_LIST)
+            _write_varint(len(value), out)
+            for item in value:
+                self._encode(item, out)
+        elif isinstance(value, str):
+            self._encode(str(value), out)
+        elif isinstance(value, dict):
+            self._encode(dict(value), out)
+        else:
+            raise TypeError(f"无法编码的类型: {type(value).__name__}")
+    
+    def decode(self, data) -> Any:
+        """
+        解码一个值
+        
+        Args:
+            data: bytes 或 memoryview
+            
+        Returns:
+            解码后的值（字节串解码为 bytes）
+            
+        Raises:
+            ValueError: 数据不完整或格式错误
+        """
+        data = bytes(data)
+        try:
+            value, position = self._decode(data, 0)
+        except (IndexError, UnicodeDecodeError, struct.error, TypeError, RecursionError) as e:
+            raise ValueError(f"无效的紧凑编码消息: {e}")
+        if position != len(data):
+            raise ValueError("紧凑编码消息末尾有多余的数据")
+        return value
+    
+    def _decode(self, data: bytes, position: int, depth: int = 0):
+        """
+        从 position 处解码一个值
+        
+        字典中常见的键（常用字符串）、小整数值和短字符串值直接在循环中解码，不递归调用。
+        
+        Args:
+            data: 消息字节串
+            position: 值的起始位置
+            depth: 当前值所在的嵌套层数
+            
+        Returns:
+            (值, 下一个值的位置)
+            
+        Raises:
+            ValueError: 未知的标签、字典的键不是字符串或嵌套过深
+        """
+        tag = data[position]
+        position += 1
+        if tag < 0x80:
+            return tag, position
+        if tag < 0xC0:
+            return self.COMMON_STRINGS[tag - 0x80], position
+        
+        if tag == TAG_MAP:
+            if depth >= self.MAX_DEPTH:
+                raise ValueError("紧凑编码消息嵌套过深")
+            count = data[position]
+            position += 1
+            if count >= 0x80:
+                count, position = _read_varint(data, position - 1)
+            strings = self.COMMON_STRINGS
+            value = {}
+            for _ in range(count):
+                tag = data[position]
+                if 0x80 <= tag < 0xC0:
+                    key = strings[tag - 0x80]
+                    position += 1
+                else:
+                    key, position = self._decode(data, position, depth + 1)
+                    if type(key) is not str:
+                        raise ValueError(f"字典的键不是字符串: {type(key).__name__}")
+                tag = data[position]
+                if tag < 0x80:
+                    value[key] = tag
+                    position += 1
+                elif tag < 0xC0:
+                    value[key] = strings[tag - 0x80]
+                    position += 1
+                elif tag == TAG_STR and data[position + 1] < 0x80:
+                    end = position + 2 + data[position + 1]
+                    if end > len(data):
+                        raise IndexError("数据不完整")
+                    value[key] = data[position + 2:end].decode('utf-8')
+                    position = end
+                else:
+                    value[key], position = self._decode(data, position, depth + 1)
+            return value, position
+        if tag == TAG_STR or tag == TAG_BYTES:
+            size = data[position]
+            position += 1
+            if size >= 0x80:
+                size, position = _read_varint(data, position - 1)
+            end = position + size
+            if end > len(data):
+                raise IndexError("数据不完整")
+            if tag == TAG_STR:
+                return data[position:end].decode('utf-8'), end
+            return data[position:end], end
+        if tag == TAG_INT:
+            zigzag, position = _read_varint(data, position)
+            return (zigzag >> 1) if not zigzag & 1 else -((zigzag + 1) >> 1), position
+        if tag == TAG_NONE:
+            return None, position
+        if tag == TAG_TRUE:
+            return True, position
+        if tag == TAG_FALSE:
+            return False, position
+        if tag == TAG_FLOAT:
+            return self.FLOAT_FIELD.unpack_from(data, position)[0], position + self.FLOAT_FIELD.size
+        if tag == TAG_LIST:
+            if depth >= self.MAX_DEPTH:
+                raise ValueError("紧凑编码消息嵌套过深")
+            count, position = _read_varint(data, position)
+            value = []
+            for _ in range(count):
+                item, position = self._decode(data, position, depth + 1)
+                value.append(item)
+            return value, position
+        raise ValueError(f"未知的标签: 0x{tag:02X}")
+
+
+def _write_varint(value: int, out: bytearray):
+    """追加一个非负的变长整数（每字节7位，最高位表示后面还有字节）"""
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, position: int):
+    """
+    读取一个变长整数
+    
+    Returns:
+        (值, 下一个值的位置)
+    """
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+JSON_CODEC = JsonCodec()
+COMPACT_CODEC = CompactCodec()
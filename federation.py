@@ -0,0 +1,484 @@
+"""
+聊天服务器联邦
+多个服务器节点（可在不同机器上，前面放TCP负载均衡）两两建立节点连接，
+复制在线用户表，把广播、私信和文件传输送到持有目标连接的节点；
+节点连接在握手时用共享密钥认证（环境变量 CHAT_FEDERATION_SECRET）
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+from utils import SlowConsumerPolicy, RelayMode
+from server import ChatServer
+from cluster import BusKind, BusLink, PresenceTable, RemoteTarget, RemoteOutbox, BUS_FEATURES, format_address
+
+
+class FederatedServer(ChatServer):
+    """
+    联邦中的一个服务器节点
+    
+    每个节点监听一个节点端口并连接配置的所有对等节点（全连接），两个节点之间只保留一条连接：
+    双方同时连接时保留名称较小的一方发起的连接。
+    节点连接使用与多进程集群相同的总线消息格式：
+    加入、离开和连接建立时的全量同步维护在线用户表；广播发给所有节点，
+    发给某个用户的消息和文件只发给该用户所在的节点。节点只转发自己客户端产生的消息，不会形成环路。
+    
+    握手: 双方交换 HELLO {"member", "nonce"}，随后发起方先发送 AUTH，接受方验证通过后才回复自己的 AUTH，
+    发起方再验证对方；任何一步失败都关闭连接，未通过认证的连接不会被登记，也不会处理其消息。
+    """
+    
+    RECONNECT_INTERVAL = 2  # 对等节点不可达时的重连间隔（秒）
+    HANDSHAKE_TIMEOUT = 10  # 握手的超时时间（秒）
+    
+    def __init__(self, host='localhost', port=8888, federation_port=9888, peers=(), node_name=None,
+                 secret=None, **kwargs):
+        """
+        初始化节点
+        
+        Args:
+            host: 服务器主机地址（节点端口也绑定该地址）
+            port: 客户端端口
+            federation_port: 节点端口
+            peers: 对等节点地址列表（"主机:节点端口"）
+            node_name: 节点名称，默认 "主机名:节点端口"
+            secret: 所有节点共用的密钥（字符串），用于认证节点连接
+            **kwargs: 传给 ChatServer 的其他参数
+        """
+        # 同一台机器上的多个节点各自写聊天记录日志（记录本节点客户端的事件）
+        kwargs.setdefault("chat_log_dir", os.path.join(os.path.dirname(__file__), 'files', 'chat_log', f"node{federation_port}"))
+        super().__init__(host, port, **kwargs)
+        self.federation_port = federation_port
+        self.peers = list(peers)
+        self.node_name = node_name or f"{socket.gethostname()}:{federation_port}"
+        self.secret = secret.encode('utf-8') if secret else None
+        
+        self.presence = PresenceTable()
+        self.links = {}           # {节点名称: BusLink}
+        self.peer_nodes = {}      # {对等节点地址: 节点名称}，已连接的地址不再重复连接
+        self.links_lock = threading.Lock()
+        self.node_targets = ()    # 广播时附加的 (RemoteTarget, 客户端信息)，节点连接变化时重建
+        
+        self.federation_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.federation_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    
+    def start(self):
+        """启动节点端口和对等节点连接，然后启动服务器"""
+        if not self.secret:
+            print("未设置节点密钥（环境变量 CHAT_FEDERATION_SECRET），节点端口不能无认证开放")
+            return
+        
+        try:
+            self.federation_socket.bind((self.host, self.federation_port))
+            self.federation_socket.listen(self.backlog)
+        except OSError as e:
+            print(f"节点端口 {self.federation_port} 监听失败: {e}")
+            return
+        
+        # ChatServer.start 设置 running 之前节点线程就要运行
+        self.running = True
+        
+        accept_thread = threading.Thread(target=self.accept_nodes)
+        accept_thread.daemon = True
+        accept_thread.start()
+        
+        for address in self.peers:
+            dial_thread = threading.Thread(target=self.dial_peer, args=(address,))
+            dial_thread.daemon = True
+            dial_thread.start()
+        
+        print(f"节点 '{self.node_name}' 监听节点端口 {self.host}:{self.federation_port}，"
+              f"对等节点: {', '.join(self.peers) or '无'}")
+        super().start()
+    
+    def stop(self):
+        """停止服务器并断开所有节点连接"""
+        super().stop()
+        try:
+            self.federation_socket.close()
+        except OSError:
+            pass
+        with self.links_lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+    
+    def accept_nodes(self):
+        """接受其他节点的连接"""
+        while self.running:
+            try:
+                node_socket, _ = self.federation_socket.accept()
+            except OSError:
+                return
+            
+            node_thread = threading.Thread(target=self.handle_node, args=(node_socket, False))
+            node_thread.daemon = True
+            node_thread.start()
+    
+    def dial_peer(self, address: str):
+        """
+        连接一个对等节点，断开后定期重连
+        
+        Args:
+            address: "主机:节点端口"
+        """
+        host, _, port = address.rpartition(':')
+        while self.running:
+            # 对方已经连接过来时不再重复连接
+            with self.links_lock:
+                connected = self.peer_nodes.get(address) in self.links
+            if not connected:
+                try:
+                    node_socket = socket.create_connection((host, int(port)), timeout=5)
+                    node_socket.settimeout(None)
+                    node = self.handle_node(node_socket, True)
+                    if node:
+                        with self.links_lock:
+                            self.peer_nodes[address] = node
+                except OSError:
+                    pass
+            time.sleep(self.RECONNECT_INTERVAL)
+    
+    def handle_node(self, node_socket, dialed: bool):
+        """
+        节点连接：握手后处理对方发来的消息，直到连接断开
+        
+        Args:
+            node_socket: 已连接的套接字
+            dialed: 是否由本节点发起
+            
+        Returns:
+            对方的节点名称，握手失败返回None
+        """
+        node_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        node_socket.settimeout(self.HANDSHAKE_TIMEOUT)
+        link = BusLink(node_socket)
+        node = self.handshake(link, dialed)
+        if node is None:
+            link.close()
+            return None
+        node_socket.settimeout(None)
+        
+        link.initiator = self.node_name if dialed else node
+        if node == self.node_name or not self.register_link(node, link):
+            link.close()
+            return node
+        
+        try:
+            # 对方通过全量同步得到本节点的在线用户
+            link.send(BusKind.SYNC, {"users": self.local_presence()})
+            while True:
+                received = link.receive()
+                if not received:
+                    break
+                try:
+                    self.process_node_message(node, *received)
+                except Exception as e:
+                    print(f"处理节点 '{node}' 的消息时发生错误: {e}")
+        except ConnectionError:
+            pass
+        finally:
+            self.unregister_link(node, link)
+        return node
+    
+    def handshake_mac(self, signer: str, signer_nonce: str, verifier_nonce: str) -> str:
+        """
+        计算握手认证码：HMAC-SHA256(密钥, 签名方名称、双方的随机数)
+        
+        认证码绑定签名方的名称和双方本次连接的随机数，不能在其他连接上重放，也不能冒充其他节点。
+        
+        Args:
+            signer: 出示认证码的节点名称
+            signer_nonce: 出示方在 HELLO 中发送的随机数
+            verifier_nonce: 验证方在 HELLO 中发送的随机数
+            
+        Returns:
+            十六进制认证码
+        """
+        message = f"{signer}\n{signer_nonce}\n{verifier_nonce}".encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+    
+    def handshake(self, link: BusLink, dialed: bool):
+        """
+        交换 HELLO 并相互认证
+        
+        Args:
+            link: 节点连接
+            dialed: 是否由本节点发起（发起方先出示认证码）
+            
+        Returns:
+            认证通过的对方节点名称，失败返回None
+        """
+        nonce = secrets.token_hex(16)
+        try:
+            link.send(BusKind.HELLO, {"member": self.node_name, "nonce": nonce})
+            received = link.receive()
+            if not received or received[0].get("type") != BusKind.HELLO:
+                return None
+            metadata = received[0].get("metadata", {})
+            node = str(metadata.get("member"))
+            peer_nonce = str(metadata.get("nonce", ""))
+            if not peer_nonce or peer_nonce == nonce:
+                return None
+            
+            own_mac = self.handshake_mac(self.node_name, nonce, peer_nonce)
+            if dialed:
+                link.send(BusKind.AUTH, {"mac": own_mac})
+            
+            # 对方在握手中关闭连接（如两个节点同时连接时多余的一条）不算认证失败
+            received = link.receive()
+            if not received:
+                return None
+            peer_mac = received[0].get("metadata", {}).get("mac")
+            if (received[0].get("type") != BusKind.AUTH or not isinstance(peer_mac, str)
+                    or not hmac.compare_digest(peer_mac, self.handshake_mac(node, peer_nonce, nonce))):
+                print(f"⚠️ 拒绝未通过认证的节点连接（自称 '{node}'）")
+                return None
+            
+            # 接受方在验证对方之后才出示自己的认证码，未认证的连接得不到任何认证码
+            if not dialed:
+                link.send(BusKind.AUTH, {"mac": own_mac})
+            return node
+        except (ConnectionError, OSError):
+            return None
+    
+    def register_link(self, node: str, link: BusLink) -> bool:
+        """
+        登记节点连接（两个节点之间只保留一条）
+        
+        Args:
+            node: 对方节点名称
+            link: 节点连接
+            
+        Returns:
+            是否保留该连接
+        """
+        preferred = min(self.node_name, node)
+        with self.links_lock:
+            existing = self.links.get(node)
+            if existing is not None and existing.initiator == preferred and link.initiator != preferred:
+                return False
+            self.links[node] = link
+            self.rebuild_node_targets()
+        
+        if existing is not None:
+            existing.close()
+        print(f"🔗 已连接节点 '{node}'")
+        return True
+    
+    def unregister_link(self, node: str, link: BusLink):
+        """
+        移除断开的节点连接，该节点上的用户全部离线
+        
+        Args:
+            node: 对方节点名称
+            link: 节点连接
+        """
+        link.close()
+        with self.links_lock:
+            if self.links.get(node) is not link:
+                return
+            del self.links[node]
+            self.rebuild_node_targets()
+        
+        self.presence.drop(node)
+        if self.running:
+            print(f"⚠️ 与节点 '{node}' 的连接已断开")
+    
+    def rebuild_node_targets(self):
+        """重建广播时附加的节点目标（调用方持有 links_lock）"""
+        self.node_targets = tuple(
+            (RemoteTarget(node), {
+                "username": f"节点 {node}",
+                "address": (node, 0),
+                "features": BUS_FEATURES,
+                "outbox": RemoteOutbox(link, BusKind.BROADCAST)
+            })
+            for node, link in self.links.items()
+        )
+    
+    def process_node_message(self, node: str, envelope: dict, message):
+        """
+        处理其他节点发来的消息
+        
+        Args:
+            node: 对方节点名称
+            envelope: 信封字典
+            message: 负载（PreparedMessage 或 None）
+        """
+        kind = envelope.get("type")
+        metadata = envelope.get("metadata", {})
+        
+        if kind == BusKind.BROADCAST:
+            # 只投递给本节点的客户端，不再转发给其他节点
+            self.deliver(message, self.registry.snapshot())
+            self.record_history(message)
+        
+        elif kind == BusKind.DIRECT:
+            user_socket = self.registry.find(metadata.get("to"))
+            client_info = self.registry.get(user_socket) if user_socket else None
+            if client_info:
+                self.deliver(message, [(user_socket, client_info)])
+        
+        elif kind == BusKind.JOIN:
+            self.presence.join(node, metadata["address"], metadata["username"])
+        
+        elif kind == BusKind.LEAVE:
+            self.presence.leave(node, metadata["address"])
+        
+        elif kind == BusKind.SYNC:
+            self.presence.replace(node, metadata.get("users", {}))
+    
+    def publish(self, kind, metadata=None):
+        """
+        向所有节点发送消息
+        
+        Args:
+            kind: BusKind
+            metadata: 路由信息
+        """
+        frames = BusLink.encode(kind, metadata)
+        with self.links_lock:
+            links = list(self.links.values())
+        for link in links:
+            try:
+                link.send_frames(frames)
+            except ConnectionError:
+                pass
+    
+    def local_presence(self):
+        """本节点的在线用户 {地址: 用户名}"""
+        return {format_address(client_info["address"]): client_info["username"]
+                for _, client_info in self.registry.snapshot()}
+    
+    def register_client(self, client_socket, address, message):
+        """加入聊天室后通知其他节点"""
+        username = super().register_client(client_socket, address, message)
+        if username:
+            self.publish(BusKind.JOIN, {"address": format_address(address), "username": username})
+        return username
+    
+    def disconnect_client(self, client_socket, username):
+        """断开本节点的连接后通知其他节点（远程目标由其所在节点管理）"""
+        if isinstance(client_socket, RemoteTarget):
+            return
+        client_info = self.clients.get(client_socket)
+        super().disconnect_client(client_socket, username)
+        if client_info:
+            self.publish(BusKind.LEAVE, {"address": format_address(client_info["address"])})
+    
+    def get_client_snapshot(self, exclude_socket=None):
+        """本节点的客户端加上每个对等节点（广播经节点连接发给对方的所有客户端）"""
+        return tuple(super().get_client_snapshot(exclude_socket)) + self.node_targets
+    
+    def find_user_socket(self, username):
+        """
+        根据用户名查找连接，本节点没有时查询在线用户表
+        
+        Returns:
+            本地套接字、其他节点上用户的 RemoteTarget，不在线返回None
+        """
+        user_socket = super().find_user_socket(username)
+        if user_socket is not None:
+            return user_socket
+        
+        owner = self.presence.find(username)
+        if owner is None:
+            return None
+        return RemoteTarget(owner[0], username)
+    
+    def get_client_info(self, client_socket):
+        """获取客户端信息，远程用户的出站队列经其所在节点的连接发送"""
+        if not isinstance(client_socket, RemoteTarget):
+            return super().get_client_info(client_socket)
+        
+        with self.links_lock:
+            link = self.links.get(client_socket.node)
+        owner = self.presence.find(client_socket.username)
+        if link is None or owner is None:
+            return None
+        
+        host, _, port = owner[1].rpartition(':')
+        return {
+            "username": client_socket.username,
+            "address": (host, int(port)),
+            "features": BUS_FEATURES,
+            "outbox": RemoteOutbox(link, BusKind.DIRECT, {"to": client_socket.username}),
+            "node": client_socket.node
+        }
+    
+    def get_online_users(self):
+        """获取所有节点的在线用户列表"""
+        return super().get_online_users() + self.presence.usernames()
+    
+    def online_count(self):
+        """获取所有节点的在线用户数"""
+        return super().online_count() + len(self.presence)
+    
+    def show_online_users(self):
+        """显示本节点和其他节点的在线用户"""
+        super().show_online_users()
+        entries = sorted(self.presence.entries())
+        if entries:
+            print(f"🌐 其他节点上的用户 ({len(entries)}):")
+            for i, (node, address, username) in enumerate(entries, 1):
+                print(f"  {i}. {username} ({address}) [节点 {node}]")
+            print()
+
+
+def main():
+    """主函数"""
+    host = 'localhost'
+    port = 8888
+    federation_port = 9888
+    peers = []
+    
+    # 处理命令行参数
+    if len(sys.argv) >= 2:
+        try:
+            port = int(sys.argv[1])
+        except ValueError:
+            print("端口号必须是数字")
+            return
+    
+    if len(sys.argv) >= 3:
+        host = sys.argv[2]
+    
+    if len(sys.argv) >= 4:
+        try:
+            federation_port = int(sys.argv[3])
+        except ValueError:
+            print("节点端口必须是数字")
+            return
+    
+    if len(sys.argv) >= 5:
+        peers = [peer.strip() for peer in sys.argv[4].split(',') if peer.strip()]
+    
+    relay_mode = RelayMode.STORE
+    if len(sys.argv) >= 6:
+        relay_mode = sys.argv[5]
+        if relay_mode not in RelayMode.ALL:
+            print(f"文件转发模式必须是: {', '.join(RelayMode.ALL)}")
+            return
+    
+    # 密钥从环境变量读取，不出现在命令行（进程列表）中
+    server = FederatedServer(host, port, federation_port, peers, relay_mode=relay_mode,
+                             secret=os.environ.get("CHAT_FEDERATION_SECRET"),
+                             slow_consumer_policy=SlowConsumerPolicy.BACKPRESSURE)
+    
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print("\n正在关闭服务器...")
+        server.stop()
+    except Exception as e:
+        print(f"服务器运行错误: {e}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+聊天消息历史
+最近的广播消息以预编码帧保存在环形缓冲区中，新用户加入时一次性回放；
+可选写入内存映射的追加日志，服务器重启后恢复
+"""
+
+import mmap
+import os
+import threading
+from collections import deque
+from utils import SocketUtils, FrameReader, PreparedMessage
+
+
+class HistoryLog:
+    """
+    内存映射的追加日志
+    
+    文件内容就是依次排列的完整消息帧（长度前缀 + 消息体），与发给客户端的字节相同。
+    文件按 GROW_SIZE 预分配并映射到内存，追加时直接复制到映射区，未写入的部分为零，
+    重启时从头解析到长度为0的位置即为末尾。先写消息体、最后写长度前缀，
+    写入中途崩溃只会留下长度为0的末尾，不会留下半条消息。
+    日志超过 max_bytes 时只保留内存中的最近消息重写，文件大小有上限。
+    """
+    
+    GROW_SIZE = 1024 * 1024
+    
+    def __init__(self, path: str, max_bytes: int = 16 * 1024 * 1024):
+        """
+        打开（或创建）日志
+        
+        Args:
+            path: 日志文件路径
+            max_bytes: 日志大小上限
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.file = open(path, mode)
+        if os.path.getsize(path) == 0:
+            self.file.truncate(self.GROW_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        
+        self.end = 0
+        for offset, size in self._scan():
+            self.end = offset + size
+    
+    def _scan(self):
+        """
+        依次定位日志中的帧
+        
+        Yields:
+            (帧的起始位置, 帧的总长度)
+        """
+        header = FrameReader.HEADER
+        offset = 0
+        while offset + header.size <= len(self.map):
+            length = header.unpack_from(self.map, offset)[0] & ~SocketUtils.BINARY_FRAME_FLAG
+            if length == 0 or offset + header.size + length > len(self.map):
+                return
+            yield offset, header.size + length
+            offset += header.size + length
+    
+    def recent(self, count: int) -> list:
+        """
+        读取日志末尾的消息帧
+        
+        Args:
+            count: 最多读取的帧数
+            
+        Returns:
+            完整帧（bytes）列表，按写入顺序
+        """
+        positions = deque(self._scan(), maxlen=count)
+        return [self.map[offset:offset + size] for offset, size in positions]
+    
+    def append(self, frame: bytes, messages):
+        """
+        追加一个帧，超过大小上限时用最近的消息重写日志
+        
+        Args:
+            frame: 完整帧
+            messages: 内存中的最近消息（PreparedMessage，已包含本条）
+        """
+        if self.end + len(frame) > self.max_bytes:
+            self._rewrite(b''.join(b''.join(message.frame()) for message in messages))
+            return
+        
+        self._reserve(self.end + len(frame))
+        header_size = FrameReader.HEADER.size
+        self.map[self.end + header_size:self.end + len(frame)] = frame[header_size:]
+        self.map[self.end:self.end + header_size] = frame[:header_size]
+        self.end += len(frame)
+    
+    def _reserve(self, size: int):
+        """确保映射区至少有 size 字节（按 GROW_SIZE 扩展文件后重新映射）"""
+        if size <= len(self.map):
+            return
+        new_size = (size // self.GROW_SIZE + 1) * self.GROW_SIZE
+        self.map.close()
+        self.file.truncate(new_size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+    
+    def _rewrite(self, data: bytes):
+        """用指定内容替换整个日志"""
+        self.map.close()
+        self.file.truncate(0)
+        self.file.truncate(max(self.GROW_SIZE, (len(data) // self.GROW_SIZE + 1) * self.GROW_SIZE))
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.map[:len(data)] = data
+        self.end = len(data)
+    
+    def close(self):
+        """把映射区写回磁盘并关闭日志"""
+        try:
+            self.map.flush()
+            self.map.close()
+        finally:
+            self.file.close()
+
+
+class MessageHistory:
+    """
+    最近聊天消息的环形缓冲区
+    
+    保存广播时使用的 PreparedMessage，帧已按编码方式缓存，
+    新用户加入时直接取出各条消息的帧拼接为一次写入，不重新编码。
+    """
+    
+    def __init__(self, max_messages: int = 50, log_path: str = None):
+        """
+        初始化历史记录
+        
+        Args:
+            max_messages: 保存的消息条数
+            log_path: 追加日志路径，None 表示只保存在内存中
+        """
+        self.messages = deque(maxlen=max_messages)
+        self.lock = threading.Lock()
+        self.log = None
+        
+        if log_path:
+            self.log = HistoryLog(log_path)
+            for frame in self.log.recent(max_messages):
+                try:
+                    self.messages.append(PreparedMessage.from_frame(frame))
+                except ValueError:
+                    continue
+    
+    def append(self, message: PreparedMessage):
+        """
+        记录一条消息（超过条数上限时丢弃最早的消息）
+        
+        Args:
+            message: 已广播的 PreparedMessage
+        """
+        with self.lock:
+            self.messages.append(message)
+            if self.log:
+                self.log.append(b''.join(message.frame()), self.messages)
+    
+    def replay_frame(self, features=frozenset()) -> tuple:
+        """
+        把最近的消息拼接为一个帧序列
+        
+        Args:
+            features: 接收方协商好的协议特性
+            
+        Returns:
+            所有消息帧的缓冲区元组，可作为一项放入出站队列一次写出
+        """
+        with self.lock:
+            messages = list(self.messages)
+        
+        buffers = []
+        for message in messages:
+            buffers.extend(message.frame(features))
+        return tuple(buffers)
+    
+    def close(self):
+        """关闭追加日志"""
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+    
+    def __len__(self) -> int:
+        """保存的消息条数"""
+        return len(self.messages)
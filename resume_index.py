@@ -0,0 +1,125 @@
+"""
+断点续传索引
+记录未完成的上传，连接断开后客户端重新发送同一文件时从已接收的位置继续
+"""
+
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+
+class ResumeIndex:
+    """
+    服务器端的续传索引
+    
+    以 (发送者, 文件名, 文件大小, 内容哈希) 为键，记录对应的部分文件路径。
+    已接收的字节数以磁盘上部分文件的实际大小为准，因此服务器异常退出后也能续传。
+    索引保存为JSON文件，每次变化后原子替换。
+    """
+    
+    def __init__(self, index_path: str):
+        """
+        初始化续传索引
+        
+        Args:
+            index_path: 索引文件路径
+        """
+        self.index_path = index_path
+        self.entries = {}  # {键: {"file_path": str, "username": str, "filename": str, "size": int, "sha256": str}}
+        self.lock = threading.Lock()
+        self.load()
+    
+    @staticmethod
+    def make_key(username: str, filename: str, size: int, sha256: str) -> str:
+        """
+        生成索引键
+        
+        Args:
+            username: 发送者用户名
+            filename: 文件名
+            size: 文件大小
+            sha256: 文件内容的SHA-256（十六进制）
+            
+        Returns:
+            索引键字符串
+        """
+        return json.dumps([username, filename, int(size), sha256], ensure_ascii=False)
+    
+    def load(self):
+        """从索引文件加载，文件不存在或损坏时从空索引开始"""
+        if not os.path.exists(self.index_path):
+            return
+        
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"加载续传索引失败: {e}")
+            self.entries = {}
+    
+    def _save_locked(self):
+        """保存索引文件（调用方持有锁）"""
+        temp_path = self.index_path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"保存续传索引失败: {e}")
+    
+    def lookup(self, key: str) -> Optional[Dict]:
+        """
+        查找未完成的上传
+        
+        Args:
+            key: 索引键
+            
+        Returns:
+            索引条目（附带已接收字节数 received），不存在或部分文件已丢失返回None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            
+            if not os.path.isfile(entry["file_path"]):
+                del self.entries[key]
+                self._save_locked()
+                return None
+            
+            received = min(os.path.getsize(entry["file_path"]), entry["size"])
+            return dict(entry, received=received)
+    
+    def add(self, key: str, file_path: str, username: str, filename: str, size: int, sha256: str):
+        """
+        登记一个新的上传
+        
+        Args:
+            key: 索引键
+            file_path: 部分文件路径
+            username: 发送者用户名
+            filename: 文件名
+            size: 文件大小
+            sha256: 文件内容的SHA-256
+        """
+        with self.lock:
+            self.entries[key] = {
+                "file_path": file_path,
+                "username": username,
+                "filename": filename,
+                "size": int(size),
+                "sha256": sha256
+            }
+            self._save_locked()
+    
+    def remove(self, key: str):
+        """
+        上传完成后移除条目
+        
+        Args:
+            key: 索引键
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._save_locked()
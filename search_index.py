@@ -0,0 +1,574 @@
+"""
+聊天记录全文检索
+在聊天记录日志之上维护增量的倒排索引：新消息先进入内存中的缓冲段，
+写满后由后台线程写成磁盘上不可变的索引段，并把大小相近的相邻索引段合并，
+段数和内存占用不随历史增长而增长
+"""
+
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from utils import MessageType
+
+# 英文、数字按单词切分；中文按连续汉字切分，索引单字和相邻两字
+TOKEN_PATTERN = re.compile(r'[0-9a-z_]+|[\u3400-\u9fff\uf900-\ufaff]+')
+
+
+def query_runs(text: str) -> list:
+    """
+    把文本切分为连续的单词或汉字串（小写）
+    
+    Args:
+        text: 文本
+        
+    Returns:
+        单词和汉字串列表
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def is_cjk(run: str) -> bool:
+    """是否为汉字串"""
+    return run[0] >= '\u3400'
+
+
+def index_terms(text: str) -> set:
+    """
+    消息文本的索引词项：单词，以及每个汉字和每对相邻汉字
+    
+    Args:
+        text: 消息文本
+        
+    Returns:
+        词项集合
+    """
+    terms = set()
+    for run in query_runs(text):
+        if is_cjk(run):
+            terms.update(run)
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.add(run)
+    return terms
+
+
+def search_terms(runs: list) -> set:
+    """
+    查询用的词项：汉字串用相邻两字（单个汉字用单字），选择性比单字好
+    
+    Args:
+        runs: query_runs 的结果
+        
+    Returns:
+        词项集合
+    """
+    terms = set()
+    for run in runs:
+        if is_cjk(run) and len(run) > 1:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.add(run)
+    return terms
+
+
+def encode_postings(docs) -> bytes:
+    """
+    把递增的文档号列表编码为差值 + 变长整数
+    
+    Args:
+        docs: 递增的文档号
+        
+    Returns:
+        编码后的字节串
+    """
+    out = bytearray()
+    previous = 0
+    for doc in docs:
+        delta = doc - previous
+        previous = doc
+        while delta >= 0x80:
+            out.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def decode_postings(data) -> array:
+    """
+    解码 encode_postings 的结果
+    
+    Args:
+        data: 编码后的字节串（或内存映射的切片）
+        
+    Returns:
+        array('Q') 递增的文档号
+    """
+    docs = array('Q')
+    value = shift = previous = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += value
+        docs.append(previous)
+        value = shift = 0
+    return docs
+
+
+def intersect(lists: list) -> list:
+    """
+    求多个递增文档号列表的交集
+    
+    Args:
+        lists: 递增的文档号列表
+        
+    Returns:
+        递增的交集
+    """
+    lists = sorted(lists, key=len)
+    result = lists[0]
+    for other in lists[1:]:
+        members = set(other)
+        result = [doc for doc in result if doc in members]
+        if not result:
+            break
+    return list(result)
+
+
+class MemorySegment:
+    """内存中的索引段（缓冲段写满后冻结，等待后台线程写入磁盘）"""
+    
+    def __init__(self):
+        self.postings = {}  # {词项: array('Q') 文档号}
+        self.doc_count = 0
+        self.min_doc = None
+        self.max_doc = None
+    
+    def add(self, doc: int, terms):
+        """加入一条消息"""
+        for term in terms:
+            self.postings.setdefault(term, array('Q')).append(doc)
+        if self.min_doc is None:
+            self.min_doc = doc
+        self.max_doc = doc
+        self.doc_count += 1
+    
+    def lookup(self, term: str):
+        """词项的文档号列表，不存在返回None"""
+        return self.postings.get(term)
+    
+    def items(self):
+        """按词项字节序依次返回 (词项字节串, 编码后的文档号列表)"""
+        for term in sorted(self.postings, key=lambda term: term.encode('utf-8')):
+            yield term.encode('utf-8'), encode_postings(self.postings[term])
+
+
+class IndexSegment:
+    """
+    磁盘上不可变的索引段（内存映射，不把词典读入内存）
+    
+    文件结构:
+        文件头    魔数, 词项数, 文档数, 最小文档号, 最大文档号, 词项表位置, 词项字符串位置
+        倒排表    各词项编码后的文档号列表依次排列
+        词项表    按词项字节序排列的定长项 (词项字符串位置, 倒排表位置, 倒排表长度)
+        词项字符串 长度前缀 + UTF-8
+    查询在词项表上二分查找，只读取命中的倒排表。
+    """
+    
+    HEADER = struct.Struct('!4sIQQQQQ')
+    ENTRY = struct.Struct('!QQI')
+    TERM_HEADER = struct.Struct('!H')
+    MAGIC = b'CSI1'
+    
+    def __init__(self, path: str):
+        """
+        打开索引段
+        
+        Args:
+            path: 索引段文件路径
+            
+        Raises:
+            ValueError: 文件不是完整的索引段
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < self.HEADER.size:
+            self.map.close()
+            raise ValueError(f"索引段不完整: {path}")
+        (magic, self.term_count, self.doc_count, self.min_doc, self.max_doc,
+         self.entries_offset, self.terms_offset) = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.map.close()
+            raise ValueError(f"不是索引段文件: {path}")
+    
+    @classmethod
+    def write(cls, path: str, items, doc_count: int, min_doc: int, max_doc: int):
+        """
+        写入索引段（先写临时文件再改名，不会留下半个索引段）
+        
+        Args:
+            path: 索引段文件路径
+            items: 按词项字节序的 (词项字节串, 编码后的文档号列表)
+            doc_count: 文档数
+            min_doc: 最小文档号
+            max_doc: 最大文档号
+        """
+        entries = bytearray()
+        terms = bytearray()
+        term_count = 0
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(bytes(cls.HEADER.size))
+            offset = cls.HEADER.size
+            for term, postings in items:
+                entries += cls.ENTRY.pack(len(terms), offset, len(postings))
+                terms += cls.TERM_HEADER.pack(len(term)) + term
+                f.write(postings)
+                offset += len(postings)
+                term_count += 1
+            f.write(entries)
+            f.write(terms)
+            f.seek(0)
+            f.write(cls.HEADER.pack(cls.MAGIC, term_count, doc_count, min_doc, max_doc,
+                                    offset, offset + len(entries)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    
+    def _term(self, index: int) -> bytes:
+        """第 index 个词项的字节串"""
+        position = self.terms_offset + self.ENTRY.unpack_from(self.map, self.entries_offset + index * self.ENTRY.size)[0]
+        size = self.TERM_HEADER.unpack_from(self.map, position)[0]
+        start = position + self.TERM_HEADER.size
+        return self.map[start:start + size]
+    
+    def _postings(self, index: int) -> bytes:
+        """第 index 个词项编码后的文档号列表"""
+        _, offset, size = self.ENTRY.unpack_from(self.map, self.entries_offset + index * self.ENTRY.size)
+        return self.map[offset:offset + size]
+    
+    def lookup(self, term: str):
+        """
+        查找词项
+        
+        Args:
+            term: 词项
+            
+        Returns:
+            array('Q') 文档号，不存在返回None
+        """
+        key = term.encode('utf-8')
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self._term(low) == key:
+            return decode_postings(self._postings(low))
+        return None
+    
+    def items(self):
+        """按词项字节序依次返回 (词项字节串, 编码后的文档号列表)"""
+        for index in range(self.term_count):
+            yield self._term(index), self._postings(index)
+    
+    def close(self):
+        """关闭内存映射"""
+        self.map.close()
+
+
+class SearchIndex:
+    """
+    聊天记录日志上的倒排索引
+    
+    文档号就是聊天记录的引用号，随写入顺序递增。索引注册为日志的监听者，
+    在日志写入锁内按顺序收到新的 TEXT 记录，所有索引段按文档号排列、互不重叠。
+    新消息进入缓冲段，缓冲段达到 FLUSH_DOCS 条后冻结并交给后台线程写入磁盘；
+    后台线程随后把 MERGE_FACTOR 个同一级别的相邻索引段合并为一个，段数随历史长度对数增长。
+    启动时从日志中补建最后一个磁盘索引段之后的消息。
+    """
+    
+    FLUSH_DOCS = 4096
+    MERGE_FACTOR = 8
+    
+    def __init__(self, directory: str, chat_log):
+        """
+        打开（或创建）索引并补建缺少的消息
+        
+        Args:
+            directory: 索引段目录
+            chat_log: 被索引的 ChatLog
+        """
+        self.directory = directory
+        self.chat_log = chat_log
+        os.makedirs(directory, exist_ok=True)
+        
+        self.lock = threading.Lock()
+        self.segments = self._load_segments()   # 磁盘索引段，按文档号排列
+        self.frozen = []                         # 已冻结、等待写入磁盘的缓冲段
+        self.buffer = MemorySegment()
+        self.generation = max((int(os.path.basename(segment.path)[:-4]) for segment in self.segments), default=0) + 1
+        self.closed = False
+        self.wakeup = threading.Event()
+        
+        last_doc = self.segments[-1].max_doc if self.segments else None
+        for ref, record in chat_log.records_after(last_doc):
+            self.on_record(ref, record)
+        chat_log.listeners.append(self.on_record)
+        
+        self.worker = threading.Thread(target=self.run_worker)
+        self.worker.daemon = True
+        self.worker.start()
+    
+    def _load_segments(self) -> list:
+        """
+        读取磁盘索引段
+        
+        合并写入新段后、删除旧段前崩溃会留下范围被新段覆盖的旧段，加载时删除。
+        
+        Returns:
+            按文档号排列的 IndexSegment 列表
+        """
+        segments = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif name.endswith('.seg'):
+                try:
+                    segments.append(IndexSegment(path))
+                except ValueError as e:
+                    print(f"跳过损坏的索引段: {e}")
+        
+        segments.sort(key=lambda segment: (segment.min_doc, -segment.max_doc))
+        kept = []
+        for segment in segments:
+            if kept and segment.max_doc <= kept[-1].max_doc:
+                segment.close()
+                os.remove(segment.path)
+            else:
+                kept.append(segment)
+        return kept
+    
+    def on_record(self, ref: int, record: dict):
+        """
+        日志写入新记录时调用（在日志写入锁内）
+        
+        Args:
+            ref: 记录的引用号
+            record: 记录字典（只索引 TEXT）
+        """
+        if record.get("type") != MessageType.TEXT:
+            return
+        terms = index_terms(record.get("data", ""))
+        if not terms:
+            return
+        
+        with self.lock:
+            self.buffer.add(ref, terms)
+            if self.buffer.doc_count >= self.FLUSH_DOCS:
+                self.frozen.append(self.buffer)
+                self.buffer = MemorySegment()
+                self.wakeup.set()
+    
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        搜索包含所有查询词的消息（最新的在前）
+        
+        倒排索引按词项求交集得到候选消息，再读取原文确认每个单词和汉字串都出现在消息中。
+        
+        Args:
+            query: 查询文本
+            limit: 最多返回的条数
+            
+        Returns:
+            记录字典列表 [{"time", "type", "user", "data"}]
+        """
+        runs = query_runs(query)
+        terms = search_terms(runs)
+        if not terms:
+            return []
+        
+        results = []
+        upper = None
+        while len(results) < limit:
+            # 索引锁内只取文档号，读取日志时不持有索引锁（日志写入时会回调索引）
+            with self.lock:
+                batch = self._candidates(terms, upper, limit * 4)
+            if not batch:
+                break
+            
+            for doc in batch:
+                record = self.chat_log.read(doc)
+                text = record.get("data", "").lower()
+                if all(run in text for run in runs):
+                    results.append(record)
+                    if len(results) >= limit:
+                        break
+            upper = batch[-1]
+        return results
+    
+    def _candidates(self, terms: set, upper, count: int) -> list:
+        """
+        按文档号从大到小取出包含所有词项的候选文档
+        
+        Args:
+            terms: 查询词项
+            upper: 只取小于该文档号的文档，None 表示不限
+            count: 取到这么多条后停止
+            
+        Returns:
+            文档号列表（从大到小）
+        """
+        candidates = []
+        sources = [self.buffer] + self.frozen[::-1] + self.segments[::-1]
+        for source in sources:
+            if source.min_doc is None or (upper is not None and source.min_doc >= upper):
+                continue
+            lists = []
+            for term in terms:
+                docs = source.lookup(term)
+                if not docs:
+                    break
+                lists.append(docs)
+            else:
+                for doc in reversed(intersect(lists)):
+                    if upper is None or doc < upper:
+                        candidates.append(doc)
+            if len(candidates) >= count:
+                break
+        return candidates
+    
+    def run_worker(self):
+        """后台线程：把冻结的缓冲段写入磁盘并合并索引段"""
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            closing = self.closed
+            try:
+                while self.flush_frozen():
+                    pass
+                while self.merge_segments():
+                    pass
+            except Exception as e:
+                print(f"写入搜索索引失败: {e}")
+            if closing:
+                return
+    
+    def next_path(self) -> str:
+        """新索引段的文件路径"""
+        path = os.path.join(self.directory, f"{self.generation:08d}.seg")
+        self.generation += 1
+        return path
+    
+    def flush_frozen(self) -> bool:
+        """
+        把最早冻结的缓冲段写入磁盘（写入期间缓冲段仍可查询）
+        
+        Returns:
+            是否写入了一个索引段
+        """
+        with self.lock:
+            if not self.frozen:
+                return False
+            memory = self.frozen[0]
+            path = self.next_path()
+        
+        IndexSegment.write(path, memory.items(), memory.doc_count, memory.min_doc, memory.max_doc)
+        segment = IndexSegment(path)
+        with self.lock:
+            self.frozen.remove(memory)
+            self.segments.append(segment)
+        return True
+    
+    def level(self, segment) -> int:
+        """索引段的级别：文档数每增加 MERGE_FACTOR 倍升一级"""
+        level = 0
+        size = self.FLUSH_DOCS
+        while segment.doc_count >= size * self.MERGE_FACTOR:
+            size *= self.MERGE_FACTOR
+            level += 1
+        return level
+    
+    def merge_segments(self) -> bool:
+        """
+        把 MERGE_FACTOR 个同一级别的相邻索引段合并为一个
+        
+        索引段按级别从高到低排列，新段为0级；总是合并同级中最早的几个，合并结果紧接在上一级之后，排列保持不变。
+        
+        旧索引段不可变，合并在锁外进行，期间照常查询；完成后在锁内替换并删除旧段。
+        
+        Returns:
+            是否进行了一次合并
+        """
+        with self.lock:
+            run = None
+            for start in range(len(self.segments) - self.MERGE_FACTOR + 1):
+                candidate = self.segments[start:start + self.MERGE_FACTOR]
+                if len({self.level(segment) for segment in candidate}) == 1:
+                    run = candidate
+                    break
+            if run is None:
+                return False
+            path = self.next_path()
+        
+        IndexSegment.write(path, self._merged_items(run), sum(segment.doc_count for segment in run),
+                           run[0].min_doc, run[-1].max_doc)
+        merged = IndexSegment(path)
+        with self.lock:
+            start = self.segments.index(run[0])
+            self.segments[start:start + len(run)] = [merged]
+            for segment in run:
+                segment.close()
+                os.remove(segment.path)
+        return True
+    
+    @staticmethod
+    def _merged_items(run: list):
+        """
+        按词项字节序合并多个相邻索引段的词项（各段文档号不重叠，倒排表按段的顺序拼接）
+        
+        Yields:
+            (词项字节串, 编码后的文档号列表)
+        """
+        def tagged(number, segment):
+            for term, postings in segment.items():
+                yield term, number, postings
+        
+        streams = [tagged(number, segment) for number, segment in enumerate(run)]
+        current = None
+        docs = array('Q')
+        for term, _, postings in heapq.merge(*streams):
+            if term != current:
+                if current is not None:
+                    yield current, encode_postings(docs)
+                current = term
+                docs = array('Q')
+            docs.extend(decode_postings(postings))
+        if current is not None:
+            yield current, encode_postings(docs)
+    
+    def close(self):
+        """停止后台线程，把内存中的索引写入磁盘（重复调用无效果）"""
+        if self.closed:
+            return
+        self.chat_log.listeners.remove(self.on_record)
+        with self.lock:
+            if self.buffer.doc_count:
+                self.frozen.append(self.buffer)
+                self.buffer = MemorySegment()
+        self.closed = True
+        self.wakeup.set()
+        self.worker.join()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
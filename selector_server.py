@@ -0,0 +1,615 @@
+"""
+基于 selectors 的套接字聊天服务器
+一个I/O线程用 selectors（Linux 上为 epoll）多路复用所有连接，固定大小的线程池处理消息，
+线程数不随连接数增长；协议、管理命令和文件存储与 ChatServer 一致
+"""
+
+import os
+import selectors
+import socket
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import (MessageType, FrameReader, FrameWriter, FileRegion, OutboundQueue,
+                   SlowConsumerPolicy, RelayMode)
+from server import ChatServer
+
+
+class SelectorOutbox(OutboundQueue):
+    """
+    由I/O线程发送的出站队列
+    
+    沿用 OutboundQueue 的容量上限和慢客户端策略，但不启动写线程：
+    放入帧后通知I/O线程，由I/O线程在套接字可写时用 FrameWriter.flush_nonblocking 发送。
+    """
+    
+    def __init__(self, connection, server, max_messages, policy):
+        """
+        初始化出站队列
+        
+        Args:
+            connection: SelectorConnection
+            server: SelectorChatServer
+            max_messages: 队列中的消息数上限
+            policy: 队列已满时的处理策略（SlowConsumerPolicy）
+        """
+        super().__init__(connection.sock, max_messages, policy)
+        self.connection = connection
+        self.server = server
+        self.writer = FrameWriter(connection.sock)
+        self.region = None            # 正在发送的 [FileRegion, 文件对象, 已发送字节数]
+        self.flush_requested = False  # 是否已通知I/O线程发送
+    
+    def start(self):
+        """由I/O线程发送，不需要写线程"""
+    
+    def _append(self, frame):
+        """放入一帧，需要时通知I/O线程（调用方持有条件变量）"""
+        super()._append(frame)
+        if not self.flush_requested:
+            self.flush_requested = True
+            self.server.call_in_loop(self.server.flush_connection, self.connection)
+    
+    def flush(self) -> bool:
+        """
+        发送队列中的数据，直到全部发完或套接字发送缓冲区已满（只在I/O线程中调用）
+        
+        Returns:
+            是否已全部发送
+            
+        Raises:
+            OSError: 连接已断开
+        """
+        while True:
+            if not self.writer.flush_nonblocking():
+                return False
+            if self.region is not None and not self._send_region():
+                return False
+            
+            with self.condition:
+                if self.closed or not self.queue:
+                    self.flush_requested = False
+                    return True
+                
+                while self.queue and self.writer.pending_bytes < FrameWriter.MAX_BATCH_BYTES:
+                    frame, size = self.queue.popleft()
+                    self.queued_bytes -= size
+                    if isinstance(frame, FileRegion):
+                        # 先发完之前的帧，再发送文件区间
+                        self.region = [frame, open(frame.path, 'rb'), 0]
+                        break
+                    self.writer.add(frame)
+                self.condition.notify_all()
+    
+    def _send_region(self) -> bool:
+        """
+        在非阻塞套接字上继续发送文件区间
+        
+        Returns:
+            是否已发送完
+            
+        Raises:
+            OSError: 发送失败，或文件在发送过程中被截断
+        """
+        region, file, sent = self.region
+        try:
+            while sent < region.count:
+                remaining = region.count - sent
+                if hasattr(os, 'sendfile'):
+                    count = os.sendfile(self.sock.fileno(), file.fileno(), region.offset + sent, remaining)
+                else:
+                    file.seek(region.offset + sent)
+                    count = self.sock.send(file.read(min(remaining, FrameWriter.MAX_BATCH_BYTES)))
+                if count == 0:
+                    raise OSError(f"文件在发送过程中被截断: {region.path}")
+                sent += count
+        except (BlockingIOError, InterruptedError):
+            self.region[2] = sent
+            return False
+        
+        file.close()
+        self.region = None
+        return True
+    
+    def discard_region(self):
+        """关闭未发送完的文件区间（只在I/O线程中调用）"""
+        if self.region is not None:
+            self.region[1].close()
+            self.region = None
+
+
+class SelectorConnection:
+    """
+    selector 模式下的一个客户端连接
+    
+    读取由I/O线程完成，解析出的消息放入 inbox，同一时刻最多一个工作线程按顺序处理，
+    因此同一连接的消息处理顺序与接收顺序一致。
+    """
+    
+    def __init__(self, sock, address):
+        """
+        初始化连接
+        
+        Args:
+            sock: 非阻塞的客户端套接字
+            address: 客户端地址
+        """
+        self.sock = sock
+        self.address = address
+        self.reader = FrameReader.for_socket(sock)
+        self.outbox = None          # 加入聊天室后创建
+        self.username = None
+        self.handshaken = False     # I/O线程是否已收到第一条消息
+        self.joined = False         # 工作线程是否已处理第一条消息（USER_JOIN）
+        
+        self.inbox = deque()        # 待处理的消息，None 表示连接已断开
+        self.lock = threading.Lock()
+        self.scheduled = False      # 是否已有工作线程在处理该连接的消息
+        
+        # 以下状态只在I/O线程中修改
+        self.events = selectors.EVENT_READ
+        self.paused = False         # 待处理的消息过多时暂停读取
+        self.want_write = False     # 发送缓冲区已满，等待可写
+        self.closing = False
+
+
+class SelectorChatServer(ChatServer):
+    MAX_PENDING_MESSAGES = 64  # 每个连接待处理的消息数上限，超过后暂停读取该连接
+    
+    def __init__(self, host='localhost', port=8888, workers=8, backlog=1024,
+                 slow_consumer_policy=SlowConsumerPolicy.BACKPRESSURE, relay_mode=RelayMode.STORE,
+                 history_size=50, history_path=None, chat_log_dir=None):
+        """
+        初始化 selector 聊天服务器
+        
+        Args:
+            host: 服务器主机地址
+            port: 服务器端口
+            workers: 处理消息的工作线程数
+            backlog: 监听队列长度
+            slow_consumer_policy: 出站队列已满时的处理策略（drop/disconnect/backpressure）
+            relay_mode: 转发客户端上传文件时的存储方式（store/relay/spool）
+            history_size: 新用户加入时回放的最近消息条数（0 表示不保存历史）
+            history_path: 历史消息追加日志的路径，None 表示只保存在内存中
+            chat_log_dir: 聊天记录日志目录，默认 files/chat_log
+        """
+        super().__init__(host, port, slow_consumer_policy=slow_consumer_policy, relay_mode=relay_mode,
+                         backlog=backlog, history_size=history_size, history_path=history_path,
+                         chat_log_dir=chat_log_dir)
+        self.workers = workers
+        
+        self.selector = None
+        self.executor = None
+        self.connections = {}  # {socket: SelectorConnection}，连接彻底断开后移除
+        
+        # 其他线程交给I/O线程执行的操作
+        self.calls = deque()
+        self.calls_lock = threading.Lock()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+    
+    def start(self):
+        """启动服务器"""
+        try:
+            self.raise_open_file_limit()
+            
+            self.socket.bind((self.host, self.port))
+            self.socket.listen(self.backlog)
+            self.socket.setblocking(False)
+            
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, selectors.EVENT_READ)
+            self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.running = True
+            
+            print(f"聊天服务器(selector)已启动，监听 {self.host}:{self.port}，{self.workers} 个工作线程")
+            print("等待客户端连接...")
+            self.print_commands()
+            print("按 Ctrl+C 停止服务器\n")
+            
+            # 启动服务器输入处理线程
+            input_thread = threading.Thread(target=self.handle_server_input)
+            input_thread.daemon = True
+            input_thread.start()
+            
+            self.run_loop()
+        
+        except Exception as e:
+            print(f"启动服务器失败: {e}")
+        finally:
+            self.stop()
+    
+    def stop(self):
+        """停止服务器（可在任意线程调用）"""
+        self.running = False
+        self.wakeup()
+        super().stop()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+    
+    def run_loop(self):
+        """I/O线程：等待套接字事件，执行其他线程交来的操作"""
+        while self.running:
+            for key, events in self.selector.select(timeout=1.0):
+                if key.fileobj is self.socket:
+                    self.accept_connections()
+                elif key.fileobj is self.wakeup_recv:
+                    self.drain_wakeup()
+                else:
+                    connection = key.data
+                    if events & selectors.EVENT_READ:
+                        self.read_connection(connection)
+                    if events & selectors.EVENT_WRITE:
+                        self.flush_connection(connection)
+            
+            self.run_calls()
+    
+    def call_in_loop(self, function, *args):
+        """
+        在I/O线程中执行操作（可在任意线程调用）
+        
+        Args:
+            function: 要执行的函数
+            *args: 参数
+        """
+        with self.calls_lock:
+            self.calls.append((function, args))
+            first = len(self.calls) == 1
+        if first:
+            self.wakeup()
+    
+    def wakeup(self):
+        """唤醒阻塞在 select 中的I/O线程"""
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            pass
+    
+    def drain_wakeup(self):
+        """读掉唤醒套接字中的数据"""
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except OSError:
+            pass
+    
+    def run_calls(self):
+        """执行其他线程交来的操作"""
+        with self.calls_lock:
+            calls = list(self.calls)
+            self.calls.clear()
+        
+        for function, args in calls:
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"I/O线程执行操作失败: {e}")
+    
+    def accept_connections(self):
+        """接受监听队列中所有等待的连接"""
+        while True:
+            try:
+                client_socket, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.running:
+                    print(f"接受连接时发生错误: {e}")
+                return
+            
+            print(f"新客户端连接: {address}")
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+            connection = SelectorConnection(client_socket, address)
+            self.connections[client_socket] = connection
+            self.selector.register(client_socket, connection.events, connection)
+    
+    def read_connection(self, connection):
+        """
+        读取连接上到达的数据并把完整的消息交给工作线程
+        
+        Args:
+            connection: SelectorConnection
+        """
+        try:
+            received = connection.reader.fill_nonblocking()
+            if received is None:
+                return
+            if received == 0:
+                self.close_connection(connection)
+                return
+            
+            while not connection.closing:
+                message = connection.reader.next_message()
+                if message is None:
+                    break
+                
+                # 并行上传的数据连接不加入聊天室，交给独立线程阻塞读取原始数据
+                if not connection.handshaken and message.get("type") == MessageType.DATA_CONNECT:
+                    self.detach_data_connection(connection, message)
+                    return
+                
+                connection.handshaken = True
+                self.enqueue(connection, message)
+            
+            # 工作线程处理不过来时暂停读取，内存占用不随发送速度增长
+            if len(connection.inbox) >= self.MAX_PENDING_MESSAGES and not connection.paused:
+                connection.paused = True
+                self.update_events(connection)
+        
+        except Exception as e:
+            # 任何解析错误只断开这一个连接，不能让 I/O 线程退出
+            print(f"处理客户端 {connection.address} 时发生错误: {e}")
+            self.close_connection(connection)
+    
+    def enqueue(self, connection, message):
+        """
+        把消息放入连接的待处理队列，没有工作线程在处理时提交一个
+        
+        Args:
+            connection: SelectorConnection
+            message: 消息字典，None 表示断开连接
+        """
+        with connection.lock:
+            connection.inbox.append(message)
+            if connection.scheduled:
+                return
+            connection.scheduled = True
+        self.executor.submit(self.process_connection, connection)
+    
+    def process_connection(self, connection):
+        """
+        工作线程：按顺序处理连接的待处理消息
+        
+        Args:
+            connection: SelectorConnection
+        """
+        while True:
+            with connection.lock:
+                if not connection.inbox:
+                    connection.scheduled = False
+                    break
+                message = connection.inbox.popleft()
+            
+            try:
+                if message is None:
+                    # 连接已从 selector 注销，执行 ChatServer 的断开流程
+                    super().disconnect_client(connection.sock, connection.username)
+                    self.connections.pop(connection.sock, None)
+                elif not connection.joined:
+                    connection.joined = True
+                    connection.username = self.register_client(connection.sock, connection.address, message)
+                    if not connection.username:
+                        self.call_in_loop(self.close_connection, connection)
+                else:
+                    self.process_message(connection.sock, message, connection.username)
+            except Exception as e:
+                print(f"处理客户端 {connection.address} 时发生错误: {e}")
+        
+        if connection.paused:
+            self.call_in_loop(self.resume_reading, connection)
+    
+    def resume_reading(self, connection):
+        """
+        待处理的消息处理完后恢复读取
+        
+        Args:
+            connection: SelectorConnection
+        """
+        if connection.paused and not connection.closing:
+            connection.paused = False
+            self.update_events(connection)
+            # 暂停期间缓冲区中可能还有完整的消息
+            self.read_buffered(connection)
+    
+    def read_buffered(self, connection):
+        """
+        处理读取缓冲区中已有的完整消息（不读取套接字）
+        
+        Args:
+            connection: SelectorConnection
+        """
+        try:
+            while len(connection.inbox) < self.MAX_PENDING_MESSAGES:
+                message = connection.reader.next_message()
+                if message is None:
+                    return
+                self.enqueue(connection, message)
+        except Exception as e:
+            print(f"处理客户端 {connection.address} 时发生错误: {e}")
+            self.close_connection(connection)
+    
+    def flush_connection(self, connection):
+        """
+        发送连接出站队列中的数据，发送缓冲区已满时等待可写事件
+        
+        Args:
+            connection: SelectorConnection
+        """
+        if connection.closing or connection.outbox is None:
+            return
+        
+        try:
+            want_write = not connection.outbox.flush()
+        except OSError:
+            self.close_connection(connection)
+            return
+        
+        if want_write != connection.want_write:
+            connection.want_write = want_write
+            self.update_events(connection)
+    
+    def update_events(self, connection):
+        """
+        按连接状态更新 selector 中关注的事件
+        
+        Args:
+            connection: SelectorConnection
+        """
+        if connection.closing:
+            return
+        
+        events = 0
+        if not connection.paused:
+            events |= selectors.EVENT_READ
+        if connection.want_write:
+            events |= selectors.EVENT_WRITE
+        
+        if events == connection.events:
+            return
+        if connection.events == 0:
+            self.selector.register(connection.sock, events, connection)
+        elif events == 0:
+            self.selector.unregister(connection.sock)
+        else:
+            self.selector.modify(connection.sock, events, connection)
+        connection.events = events
+    
+    def close_connection(self, connection):
+        """
+        从 selector 注销连接，并在该连接已收到的消息处理完后断开（只在I/O线程中调用）
+        
+        Args:
+            connection: SelectorConnection
+        """
+        if connection.closing:
+            return
+        connection.closing = True
+        
+        if connection.events:
+            try:
+                self.selector.unregister(connection.sock)
+            except (KeyError, ValueError):
+                pass
+            connection.events = 0
+        
+        if connection.outbox:
+            connection.outbox.close()
+            connection.outbox.discard_region()
+        self.enqueue(connection, None)
+    
+    def disconnect_client(self, client_socket, username):
+        """
+        断开客户端连接
+        
+        仍在 selector 中的连接交给I/O线程注销，之后再由工作线程执行断开流程，
+        避免在其他线程关闭I/O线程正在使用的套接字。
+        
+        Args:
+            client_socket: 客户端套接字
+            username: 用户名
+        """
+        connection = self.connections.get(client_socket)
+        if connection is not None and not connection.closing:
+            if connection.outbox:
+                connection.outbox.close()
+            self.call_in_loop(self.close_connection, connection)
+            return
+        
+        super().disconnect_client(client_socket, username)
+    
+    def detach_data_connection(self, connection, message):
+        """
+        把并行上传的数据连接移出 selector，由独立线程阻塞读取
+        
+        Args:
+            connection: SelectorConnection
+            message: DATA_CONNECT 消息
+        """
+        connection.closing = True
+        self.selector.unregister(connection.sock)
+        connection.events = 0
+        self.connections.pop(connection.sock, None)
+        connection.sock.setblocking(True)
+        
+        data_thread = threading.Thread(target=self.run_data_connection, args=(connection, message))
+        data_thread.daemon = True
+        data_thread.start()
+    
+    def run_data_connection(self, connection, message):
+        """
+        数据连接线程
+        
+        Args:
+            connection: SelectorConnection
+            message: DATA_CONNECT 消息
+        """
+        try:
+            self.handle_data_connection(connection.sock, connection.reader, message)
+        except Exception as e:
+            print(f"处理数据连接 {connection.address} 时发生错误: {e}")
+        finally:
+            connection.sock.close()
+    
+    def create_outbox(self, client_socket):
+        """
+        为客户端创建由I/O线程发送的出站队列
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            出站队列
+        """
+        connection = self.connections[client_socket]
+        connection.outbox = SelectorOutbox(connection, self, self.outbound_queue_size, self.slow_consumer_policy)
+        return connection.outbox
+
+
+def main():
+    """主函数"""
+    host = 'localhost'
+    port = 8888
+    
+    # 处理命令行参数
+    if len(sys.argv) >= 2:
+        try:
+            port = int(sys.argv[1])
+        except ValueError:
+            print("端口号必须是数字")
+            return
+    
+    if len(sys.argv) >= 3:
+        host = sys.argv[2]
+    
+    policy = SlowConsumerPolicy.BACKPRESSURE
+    if len(sys.argv) >= 4:
+        policy = sys.argv[3]
+        if policy not in SlowConsumerPolicy.ALL:
+            print(f"慢客户端策略必须是: {', '.join(SlowConsumerPolicy.ALL)}")
+            return
+    
+    relay_mode = RelayMode.STORE
+    if len(sys.argv) >= 5:
+        relay_mode = sys.argv[4]
+        if relay_mode not in RelayMode.ALL:
+            print(f"文件转发模式必须是: {', '.join(RelayMode.ALL)}")
+            return
+    
+    workers = 8
+    if len(sys.argv) >= 6:
+        try:
+            workers = int(sys.argv[5])
+        except ValueError:
+            print("工作线程数必须是数字")
+            return
+    
+    # 创建并启动服务器
+    server = SelectorChatServer(host, port, workers=workers, slow_consumer_policy=policy, relay_mode=relay_mode)
+    
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print("\n正在关闭服务器...")
+        server.stop()
+    except Exception as e:
+        print(f"服务器运行错误: {e}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,27 +7,54 @@ import socket
 import threading
 import sys
 import os
+import secrets
+import shutil
+import time
+import zlib
 from datetime import datetime
-from utils import SocketUtils, MessageType, format_message
+from resume_index import ResumeIndex
+from blob_store import BlobStore, ChunkSpool
+from client_registry import ClientRegistry
+from history import MessageHistory
+from chat_log import ChatLog, parse_time
+from search_index import SearchIndex
+from utils import (SocketUtils, MessageType, Feature, FrameReader, FileRegion, PreparedMessage, RoutedMessage,
+                   OutboundQueue, SlowConsumerPolicy, RelayMode, StreamHasher, TransferController, format_message)
 
 
 class ChatServer:
-    def __init__(self, host='localhost', port=8888):
+    MAX_USERNAME_LENGTH = 64  # 用户名的最大字符数（用户名会进入子串索引和广播消息）
+    MAX_UPLOAD_SIZE = 16 * 1024 ** 3  # 并行上传的最大文件大小（服务器按声明的大小预分配磁盘空间）
+    
+    def __init__(self, host='localhost', port=8888, outbound_queue_size=1024,
+                 slow_consumer_policy=SlowConsumerPolicy.BACKPRESSURE, relay_mode=RelayMode.STORE, backlog=128,
+                 history_size=50, history_path=None, chat_log_dir=None):
         """
         初始化聊天服务器
         
         Args:
             host: 服务器主机地址
             port: 服务器端口
+            outbound_queue_size: 每个客户端出站队列的消息数上限
+            slow_consumer_policy: 出站队列已满时的处理策略（drop/disconnect/backpressure）
+            relay_mode: 转发客户端上传文件时的存储方式（store/relay/spool）
+            backlog: 监听队列长度（等待 accept 的连接数上限）
+            history_size: 新用户加入时回放的最近消息条数（0 表示不保存历史）
+            history_path: 历史消息追加日志的路径，None 表示只保存在内存中
+            chat_log_dir: 聊天记录日志目录，默认 files/chat_log
         """
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.outbound_queue_size = outbound_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.relay_mode = relay_mode
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
         # 客户端管理
-        self.clients = {}  # {socket: {"username": str, "address": tuple}}
-        self.clients_lock = threading.Lock()
+        # 成员变化在锁内完成，广播遍历不可变快照，不持有锁
+        self.registry = ClientRegistry()
         
         # 文件接收管理
         self.file_transfers = {}  # {socket: {"file_handle": file, "filename": str, "received": int}}
@@ -36,30 +63,56 @@ class ChatServer:
         self.files_dir = os.path.join(os.path.dirname(__file__), 'files', 'received')
         os.makedirs(self.files_dir, exist_ok=True)
         
+        # 按内容去重保存接收的文件
+        self.blob_store = BlobStore(self.files_dir)
+        
+        # 断点续传索引（未完成的上传在服务器重启后仍可续传）
+        self.resume_index = ResumeIndex(os.path.join(self.files_dir, '.resume_index.json'))
+        
+        # spool 模式下由后台线程异步写入接收的文件
+        self.spool = ChunkSpool() if relay_mode == RelayMode.SPOOL else None
+        
+        # 并行上传 {令牌: 传输信息}，数据连接凭令牌写入各自的区间
+        self.parallel_uploads = {}
+        self.parallel_lock = threading.Lock()
+        
+        # 定向上传 {发送者套接字: [(接收者套接字, 客户端信息)]}，未记录的上传照常广播
+        self.upload_targets = {}
+        
+        # 管理员定义的群组 {群组名: [用户名]}
+        self.groups = {}
+        
+        # 最近的聊天消息，新用户加入时回放
+        self.history = MessageHistory(history_size, history_path) if history_size > 0 else None
+        
+        # 所有聊天、加入和离开事件的分段日志，管理员用 /history 查询
+        chat_log_dir = chat_log_dir or os.path.join(os.path.dirname(__file__), 'files', 'chat_log')
+        self.chat_log = ChatLog(chat_log_dir)
+        
+        # 聊天消息的全文索引，随日志写入增量更新
+        self.search_index = SearchIndex(os.path.join(chat_log_dir, 'search'), self.chat_log)
+        
         # 服务器发送文件目录
         self.server_files_dir = os.path.join(os.path.dirname(__file__), 'files', 'server')
         os.makedirs(self.server_files_dir, exist_ok=True)
         
         self.running = False
     
+    @property
+    def clients(self):
+        """在线客户端 {socket: {"username": str, "address": tuple, "features": frozenset, "outbox": OutboundQueue}}（只读）"""
+        return self.registry.clients
+    
     def start(self):
         """启动服务器"""
         try:
             self.socket.bind((self.host, self.port))
-            self.socket.listen(5)
+            self.socket.listen(self.backlog)
             self.running = True
             
             print(f"聊天服务器已启动，监听 {self.host}:{self.port}")
             print("等待客户端连接...")
-            print("\n服务器管理命令:")
-            print("  /msg <消息内容> - 向所有客户端广播消息")
-            print("  /msg @用户名 <消息内容> - 向指定用户发送私信")
-            print("  /send <文件路径> - 向所有客户端广播文件")
-            print("  /send @用户名 <文件路径> - 向指定用户发送文件")
-            print("  /list - 显示在线用户列表")
-            print("  /user <用户名> - 显示用户详细信息")
-            print("  /help - 显示帮助信息")
-            print("  /quit - 关闭服务器")
+            self.print_commands()
             print("按 Ctrl+C 停止服务器\n")
             
             # 启动服务器输入处理线程
@@ -72,6 +125,9 @@ class ChatServer:
                     client_socket, address = self.socket.accept()
                     print(f"新客户端连接: {address}")
                     
+                    # 写线程自行合并小消息，关闭Nagle算法避免额外延迟
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    
                     # 为每个客户端创建处理线程
                     client_thread = threading.Thread(
                         target=self.handle_client,
@@ -94,16 +150,24 @@ class ChatServer:
         """停止服务器"""
         self.running = False
         
-        # 关闭所有客户端连接
-        with self.clients_lock:
-            for client_socket in list(self.clients.keys()):
-                try:
-                    client_socket.close()
-                except:
-                    pass
-            self.clients.clear()
+        # 关闭所有客户端连接（先移出登记表，关闭连接时不持有锁）
+        for client_socket, client_info in self.registry.clear():
+            try:
+                client_info["outbox"].close()
+                client_socket.close()
+            except:
+                pass
+        
+        if self.history is not None:
+            self.history.close()
+        self.search_index.close()
+        self.chat_log.close()
         
-        # 关闭服务器套接字
+        # 关闭服务器套接字（先 shutdown 唤醒阻塞在 accept 中的线程）
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         try:
             self.socket.close()
         except:
@@ -111,6 +175,18 @@ class ChatServer:
         
         print("服务器已关闭")
     
+    @staticmethod
+    def raise_open_file_limit():
+        """尽量提高进程可打开的文件描述符上限，以支持大量并发连接"""
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            target = hard if hard != resource.RLIM_INFINITY else 65536
+            if soft < target:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ImportError, ValueError, OSError):
+            pass
+    
     def handle_client(self, client_socket, address):
         """
         处理客户端连接
@@ -120,39 +196,24 @@ class ChatServer:
             address: 客户端地址
         """
         username = None
+        reader = FrameReader.for_socket(client_socket)
         
         try:
             # 等待客户端发送用户名
-            message = SocketUtils.receive_message(client_socket)
-            if not message or message.get("type") != MessageType.USER_JOIN:
-                print(f"客户端 {address} 未发送有效的用户名")
-                return
-            
-            username = message.get("data", f"User_{address[1]}")
-            
-            # 添加客户端到管理列表
-            with self.clients_lock:
-                self.clients[client_socket] = {
-                    "username": username,
-                    "address": address
-                }
+            message = reader.read_message()
             
-            print(f"用户 '{username}' 已加入聊天室 (来自 {address})")
-            
-            # 广播用户加入消息
-            self.broadcast_message(
-                MessageType.USER_JOIN,
-                f"用户 '{username}' 加入了聊天室",
-                exclude_socket=client_socket
-            )
+            # 并行上传的数据连接不加入聊天室
+            if message and message.get("type") == MessageType.DATA_CONNECT:
+                self.handle_data_connection(client_socket, reader, message)
+                return
             
-            # 发送欢迎消息给新用户
-            welcome_msg = f"欢迎加入聊天室！当前在线用户数: {len(self.clients)}"
-            SocketUtils.send_message(client_socket, MessageType.TEXT, welcome_msg)
+            username = self.register_client(client_socket, address, message)
+            if not username:
+                return
             
             # 处理客户端消息
             while self.running:
-                message = SocketUtils.receive_message(client_socket)
+                message = reader.read_message()
                 if not message:
                     break
                 
@@ -164,6 +225,116 @@ class ChatServer:
             # 客户端断开连接
             self.disconnect_client(client_socket, username)
     
+    def register_client(self, client_socket, address, message):
+        """
+        处理客户端的 USER_JOIN 握手并加入聊天室
+        
+        Args:
+            client_socket: 客户端套接字
+            address: 客户端地址
+            message: 客户端发送的第一条消息
+            
+        Returns:
+            用户名，握手无效返回None
+        """
+        if not message or message.get("type") != MessageType.USER_JOIN:
+            print(f"客户端 {address} 未发送有效的用户名")
+            return None
+        
+        username = message.get("data") or f"User_{address[1]}"
+        if not isinstance(username, str) or len(username) > self.MAX_USERNAME_LENGTH:
+            print(f"客户端 {address} 的用户名无效（须为不超过 {self.MAX_USERNAME_LENGTH} 个字符的字符串）")
+            return None
+        
+        # 协商协议特性（未声明特性的客户端使用原有协议）
+        metadata = message.get("metadata")
+        offered = metadata.get("features") if isinstance(metadata, dict) else None
+        features = SocketUtils.negotiate_features(offered)
+        if self.relay_mode == RelayMode.RELAY:
+            # 转发模式不在磁盘上保存文件，不提供并行上传，客户端改用控制连接上传
+            features -= {Feature.PARALLEL_UPLOAD}
+        
+        # 添加客户端到管理列表，此后发给该客户端的消息都经过它自己的出站队列
+        client_info = {
+            "username": username,
+            "address": address,
+            "features": features,
+            "outbox": self.create_outbox(client_socket)
+        }
+        self.registry.add(client_socket, client_info)
+        
+        print(f"用户 '{username}' 已加入聊天室 (来自 {address})")
+        self.log_event(MessageType.USER_JOIN, username, f"{address[0]}:{address[1]}")
+        
+        # 广播用户加入消息
+        self.broadcast_message(
+            MessageType.USER_JOIN,
+            f"用户 '{username}' 加入了聊天室",
+            exclude_socket=client_socket
+        )
+        
+        # 发送欢迎消息给新用户
+        welcome_msg = f"欢迎加入聊天室！当前在线用户数: {self.online_count()}"
+        welcome_metadata = None
+        if offered is not None:
+            welcome_metadata = {"features": SocketUtils.encode_features(features)}
+        self._send(client_socket, client_info, PreparedMessage(MessageType.TEXT, welcome_msg, welcome_metadata))
+        self.replay_history(client_info)
+        
+        return username
+    
+    def replay_history(self, client_info):
+        """
+        把最近的聊天消息作为一项放入新用户的出站队列，由写线程一次写出
+        
+        Args:
+            client_info: 客户端信息
+        """
+        if not self.history:
+            return
+        
+        frame = self.history.replay_frame(client_info["features"])
+        if frame:
+            client_info["outbox"].put(frame, wait=True)
+    
+    def record_history(self, message):
+        """
+        记录一条广播的聊天消息
+        
+        Args:
+            message: PreparedMessage（只记录 TEXT）
+        """
+        if self.history is not None and message.msg_type == MessageType.TEXT:
+            self.history.append(message)
+    
+    def log_event(self, msg_type, username, data):
+        """
+        写入聊天记录日志（写入失败只打印错误，不影响消息处理）
+        
+        Args:
+            msg_type: TEXT / USER_JOIN / USER_LEAVE
+            username: 用户名
+            data: 消息内容
+        """
+        try:
+            self.chat_log.append(msg_type, username, data)
+        except Exception as e:
+            print(f"写入聊天记录失败: {e}")
+    
+    def create_outbox(self, client_socket):
+        """
+        为客户端创建出站队列并启动写线程
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            出站队列
+        """
+        outbox = OutboundQueue(client_socket, self.outbound_queue_size, self.slow_consumer_policy)
+        outbox.start()
+        return outbox
+    
     def process_message(self, sender_socket, message, username):
         """
         处理客户端发送的消息
@@ -175,13 +346,24 @@ class ChatServer:
         """
         try:
             msg_type = message.get("type")
+            
+            # 带路由头的私信只按头部中的接收者转发，不解析消息体
+            if msg_type == MessageType.TEXT and message.get("peer"):
+                self.send_direct(sender_socket, username, message, message.get("peer"))
+                return
+            
             data = message.get("data", "")
             metadata = message.get("metadata", {})
             
-            if msg_type == MessageType.TEXT:
+            if msg_type == MessageType.TEXT and metadata.get("to"):
+                # 未协商路由头的客户端在元数据中指定私信接收者
+                self.send_direct(sender_socket, username, message, metadata["to"])
+            
+            elif msg_type == MessageType.TEXT:
                 # 处理文本消息
                 formatted_msg = format_message(username, data)
                 print(formatted_msg)
+                self.log_event(MessageType.TEXT, username, data)
                 
                 # 广播给其他客户端
                 self.broadcast_message(
@@ -190,6 +372,14 @@ class ChatServer:
                     exclude_socket=sender_socket
                 )
             
+            elif msg_type == MessageType.SEARCH:
+                # 搜索聊天记录，结果只回复给查询者
+                records = self.search_index.search(data)
+                self.send_to_socket(sender_socket, MessageType.SEARCH, self.format_search_results(data, records), {
+                    "query": data,
+                    "results": records
+                })
+            
             elif msg_type == MessageType.FILE:
                 # 处理文件传输开始
                 filename = metadata.get("filename", "unknown_file")
@@ -197,78 +387,279 @@ class ChatServer:
                 
                 print(f"用户 '{username}' 开始发送文件: {filename} ({file_size} 字节)")
                 
+                client_info = self.clients.get(sender_socket)
+                
+                # 定向上传：FILE、FILE_DATA、FILE_COMPLETE 只转发给指定的用户或群组
+                self.upload_targets.pop(sender_socket, None)
+                if metadata.get("to"):
+                    targets, missing = self.resolve_recipients(metadata["to"], exclude_socket=sender_socket)
+                    self.upload_targets[sender_socket] = targets
+                    print(f"🎯 定向发送给: {', '.join(info['username'] for _, info in targets) or '无在线接收者'}")
+                    if missing:
+                        self.send_to_socket(sender_socket, MessageType.ERROR,
+                                            f"以下用户不在线或不存在，不会收到文件: {', '.join(missing)}")
+                
+                # 大文件经多个数据连接并行上传，控制连接只回复传输令牌
+                if client_info and Feature.PARALLEL_UPLOAD in client_info["features"] and metadata.get("streams"):
+                    self.start_parallel_upload(sender_socket, client_info, filename, file_size,
+                                               username, int(metadata["streams"]))
+                    return
+                
+                # 协商了续传的客户端带有文件内容哈希
+                sha256 = None
+                if client_info and Feature.RESUME in client_info["features"]:
+                    sha256 = metadata.get("sha256")
+                
                 # 在服务器端保存文件的准备工作
-                self.prepare_file_reception(sender_socket, filename, file_size, username)
+                offset = self.prepare_file_reception(sender_socket, filename, file_size, username, sha256)
                 
-                # 转发文件信息给其他客户端
-                self.broadcast_message(
-                    MessageType.FILE,
-                    data,
-                    metadata,
-                    exclude_socket=sender_socket
-                )
+                if sha256:
+                    # 告诉客户端从哪里继续发送（服务器已有相同内容时为文件末尾，无需上传）
+                    self._send(sender_socket, client_info, PreparedMessage(MessageType.FILE_RESUME, "", {
+                        "filename": filename,
+                        "offset": offset or 0,
+                        "have_blob": self.is_blob_hit(sender_socket)
+                    }))
+                
+                if offset:
+                    # 其他客户端没有收到前半部分，接收完成后再整体转发
+                    print(f"🔁 从 {SocketUtils.format_file_size(offset)} 处续传，完成后转发给其他客户端")
+                else:
+                    # 转发文件信息给其他客户端
+                    self.relay_upload(sender_socket, MessageType.FILE, data, metadata)
             
             elif msg_type == MessageType.FILE_DATA:
-                # 保存文件数据到服务器
-                self.save_file_chunk(sender_socket, data)
+                # 确认请求只对发送方有效，不转发给接收方
+                ack = metadata.pop("ack", False)
+                
+                # 二进制帧直接携带原始字节，十六进制消息只解码一次；
+                # 只转发不保存且无需校验时十六进制数据原样转发，由需要原始字节的接收方按需解码
+                if isinstance(data, str) and metadata.get("crc32") is None and self.is_relay_only(sender_socket):
+                    chunk = data
+                else:
+                    chunk = SocketUtils.decode_chunk(data)
+                
+                # 数据块校验失败：停止接收该文件，不再转发
+                if not SocketUtils.verify_chunk(chunk, metadata):
+                    self.fail_file_reception(sender_socket, f"数据块 {metadata.get('chunk_index')} 校验失败")
+                    return
+                
+                # store 模式先写入磁盘再转发
+                if self.relay_mode == RelayMode.STORE:
+                    self.save_file_chunk(sender_socket, chunk)
                 
                 # 转发文件数据
-                self.broadcast_message(
-                    MessageType.FILE_DATA,
-                    data,
-                    metadata,
-                    exclude_socket=sender_socket
-                )
+                if self.is_relayed_live(sender_socket):
+                    self.relay_upload(sender_socket, MessageType.FILE_DATA, chunk, metadata)
+                
+                # relay 模式只统计进度，spool 模式交给后台线程写入
+                if self.relay_mode != RelayMode.STORE:
+                    self.save_file_chunk(sender_socket, chunk)
+                
+                # 数据块处理完（已写入或已放入接收方的出站队列）后确认，发送方据此测量往返时间和吞吐量
+                if ack:
+                    self.send_to_socket(sender_socket, MessageType.FILE_ACK, "", {
+                        "chunk_index": metadata.get("chunk_index"),
+                        "bytes_received": int(metadata.get("bytes_sent", 0) or 0) + SocketUtils.chunk_size(chunk)
+                    })
             
             elif msg_type == MessageType.FILE_COMPLETE:
                 # 文件传输完成
                 filename = metadata.get("filename", "unknown_file")
-                saved_path = self.complete_file_reception(sender_socket)
+                # 接收中已校验失败的文件已经通知过发送方
+                reported = self.file_transfers.get(sender_socket, {}).get("failed", False)
+                if metadata.get("token"):
+                    # 并行上传：所有区间都已写入才算完成，完成后整体转发
+                    relayed_live = False
+                    relay_only = False
+                    saved_path = self.complete_parallel_upload(sender_socket, metadata["token"], metadata.get("sha256"))
+                else:
+                    relayed_live = self.is_relayed_live(sender_socket)
+                    relay_only = self.is_relay_only(sender_socket)
+                    saved_path = self.complete_file_reception(sender_socket, metadata.get("sha256"))
                 
                 if saved_path:
                     print(f"✅ 用户 '{username}' 完成文件发送: {filename}")
                     print(f"📁 文件已保存到: {saved_path}")
+                elif relay_only and not reported:
+                    print(f"✅ 用户 '{username}' 完成文件发送: {filename}（仅转发，服务器未保存）")
                 else:
                     print(f"❌ 用户 '{username}' 文件发送失败: {filename}")
+                    if not reported:
+                        self.send_to_socket(sender_socket, MessageType.ERROR,
+                                            f"文件 '{filename}' 接收失败，请重新发送")
                 
-                # 转发完成信号
-                self.broadcast_message(
-                    MessageType.FILE_COMPLETE,
-                    data,
-                    metadata,
-                    exclude_socket=sender_socket
-                )
+                targets = self.upload_targets.pop(sender_socket, None)
+                if relayed_live:
+                    # 转发完成信号
+                    self.relay_upload(sender_socket, MessageType.FILE_COMPLETE, data, metadata, targets)
+                elif saved_path:
+                    # 续传完成的文件整体转发
+                    file_info = {
+                        "filename": filename,
+                        "size": os.path.getsize(saved_path),
+                        "sender": username
+                    }
+                    self.relay_stored_file(sender_socket, saved_path, file_info, targets)
             
         except Exception as e:
             print(f"处理消息时发生错误: {e}")
     
-    def broadcast_message(self, msg_type, data, metadata=None, exclude_socket=None):
+    def broadcast_message(self, msg_type, data, metadata=None, exclude_socket=None, wait=False):
         """
         广播消息给所有客户端
         
         Args:
             msg_type: 消息类型
-            data: 消息数据
+            data: 消息数据（FILE_DATA 为原始字节）
             metadata: 消息元数据
             exclude_socket: 排除的套接字（不发送给该套接字）
+            wait: 队列已满时是否等待（服务器主动发送文件时使用）
+        """
+        self.broadcast_prepared(PreparedMessage(msg_type, data, metadata), exclude_socket, wait)
+    
+    def broadcast_prepared(self, message, exclude_socket=None, wait=False):
+        """
+        广播预编码消息
+        
+        消息只编码一次（每种编码方式一次），各客户端的出站队列共享同一份帧，
+        由各自的写线程发送；锁只用于获取客户端快照。
+        队列未满的客户端先放入，已满的客户端再按慢客户端策略处理，
+        因此广播延迟不受最慢客户端影响。
+        
+        Args:
+            message: PreparedMessage
+            exclude_socket: 排除的套接字（不发送给该套接字）
+            wait: 队列已满时是否等待
+        """
+        self.deliver(message, self.get_client_snapshot(exclude_socket), wait)
+        self.record_history(message)
+    
+    def relay_upload(self, sender_socket, msg_type, data, metadata, targets=None):
+        """
+        转发客户端上传的文件消息（定向上传只发给指定接收者，否则广播）
+        
+        Args:
+            sender_socket: 发送者套接字
+            msg_type: FILE / FILE_DATA / FILE_COMPLETE
+            data: 消息数据
+            metadata: 消息元数据
+            targets: 接收者列表，未提供时按发送者当前的定向上传查找
+        """
+        if targets is None:
+            targets = self.upload_targets.get(sender_socket)
+        
+        message = PreparedMessage(msg_type, data, metadata)
+        if targets is None:
+            self.broadcast_prepared(message, exclude_socket=sender_socket)
+        else:
+            self.deliver(message, targets)
+    
+    def relay_stored_file(self, sender_socket, file_path, file_info, targets=None):
         """
-        with self.clients_lock:
-            disconnected_clients = []
+        在独立线程中转发已保存的上传文件，不阻塞发送者的消息处理
+        
+        Args:
+            sender_socket: 发送者套接字
+            file_path: 文件的存储路径
+            file_info: 文件信息（filename、size、sender）
+            targets: 接收者列表，None 表示除发送者外的所有客户端
+        """
+        if targets is None:
+            targets = self.get_client_snapshot(sender_socket)
+        relay_thread = threading.Thread(
+            target=self.send_stored_file,
+            args=(file_path, file_info, targets)
+        )
+        relay_thread.daemon = True
+        relay_thread.start()
+    
+    def resolve_recipients(self, names, exclude_socket=None):
+        """
+        解析接收者列表
+        
+        Args:
+            names: 逗号分隔的用户名或群组名（可带@前缀）
+            exclude_socket: 排除的套接字（发送者自己）
             
-            for client_socket in self.clients:
-                if client_socket == exclude_socket:
-                    continue
-                
-                try:
-                    SocketUtils.send_message(client_socket, msg_type, data, metadata)
-                except Exception as e:
-                    print(f"发送消息给客户端失败: {e}")
-                    disconnected_clients.append(client_socket)
+        Returns:
+            (在线接收者 [(客户端套接字, 客户端信息)], 不在线或不存在的用户名列表)
+        """
+        usernames = []
+        for name in names.split(','):
+            name = name.strip().lstrip('@')
+            if name:
+                usernames.extend(self.groups.get(name, [name]))
+        
+        targets = []
+        missing = []
+        for username in dict.fromkeys(usernames):
+            user_socket = self.find_user_socket(username)
+            client_info = self.get_client_info(user_socket) if user_socket else None
+            if client_info is None:
+                missing.append(username)
+            elif user_socket != exclude_socket:
+                targets.append((user_socket, client_info))
+        return targets, missing
+    
+    def get_client_snapshot(self, exclude_socket=None):
+        """
+        获取当前客户端列表的快照
+        
+        Args:
+            exclude_socket: 排除的套接字
+            
+        Returns:
+            (客户端套接字, 客户端信息) 序列（不可变，遍历时无需加锁）
+        """
+        snapshot = self.registry.snapshot()
+        if exclude_socket is None:
+            return snapshot
+        return [(client_socket, client_info) for client_socket, client_info in snapshot
+                if client_socket != exclude_socket]
+    
+    def deliver(self, message, targets, wait=False):
+        """
+        将预编码消息放入一组客户端的出站队列
+        
+        Args:
+            message: PreparedMessage
+            targets: (客户端套接字, 客户端信息) 列表
+            wait: 队列已满时是否等待
+        """
+        full_clients = []
+        disconnected_clients = []
+        
+        for client_socket, client_info in targets:
+            frame = message.frame(client_info["features"])
+            if not client_info["outbox"].offer(frame):
+                full_clients.append((client_socket, client_info, frame))
+        
+        for client_socket, client_info, frame in full_clients:
+            try:
+                client_info["outbox"].put(frame, wait)
+            except Exception as e:
+                print(f"发送消息给客户端失败: {e}")
+                disconnected_clients.append((client_socket, client_info["username"]))
+        
+        # 移除断开连接的客户端
+        for client_socket, username in disconnected_clients:
+            self.disconnect_client(client_socket, username)
+    
+    def _send(self, client_socket, client_info, message, wait=False):
+        """
+        将预编码消息放入客户端的出站队列
+        
+        Args:
+            client_socket: 客户端套接字
+            client_info: 客户端信息
+            message: PreparedMessage
+            wait: 队列已满时是否等待
             
-            # 移除断开连接的客户端
-            for client_socket in disconnected_clients:
-                username = self.clients.get(client_socket, {}).get("username", "Unknown")
-                self.disconnect_client(client_socket, username)
+        Returns:
+            是否已放入队列（DROP 策略下可能被丢弃）
+        """
+        return client_info["outbox"].put(message.frame(client_info["features"]), wait)
     
     def disconnect_client(self, client_socket, username):
         """
@@ -279,14 +670,20 @@ class ChatServer:
             username: 用户名
         """
         try:
-            with self.clients_lock:
-                if client_socket in self.clients:
-                    del self.clients[client_socket]
+            client_info = self.registry.remove(client_socket)
             
+            if client_info:
+                client_info["outbox"].close()
             client_socket.close()
             
-            if username:
+            self.abort_file_reception(client_socket)
+            self.abort_parallel_uploads(client_socket)
+            self.upload_targets.pop(client_socket, None)
+            
+            # 同一连接可能被读线程和广播同时断开，只广播一次离开消息
+            if username and client_info:
                 print(f"用户 '{username}' 已离开聊天室")
+                self.log_event(MessageType.USER_LEAVE, username, "")
                 
                 # 广播用户离开消息
                 self.broadcast_message(
@@ -298,8 +695,23 @@ class ChatServer:
     
     def get_online_users(self):
         """获取在线用户列表"""
-        with self.clients_lock:
-            return [client_info["username"] for client_info in self.clients.values()]
+        return [client_info["username"] for _, client_info in self.registry.snapshot()]
+    
+    def online_count(self):
+        """获取在线用户数"""
+        return len(self.registry)
+    
+    def get_client_info(self, client_socket):
+        """
+        获取连接对应的客户端信息
+        
+        Args:
+            client_socket: find_user_socket 返回的连接
+            
+        Returns:
+            客户端信息，不在线返回None
+        """
+        return self.registry.get(client_socket)
     
     def find_user_socket(self, username):
         """
@@ -311,13 +723,9 @@ class ChatServer:
         Returns:
             对应的套接字，如果未找到返回None
         """
-        with self.clients_lock:
-            for socket, client_info in self.clients.items():
-                if client_info["username"] == username:
-                    return socket
-        return None
+        return self.registry.find(username)
     
-    def send_to_user(self, username, msg_type, data, metadata=None):
+    def send_to_user(self, username, msg_type, data, metadata=None, wait=False):
         """
         向指定用户发送消息
         
@@ -326,6 +734,7 @@ class ChatServer:
             msg_type: 消息类型
             data: 消息数据
             metadata: 元数据
+            wait: 出站队列已满时是否等待
             
         Returns:
             是否发送成功
@@ -334,13 +743,78 @@ class ChatServer:
         if not user_socket:
             return False
         
+        return self.send_to_socket(user_socket, msg_type, data, metadata, wait)
+    
+    def send_direct(self, sender_socket, username, message, target):
+        """
+        转发客户端之间的私信
+        
+        接收方也协商了路由头时，把原消息体放入以发送者为对方用户名的路由帧，不解析也不重新编码；
+        否则取出消息内容，按服务器私信的格式发送。
+        
+        Args:
+            sender_socket: 发送者套接字
+            username: 发送者用户名
+            message: 私信消息（RoutedMessage 或消息字典）
+            target: 接收者用户名
+        """
+        target_socket = self.find_user_socket(target)
+        client_info = self.get_client_info(target_socket) if target_socket is not None else None
+        if not client_info:
+            self.send_to_socket(sender_socket, MessageType.ERROR, f"用户 '{target}' 不在线或不存在")
+            return
+        
+        if isinstance(message, RoutedMessage) and Feature.ROUTED_HEADER in client_info["features"]:
+            features = client_info["features"]
+            frame = message.relay_frame(username, Feature.ZLIB in features, Feature.COMPACT_CODEC in features)
+            client_info["outbox"].put(frame)
+        else:
+            private_msg = format_message(username, f"[私信] {message.get('data', '')}")
+            self._send(target_socket, client_info, PreparedMessage(MessageType.TEXT, private_msg))
+        print(f"✉️  用户 '{username}' 向 '{target}' 发送了私信")
+    
+    def send_to_socket(self, client_socket, msg_type, data, metadata=None, wait=False):
+        """
+        向指定连接发送消息
+        
+        Args:
+            client_socket: 客户端套接字
+            msg_type: 消息类型
+            data: 消息数据
+            metadata: 元数据
+            wait: 出站队列已满时是否等待
+            
+        Returns:
+            是否发送成功
+        """
+        client_info = self.get_client_info(client_socket)
+        if not client_info:
+            return False
+        
         try:
-            SocketUtils.send_message(user_socket, msg_type, data, metadata)
-            return True
+            return self._send(client_socket, client_info, PreparedMessage(msg_type, data, metadata), wait)
         except Exception as e:
-            print(f"向用户 {username} 发送消息失败: {e}")
+            print(f"向用户 {client_info['username']} 发送消息失败: {e}")
             return False
     
+    def print_commands(self):
+        """显示服务器管理命令"""
+        print("\n服务器管理命令:")
+        print("  /msg <消息内容> - 向所有客户端广播消息")
+        print("  /msg @用户名 <消息内容> - 向指定用户发送私信")
+        print("  /send <文件路径> - 向所有客户端广播文件")
+        print("  /send @用户名 <文件路径> - 向指定用户发送文件")
+        print("  /send @用户1,群组名 <文件路径> - 向多个用户或群组发送文件")
+        print("  /group - 显示所有群组")
+        print("  /group <群组名> <用户1,用户2> - 创建或修改群组（客户端可用 /send @群组名 发送文件）")
+        print("  /ungroup <群组名> - 删除群组")
+        print("  /list - 显示在线用户列表")
+        print("  /user <用户名> - 显示用户详细信息")
+        print("  /history <用户名|*> [起始时间] - 查询聊天记录（如 2h、7d、2024-01-31 08:00，默认最近24小时）")
+        print("  /search <关键词> - 搜索聊天消息")
+        print("  /help - 显示帮助信息")
+        print("  /quit - 关闭服务器")
+    
     def handle_server_input(self):
         """处理服务器管理员输入"""
         try:
@@ -370,15 +844,8 @@ class ChatServer:
                 self.stop()
                 
             elif command.lower() == '/help':
-                print("\n服务器管理命令:")
-                print("  /msg <消息内容> - 向所有客户端广播消息")
-                print("  /msg @用户名 <消息内容> - 向指定用户发送私信")
-                print("  /send <文件路径> - 向所有客户端广播文件")
-                print("  /send @用户名 <文件路径> - 向指定用户发送文件")
-                print("  /list - 显示在线用户列表")
-                print("  /user <用户名> - 显示用户详细信息")
-                print("  /help - 显示帮助信息")
-                print("  /quit - 关闭服务器\n")
+                self.print_commands()
+                print()
                 
             elif command.lower() == '/list':
                 self.show_online_users()
@@ -391,6 +858,26 @@ class ChatServer:
                 else:
                     print("请指定要查看的用户名: /user 用户名")
                 
+            elif command.lower().startswith('/history '):
+                # 查询聊天记录
+                parts = command[9:].strip().split(None, 1)
+                if parts:
+                    self.show_chat_log(parts[0], parts[1] if len(parts) == 2 else None)
+                else:
+                    print("格式: /history 用户名 [起始时间] (* 表示所有用户)")
+            
+            elif command.lower().startswith('/search '):
+                # 全文搜索聊天消息
+                query = command[8:].strip()
+                if query:
+                    started = time.perf_counter()
+                    records = self.search_index.search(query)
+                    elapsed = (time.perf_counter() - started) * 1000
+                    print(f"\n{self.format_search_results(query, records)}")
+                    print(f"  （用时 {elapsed:.1f} ms）\n")
+                else:
+                    print("格式: /search 关键词")
+            
             elif command.lower().startswith('/msg '):
                 # 发送消息给所有客户端或指定用户
                 message = command[5:].strip()
@@ -414,6 +901,7 @@ class ChatServer:
                         # 广播消息
                         server_msg = format_message("服务器", message)
                         print(server_msg)
+                        self.log_event(MessageType.TEXT, "服务器", message)
                         self.broadcast_message(MessageType.TEXT, server_msg)
                 else:
                     print("请输入要发送的消息内容")
@@ -437,8 +925,11 @@ class ChatServer:
                             elif file_path.startswith("'") and file_path.endswith("'"):
                                 file_path = file_path[1:-1]
                             
-                            # 发送给指定用户
-                            self.send_file_to_user(target_user, file_path)
+                            # 发送给指定用户，多个接收者或群组按组发送
+                            if ',' in target_user or target_user in self.groups:
+                                self.send_file_to_group(target_user, file_path)
+                            else:
+                                self.send_file_to_user(target_user, file_path)
                         else:
                             print("定向发送格式: /send @用户名 文件路径")
                     else:
@@ -456,6 +947,26 @@ class ChatServer:
                     print("格式: /send 文件路径 (广播)")
                     print("格式: /send @用户名 文件路径 (定向发送)")
                     
+            elif command.lower() == '/group':
+                self.show_groups()
+            
+            elif command.lower().startswith('/group '):
+                # 创建或修改群组
+                parts = command[7:].split(None, 1)
+                if len(parts) == 2:
+                    members = [name.strip().lstrip('@') for name in parts[1].split(',') if name.strip()]
+                    self.groups[parts[0]] = members
+                    print(f"✅ 群组 '{parts[0]}': {', '.join(members)}")
+                else:
+                    print("群组格式: /group 群组名 用户1,用户2")
+            
+            elif command.lower().startswith('/ungroup '):
+                group_name = command[9:].strip()
+                if self.groups.pop(group_name, None) is not None:
+                    print(f"✅ 已删除群组 '{group_name}'")
+                else:
+                    print(f"❌ 群组 '{group_name}' 不存在")
+            
             elif command.startswith('/'):
                 print(f"未知命令: {command}，输入 /help 查看可用命令")
                 
@@ -490,28 +1001,61 @@ class ChatServer:
                 "sender": "服务器"
             }
             
-            self.broadcast_message(MessageType.FILE, "", file_info)
+            self.send_stored_file(file_path, file_info, self.get_client_snapshot())
+        
+        except Exception as e:
+            print(f"发送文件失败: {e}")
+    
+    def send_stored_file(self, file_path, file_info, targets):
+        """
+        向一组客户端发送服务器上的文件（出站队列已满时等待）
+        
+        Args:
+            file_path: 文件路径
+            file_info: 文件信息（filename、size、sender）
+            targets: (客户端套接字, 客户端信息) 列表
+        """
+        try:
+            filename = file_info["filename"]
+            file_size = file_info["size"]
+            
+            # 支持原始字节流的客户端：FILE 头之后由写线程用 sendfile 直接发送文件内容
+            raw_targets = [target for target in targets if Feature.RAW_STREAM in target[1]["features"]]
+            chunk_targets = [target for target in targets if Feature.RAW_STREAM not in target[1]["features"]]
+            
+            if raw_targets:
+                self.send_raw_file(raw_targets, file_path, file_info)
+                print(f"已通过 sendfile 向 {len(raw_targets)} 个客户端排队发送")
             
-            # 发送文件数据
+            if not chunk_targets:
+                print(f"文件 '{filename}' 发送完成")
+                return
+            
+            # 其余客户端按数据块发送
+            self.deliver(PreparedMessage(MessageType.FILE, "", file_info), chunk_targets, wait=True)
+            
+            # 发送文件数据（数据块大小按出站队列的实际发送速度调整，未协商自适应分块的接收方收到拆分后的数据块）
             import time
             start_time = time.time()
             last_update_time = start_time
+            controller = TransferController(SocketUtils.get_optimal_buffer_size(file_size), acked=False)
             
             with open(file_path, 'rb') as f:
                 bytes_sent = 0
                 chunk_count = 0
                 
                 while bytes_sent < file_size:
-                    chunk = f.read(SocketUtils.BUFFER_SIZE)
+                    chunk = f.read(controller.chunk_size)
                     if not chunk:
                         break
                     
                     # 发送文件数据块
-                    self.broadcast_message(MessageType.FILE_DATA, chunk.hex(), {
+                    controller.on_sent(chunk_count, bytes_sent, len(chunk))
+                    self.deliver(PreparedMessage(MessageType.FILE_DATA, chunk, {
                         "bytes_sent": bytes_sent,
                         "total_size": file_size,
                         "chunk_index": chunk_count
-                    })
+                    }), chunk_targets, wait=True)
                     
                     bytes_sent += len(chunk)
                     chunk_count += 1
@@ -532,10 +1076,10 @@ class ChatServer:
                             last_update_time = current_time
             
             # 发送文件传输完成信号
-            self.broadcast_message(MessageType.FILE_COMPLETE, "", {
+            self.deliver(PreparedMessage(MessageType.FILE_COMPLETE, "", {
                 "filename": filename,
                 "total_size": file_size
-            })
+            }), chunk_targets, wait=True)
             
             print(f"\n文件 '{filename}' 发送完成")
             
@@ -577,27 +1121,40 @@ class ChatServer:
                 "sender": "服务器"
             }
             
-            if not self.send_to_user(username, MessageType.FILE, "", file_info):
+            client_info = self.get_client_info(user_socket)
+            if client_info and Feature.RAW_STREAM in client_info["features"]:
+                if self.send_raw_file([(user_socket, client_info)], file_path, file_info):
+                    print(f"✅ 文件 '{filename}' 已通过 sendfile 排队发送给用户 '{username}'")
+                else:
+                    print(f"❌ 向用户 '{username}' 发送文件失败")
+                return
+            
+            if not self.send_to_user(username, MessageType.FILE, "", file_info, wait=True):
                 print(f"❌ 向用户 '{username}' 发送文件信息失败")
                 return
             
-            # 发送文件数据
+            # 发送文件数据（数据块大小按出站队列的实际发送速度调整）
+            controller = TransferController(SocketUtils.get_optimal_buffer_size(file_size), acked=False)
             with open(file_path, 'rb') as f:
                 bytes_sent = 0
+                chunk_count = 0
                 while bytes_sent < file_size:
-                    chunk = f.read(SocketUtils.BUFFER_SIZE)
+                    chunk = f.read(controller.chunk_size)
                     if not chunk:
                         break
                     
                     # 发送文件数据块
-                    if not self.send_to_user(username, MessageType.FILE_DATA, chunk.hex(), {
+                    controller.on_sent(chunk_count, bytes_sent, len(chunk))
+                    if not self.send_to_user(username, MessageType.FILE_DATA, chunk, {
                         "bytes_sent": bytes_sent,
-                        "total_size": file_size
-                    }):
+                        "total_size": file_size,
+                        "chunk_index": chunk_count
+                    }, wait=True):
                         print(f"❌ 向用户 '{username}' 发送文件数据失败")
                         return
                     
                     bytes_sent += len(chunk)
+                    chunk_count += 1
                     
                     # 显示进度
                     if file_size > 0:
@@ -608,7 +1165,7 @@ class ChatServer:
             if self.send_to_user(username, MessageType.FILE_COMPLETE, "", {
                 "filename": filename,
                 "total_size": file_size
-            }):
+            }, wait=True):
                 print(f"\n✅ 文件 '{filename}' 已成功发送给用户 '{username}'")
             else:
                 print(f"\n❌ 向用户 '{username}' 发送文件完成信号失败")
@@ -616,16 +1173,97 @@ class ChatServer:
         except Exception as e:
             print(f"❌ 向用户发送文件失败: {e}")
     
+    def send_file_to_group(self, names, file_path):
+        """
+        向多个用户或群组发送文件
+        
+        Args:
+            names: 逗号分隔的用户名或群组名
+            file_path: 文件路径
+        """
+        try:
+            if not os.path.isfile(file_path):
+                print(f"❌ 文件不存在或不是文件: {file_path}")
+                return
+            
+            targets, missing = self.resolve_recipients(names)
+            if missing:
+                print(f"⚠️ 以下用户不在线或不存在: {', '.join(missing)}")
+            if not targets:
+                print("❌ 没有在线的接收者")
+                return
+            
+            file_info = {
+                "filename": os.path.basename(file_path),
+                "size": os.path.getsize(file_path),
+                "sender": "服务器"
+            }
+            
+            print(f"📤 开始向 {', '.join(info['username'] for _, info in targets)} 发送文件: "
+                  f"{file_info['filename']} ({file_info['size']} 字节)")
+            self.send_stored_file(file_path, file_info, targets)
+        
+        except Exception as e:
+            print(f"❌ 向群组发送文件失败: {e}")
+    
+    def send_raw_file(self, targets, file_path, file_info):
+        """
+        以原始字节流向一组客户端发送文件
+        
+        FILE 头的 metadata 中带有 raw_stream 标记，随后的 size 字节是不带帧头的文件内容，
+        最后是 FILE_COMPLETE。三者作为一个整体放入出站队列，文件内容由写线程用 sendfile 发送。
+        
+        Args:
+            targets: (客户端套接字, 客户端信息) 列表，客户端须已协商 raw_stream 特性
+            file_path: 文件路径
+            file_info: 文件信息（filename、size、sender）
+            
+        Returns:
+            是否全部放入队列
+        """
+        header = PreparedMessage(MessageType.FILE, "", dict(file_info, raw_stream=True))
+        complete = PreparedMessage(MessageType.FILE_COMPLETE, "", {
+            "filename": file_info["filename"],
+            "total_size": file_info["size"]
+        })
+        
+        success = True
+        for client_socket, client_info in targets:
+            features = client_info["features"]
+            try:
+                client_info["outbox"].put_sequence([
+                    header.frame(features),
+                    FileRegion(file_path, 0, file_info["size"]),
+                    complete.frame(features)
+                ])
+            except Exception as e:
+                print(f"发送文件给客户端失败: {e}")
+                self.disconnect_client(client_socket, client_info["username"])
+                success = False
+        return success
+    
+    def show_groups(self):
+        """显示所有群组及在线成员数"""
+        if not self.groups:
+            print("当前没有群组，使用 /group 群组名 用户1,用户2 创建")
+            return
+        
+        online = set(self.get_online_users())
+        print(f"\n群组 ({len(self.groups)} 个):")
+        for group_name, members in self.groups.items():
+            online_count = sum(1 for member in members if member in online)
+            print(f"  {group_name}: {', '.join(members)} ({online_count}/{len(members)} 在线)")
+        print()
+    
     def show_online_users(self):
         """显示在线用户详细信息"""
-        with self.clients_lock:
-            users_info = []
-            for socket, client_info in self.clients.items():
-                users_info.append({
-                    'username': client_info['username'],
-                    'address': client_info['address'],
-                    'socket': socket
-                })
+        users_info = []
+        for socket, client_info in self.registry.snapshot():
+            users_info.append({
+                'username': client_info['username'],
+                'address': client_info['address'],
+                'socket': socket
+            })
         
         print(f"\n📋 在线用户列表 ({len(users_info)}):")
         if users_info:
@@ -644,25 +1282,78 @@ class ChatServer:
             username: 用户名
         """
         user_socket = self.find_user_socket(username)
-        if user_socket:
-            with self.clients_lock:
-                client_info = self.clients.get(user_socket)
-                if client_info:
-                    print(f"\n👤 用户信息:")
-                    print(f"  用户名: {client_info['username']}")
-                    print(f"  IP地址: {client_info['address'][0]}")
-                    print(f"  端口: {client_info['address'][1]}")
-                    print(f"  连接状态: 在线")
-                    
-                    # 检查是否有正在进行的文件传输
-                    if user_socket in self.file_transfers:
-                        transfer_info = self.file_transfers[user_socket]
-                        progress = (transfer_info['received'] / transfer_info['expected_size']) * 100 if transfer_info['expected_size'] > 0 else 0
-                        print(f"  文件传输: 正在接收 {transfer_info['filename']} ({progress:.1f}%)")
-                    
-                    print()
+        client_info = self.get_client_info(user_socket) if user_socket else None
+        if client_info:
+            print(f"\n👤 用户信息:")
+            print(f"  用户名: {client_info['username']}")
+            print(f"  IP地址: {client_info['address'][0]}")
+            print(f"  端口: {client_info['address'][1]}")
+            print(f"  连接状态: 在线")
+            
+            # 检查是否有正在进行的文件传输
+            transfer_info = self.file_transfers.get(user_socket)
+            if transfer_info:
+                progress = (transfer_info['received'] / transfer_info['expected_size']) * 100 if transfer_info['expected_size'] > 0 else 0
+                print(f"  文件传输: 正在接收 {transfer_info['filename']} ({progress:.1f}%)")
+            
+            print()
         else:
             print(f"❌ 用户 '{username}' 不在线或不存在")
+            similar_users = self.find_users_by_pattern(username)
+            if similar_users:
+                print(f"   相似的在线用户: {', '.join(similar_users[:10])}")
+    
+    def show_chat_log(self, username, since_text=None, limit=100):
+        """
+        显示聊天记录的查询结果
+        
+        Args:
+            username: 用户名，* 表示所有用户
+            since_text: 起始时间（相对时间如 2h、7d，或日期时间），None 表示最近24小时
+            limit: 最多显示的记录数
+        """
+        since = parse_time(since_text) if since_text else time.time() - 86400
+        if since is None:
+            print(f"❌ 无法识别的时间: {since_text}（示例: 30m、2h、7d、2024-01-31、2024-01-31 08:00）")
+            return
+        
+        started = time.perf_counter()
+        records = self.chat_log.query(None if username == '*' else username, since, limit=limit)
+        elapsed = (time.perf_counter() - started) * 1000
+        
+        who = "所有用户" if username == '*' else f"用户 '{username}'"
+        print(f"\n📜 {who}自 {datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M:%S')} 起的聊天记录 "
+              f"({len(records)} 条，用时 {elapsed:.1f} ms):")
+        for record in records:
+            stamp = datetime.fromtimestamp(record["time"]).strftime('%Y-%m-%d %H:%M:%S')
+            if record["type"] == MessageType.USER_JOIN:
+                print(f"  [{stamp}] {record['user']} 加入了聊天室 ({record['data']})")
+            elif record["type"] == MessageType.USER_LEAVE:
+                print(f"  [{stamp}] {record['user']} 离开了聊天室")
+            else:
+                print(f"  [{stamp}] {record['user']}: {record['data']}")
+        if len(records) >= limit:
+            print(f"  （只显示前 {limit} 条，可指定更晚的起始时间）")
+        print()
+    
+    def format_search_results(self, query, records):
+        """
+        把搜索结果格式化为文本
+        
+        Args:
+            query: 查询文本
+            records: SearchIndex.search 返回的记录（最新的在前）
+            
+        Returns:
+            多行文本
+        """
+        lines = [f"🔍 搜索 '{query}' 找到 {len(records)} 条消息:"]
+        for record in records:
+            stamp = datetime.fromtimestamp(record["time"]).strftime('%Y-%m-%d %H:%M:%S')
+            lines.append(f"  [{stamp}] {record['user']}: {record['data']}")
+        if not records:
+            lines.append("  没有匹配的消息")
+        return "\n".join(lines)
     
     def find_users_by_pattern(self, pattern):
         """
@@ -672,17 +1363,11 @@ class ChatServer:
             pattern: 搜索模式
             
         Returns:
-            匹配的用户名列表
+            用户名包含该模式（不区分大小写）的用户名列表
         """
-        with self.clients_lock:
-            matching_users = []
-            for client_info in self.clients.values():
-                username = client_info['username']
-                if pattern.lower() in username.lower():
-                    matching_users.append(username)
-            return matching_users
+        return self.registry.search(pattern)
     
-    def prepare_file_reception(self, client_socket, filename, file_size, username):
+    def prepare_file_reception(self, client_socket, filename, file_size, username, sha256=None):
         """
         准备接收文件
         
@@ -691,51 +1376,169 @@ class ChatServer:
             filename: 文件名
             file_size: 文件大小
             username: 发送者用户名
+            sha256: 文件内容的SHA-256（客户端支持续传时提供）
+            
+        Returns:
+            开始接收的位置（续传时为已接收的字节数），失败返回None
         """
         try:
-            import time
+            # 只转发不保存：不打开文件，也不做去重和续传
+            if self.relay_mode == RelayMode.RELAY:
+                self.file_transfers[client_socket] = self.new_transfer_info(filename, file_size, username)
+                return 0
+            
             # 确保接收目录存在
             os.makedirs(self.files_dir, exist_ok=True)
             
-            # 生成唯一的文件路径
-            base_name, ext = os.path.splitext(filename)
-            file_path = os.path.join(self.files_dir, f"{username}_{filename}")
+            # 客户端给出的哈希不合法时按没有哈希处理（不去重、不续传）
+            if sha256 and not BlobStore.is_valid_hash(sha256):
+                print(f"⚠️ 用户 '{username}' 的文件 '{filename}' 带有无效的内容哈希，按普通上传接收")
+                sha256 = None
+            
+            # 服务器已有相同内容：只登记上传记录，客户端无需发送数据
+            if sha256 and self.blob_store.has_blob(sha256, file_size):
+                print(f"📦 用户 '{username}' 的文件 '{filename}' 已存在于服务器，跳过上传")
+                self.file_transfers[client_socket] = self.new_transfer_info(
+                    filename, file_size, username,
+                    file_path=self.blob_store.blob_path(sha256),
+                    blob_sha256=sha256,
+                    expected_sha256=sha256,
+                    received=file_size,
+                    resumed_from=file_size,
+                    relay_live=False
+                )
+                return file_size
             
-            # 如果文件已存在，添加数字后缀
-            counter = 1
-            while os.path.exists(file_path):
-                file_path = os.path.join(self.files_dir, f"{username}_{base_name}_{counter}{ext}")
-                counter += 1
+            # 查找同一文件未完成的上传（同一文件正在另一个连接上传时不续传）
+            resume_key = None
+            entry = None
+            if sha256:
+                resume_key = ResumeIndex.make_key(username, filename, file_size, sha256)
+                if not any(transfer.get("resume_key") == resume_key for transfer in self.file_transfers.values()):
+                    entry = self.resume_index.lookup(resume_key)
             
-            # 打开文件准备写入
-            file_handle = open(file_path, 'wb')
+            if entry:
+                # 打开部分文件，丢弃可能不完整的尾部后继续写入
+                file_path = entry["file_path"]
+                offset = entry["received"]
+                file_handle = open(file_path, 'r+b')
+                file_handle.truncate(offset)
+                file_handle.seek(offset)
+            else:
+                # 先写入临时文件，接收完成后按内容存入 BlobStore
+                file_path = self.blob_store.new_temp_path()
+                
+                # 打开文件准备写入
+                offset = 0
+                file_handle = open(file_path, 'wb')
+                
+                if resume_key:
+                    self.resume_index.add(resume_key, file_path, username, filename, file_size, sha256)
             
             print(f"📥 开始接收文件: {filename}")
             print(f"👤 发送者: {username}")
             print(f"📊 文件大小: {SocketUtils.format_file_size(file_size)}")
             
-            self.file_transfers[client_socket] = {
-                "file_handle": file_handle,
-                "filename": filename,
-                "file_path": file_path,
-                "expected_size": file_size,
-                "received": 0,
-                "username": username,
-                "start_time": time.time(),
-                "last_update": time.time(),
-                "chunk_count": 0
-            }
+            self.file_transfers[client_socket] = self.new_transfer_info(
+                filename, file_size, username,
+                file_handle=file_handle,
+                file_path=file_path,
+                expected_sha256=sha256,
+                # 从头接收时边写边计算摘要；续传的文件在完成时读取一次
+                hasher=StreamHasher(file_size) if offset == 0 else None,
+                received=offset,
+                resumed_from=offset,
+                resume_key=resume_key,
+                relay_live=offset == 0  # 续传的文件接收完成后才转发
+            )
             
+            return offset
+        
         except Exception as e:
             print(f"准备文件接收失败: {e}")
+            return None
+    
+    def new_transfer_info(self, filename, file_size, username, **fields):
+        """
+        创建文件接收信息
+        
+        Args:
+            filename: 文件名
+            file_size: 文件大小
+            username: 发送者用户名
+            **fields: 覆盖默认值的字段（默认为只转发不保存）
+            
+        Returns:
+            接收信息字典
+        """
+        import time
+        transfer_info = {
+            "file_handle": None,
+            "filename": filename,
+            "file_path": None,  # relay 模式下不保存文件
+            "blob_sha256": None,
+            "expected_sha256": None,
+            "hasher": None,
+            "failed": False,
+            "expected_size": file_size,
+            "received": 0,
+            "resumed_from": 0,
+            "resume_key": None,
+            "relay_live": True,
+            "username": username,
+            "start_time": time.time(),
+            "last_update": time.time(),
+            "chunk_count": 0
+        }
+        transfer_info.update(fields)
+        return transfer_info
+    
+    def is_relayed_live(self, client_socket):
+        """
+        客户端正在上传的文件是否边接收边转发
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            是否实时转发（没有接收记录时按原方式转发）
+        """
+        transfer_info = self.file_transfers.get(client_socket)
+        return transfer_info is None or (transfer_info["relay_live"] and not transfer_info["failed"])
+    
+    def is_relay_only(self, client_socket):
+        """
+        客户端正在上传的文件是否只转发不保存（relay 模式）
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            是否只转发
+        """
+        transfer_info = self.file_transfers.get(client_socket)
+        return bool(transfer_info and transfer_info["file_path"] is None)
     
-    def save_file_chunk(self, client_socket, hex_data):
+    def is_blob_hit(self, client_socket):
+        """
+        客户端正在上传的文件是否已存在于服务器（无需上传）
+        
+        Args:
+            client_socket: 客户端套接字
+            
+        Returns:
+            是否已存在
+        """
+        transfer_info = self.file_transfers.get(client_socket)
+        return bool(transfer_info and transfer_info["blob_sha256"])
+    
+    def save_file_chunk(self, client_socket, chunk):
         """
         保存文件数据块
         
         Args:
             client_socket: 客户端套接字
-            hex_data: 十六进制编码的文件数据
+            chunk: 文件数据（原始字节，relay 模式下可能是未解码的十六进制字符串）
         """
         try:
             import time
@@ -743,13 +1546,19 @@ class ChatServer:
                 return
             
             transfer_info = self.file_transfers[client_socket]
-            file_handle = transfer_info["file_handle"]
+            if transfer_info["blob_sha256"] or transfer_info["failed"]:
+                return
             
-            # 将十六进制数据转换为字节
-            chunk = bytes.fromhex(hex_data)
-            file_handle.write(chunk)
+            file_handle = transfer_info["file_handle"]
+            if file_handle is not None:
+                if self.spool:
+                    self.spool.write(transfer_info, chunk)
+                else:
+                    file_handle.write(chunk)
+                    if transfer_info["hasher"]:
+                        transfer_info["hasher"].update(chunk)
             
-            transfer_info["received"] += len(chunk)
+            transfer_info["received"] += len(chunk) // 2 if isinstance(chunk, str) else len(chunk)
             transfer_info["chunk_count"] += 1
             
             # 显示接收进度（每0.1秒更新一次）
@@ -761,7 +1570,7 @@ class ChatServer:
                 elapsed_time = current_time - transfer_info["start_time"]
                 
                 if elapsed_time > 0:
-                    speed = transfer_info["received"] / elapsed_time
+                    speed = (transfer_info["received"] - transfer_info["resumed_from"]) / elapsed_time
                     speed_str = SocketUtils.format_transfer_speed(speed)
                     progress_bar = SocketUtils.create_progress_bar(progress)
                     
@@ -773,15 +1582,16 @@ class ChatServer:
         except Exception as e:
             print(f"保存文件数据块失败: {e}")
     
-    def complete_file_reception(self, client_socket):
+    def complete_file_reception(self, client_socket, expected_sha256=None):
         """
         完成文件接收
         
         Args:
             client_socket: 客户端套接字
+            expected_sha256: 发送方在 FILE_COMPLETE 中给出的整个文件的SHA-256
             
         Returns:
-            保存的文件路径，失败返回None
+            保存的文件路径，失败（包括校验不通过）返回None
         """
         try:
             import time
@@ -790,35 +1600,366 @@ class ChatServer:
             
             transfer_info = self.file_transfers[client_socket]
             file_handle = transfer_info["file_handle"]
-            file_path = transfer_info["file_path"]
+            
+            # 等待后台线程写完此前的数据块
+            if self.spool and file_handle is not None:
+                self.spool.flush()
+            
+            # 接收过程中校验失败：按中断处理，可续传的部分文件保留
+            if transfer_info["failed"]:
+                self.abort_file_reception(client_socket)
+                return None
             
             # 计算传输统计
             end_time = time.time()
             total_time = end_time - transfer_info["start_time"]
             
-            # 关闭文件
-            file_handle.close()
+            if transfer_info["file_path"] is None:
+                # 只转发不保存
+                file_path = None
+            elif transfer_info["blob_sha256"]:
+                # 服务器已有相同内容，只登记上传记录
+                file_path = transfer_info["file_path"]
+                self.blob_store.record(transfer_info["username"], transfer_info["filename"],
+                                       transfer_info["blob_sha256"], transfer_info["expected_size"])
+            else:
+                file_handle.close()
+                
+                # 从头接收的文件摘要已增量算好，续传的文件只在这里读取一次
+                if transfer_info["hasher"]:
+                    sha256 = transfer_info["hasher"].hexdigest()
+                else:
+                    sha256 = SocketUtils.file_sha256(transfer_info["file_path"])
+                
+                expected_sha256 = expected_sha256 or transfer_info["expected_sha256"]
+                if expected_sha256 and expected_sha256 != sha256:
+                    print(f"\n❌ 文件 '{transfer_info['filename']}' 校验失败: SHA-256 不一致")
+                    del self.file_transfers[client_socket]
+                    self.blob_store.discard(transfer_info["file_path"])
+                    if transfer_info["resume_key"]:
+                        self.resume_index.remove(transfer_info["resume_key"])
+                    return None
+                
+                # 按内容存入 BlobStore（相同内容只保存一份）
+                file_path = self.blob_store.commit(transfer_info["file_path"], transfer_info["username"],
+                                                   transfer_info["filename"], sha256)
             
             # 显示传输统计
             print()  # 换行，结束进度显示
             print(f"✅ 文件接收完成: {transfer_info['filename']}")
-            print(f"💾 保存位置: {file_path}")
+            if file_path:
+                print(f"💾 保存位置: {file_path}")
             print(f"⏱️  接收时间: {SocketUtils.format_time(total_time)}")
             
             if total_time > 0:
-                avg_speed = transfer_info["received"] / total_time
+                avg_speed = (transfer_info["received"] - transfer_info["resumed_from"]) / total_time
                 print(f"🚀 平均速度: {SocketUtils.format_transfer_speed(avg_speed)}")
             
             print(f"📦 数据块数: {transfer_info['chunk_count']}")
             
             # 清理传输信息
             del self.file_transfers[client_socket]
+            if transfer_info["resume_key"]:
+                self.resume_index.remove(transfer_info["resume_key"])
             
             return file_path
             
         except Exception as e:
             print(f"完成文件接收失败: {e}")
             return None
+    
+    def fail_file_reception(self, client_socket, reason):
+        """
+        标记正在接收的文件校验失败并通知发送方（该文件剩余的数据块被忽略）
+        
+        Args:
+            client_socket: 客户端套接字
+            reason: 失败原因
+        """
+        transfer_info = self.file_transfers.get(client_socket)
+        if not transfer_info or transfer_info["failed"]:
+            return
+        
+        transfer_info["failed"] = True
+        print(f"\n❌ 文件 '{transfer_info['filename']}' 接收失败: {reason}")
+        self.send_to_socket(client_socket, MessageType.ERROR, f"文件 '{transfer_info['filename']}' {reason}，请重新发送")
+    
+    def abort_file_reception(self, client_socket):
+        """
+        连接断开时关闭未完成的文件（可续传的部分文件保留在续传索引中）
+        
+        Args:
+            client_socket: 客户端套接字
+        """
+        transfer_info = self.file_transfers.pop(client_socket, None)
+        if not transfer_info:
+            return
+        
+        # 等待后台线程写完此前的数据块
+        if self.spool and transfer_info["file_handle"] is not None:
+            self.spool.flush()
+        
+        if transfer_info["hasher"]:
+            transfer_info["hasher"].close()
+        
+        if transfer_info["file_handle"] is None:
+            return
+        
+        try:
+            transfer_info["file_handle"].close()
+        except OSError as e:
+            print(f"关闭未完成的文件失败: {e}")
+        
+        print()  # 换行，结束进度显示
+        if transfer_info["resume_key"]:
+            print(f"⏸️  文件 '{transfer_info['filename']}' 上传中断，"
+                  f"已接收 {SocketUtils.format_file_size(transfer_info['received'])}，可断点续传")
+        else:
+            # 无法续传的临时文件没有保留价值
+            self.blob_store.discard(transfer_info["file_path"])
+            print(f"❌ 文件 '{transfer_info['filename']}' 上传中断")
+    
+    
+    def start_parallel_upload(self, client_socket, client_info, filename, file_size, username, streams):
+        """
+        开始并行上传：预分配文件，划分区间，并在控制连接上回复传输令牌
+        
+        Args:
+            client_socket: 控制连接（聊天连接）
+            client_info: 客户端信息
+            filename: 文件名
+            file_size: 客户端声明的文件大小
+            username: 发送者用户名
+            streams: 客户端请求的数据连接数
+        """
+        import time
+        try:
+            # 声明的大小决定预分配的磁盘空间，签发令牌前先检查
+            if (not isinstance(file_size, int) or isinstance(file_size, bool)
+                    or not 0 <= file_size <= self.MAX_UPLOAD_SIZE):
+                print(f"拒绝并行接收 {filename}: 文件大小无效 ({file_size})")
+                self._send(client_socket, client_info, PreparedMessage(MessageType.ERROR,
+                    f"文件大小无效或超过上限 {SocketUtils.format_file_size(self.MAX_UPLOAD_SIZE)}: {filename}"))
+                return
+            
+            if shutil.disk_usage(self.blob_store.temp_dir).free < file_size:
+                print(f"拒绝并行接收 {filename}: 磁盘空间不足")
+                self._send(client_socket, client_info, PreparedMessage(MessageType.ERROR,
+                    f"服务器磁盘空间不足，无法接收文件: {filename}"))
+                return
+            
+            file_path = self.blob_store.new_temp_path()
+            
+            # 预分配文件，各数据连接直接写入自己的区间
+            with open(file_path, 'wb') as f:
+                if hasattr(os, 'posix_fallocate') and file_size > 0:
+                    os.posix_fallocate(f.fileno(), 0, file_size)
+                else:
+                    f.truncate(file_size)
+            
+            token = secrets.token_hex(16)
+            ranges = SocketUtils.split_ranges(file_size, streams)
+            with self.parallel_lock:
+                self.parallel_uploads[token] = {
+                    "client_socket": client_socket,
+                    "filename": filename,
+                    "file_path": file_path,
+                    "size": file_size,
+                    "username": username,
+                    "ranges": dict(ranges),  # {偏移: 长度}
+                    "claimed": set(),
+                    "done": set(),
+                    "start_time": time.time()
+                }
+            
+            print(f"📥 开始并行接收文件: {filename}")
+            print(f"👤 发送者: {username}")
+            print(f"📊 文件大小: {SocketUtils.format_file_size(file_size)}，{len(ranges)} 个数据连接")
+            
+            self._send(client_socket, client_info, PreparedMessage(MessageType.TRANSFER_TOKEN, "", {
+                "filename": filename,
+                "token": token,
+                "ranges": [list(item) for item in ranges]
+            }))
+        
+        except Exception as e:
+            print(f"准备并行接收失败: {e}")
+            self._send(client_socket, client_info, PreparedMessage(MessageType.ERROR, f"服务器无法接收文件: {filename}"))
+    
+    def claim_data_range(self, message):
+        """
+        校验数据连接的令牌和区间
+        
+        Args:
+            message: 数据连接发送的 DATA_CONNECT 消息
+            
+        Returns:
+            (传输信息, 偏移, 长度, 区间的CRC32)，令牌无效或区间已被占用返回None；
+            客户端未协商完整性校验时CRC32为None
+        """
+        metadata = message.get("metadata", {})
+        token = metadata.get("token")
+        try:
+            offset = int(metadata.get("offset"))
+            length = int(metadata.get("length"))
+            expected_crc = int(metadata["crc32"]) if metadata.get("crc32") is not None else None
+        except (TypeError, ValueError):
+            return None
+        
+        with self.parallel_lock:
+            transfer = self.parallel_uploads.get(token)
+            if not transfer or transfer["ranges"].get(offset) != length or offset in transfer["claimed"]:
+                return None
+            transfer["claimed"].add(offset)
+            return transfer, offset, length, expected_crc
+    
+    @staticmethod
+    def write_at(fd, data, offset):
+        """
+        把数据写入文件的指定位置
+        
+        Args:
+            fd: 文件描述符
+            data: 数据
+            offset: 文件内偏移
+        """
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    
+    def open_data_range(self, transfer):
+        """
+        为数据连接单独打开目标文件（各连接互不影响，连接结束即关闭）
+        
+        Args:
+            transfer: 传输信息
+            
+        Returns:
+            文件描述符
+        """
+        return os.open(transfer["file_path"], os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    
+    def finish_data_range(self, transfer, offset, received, crc=None, expected_crc=None):
+        """
+        记录一个区间接收结束
+        
+        Args:
+            transfer: 传输信息
+            offset: 区间偏移
+            received: 实际写入的字节数
+            crc: 接收到的数据的CRC32
+            expected_crc: 客户端在 DATA_CONNECT 中给出的CRC32，None 表示不校验
+            
+        Returns:
+            确认给客户端的字节数（CRC32校验失败时为0，区间可重新发送）
+        """
+        if expected_crc is not None and received == transfer["ranges"][offset] and crc != expected_crc:
+            print(f"❌ 文件 '{transfer['filename']}' 偏移 {offset} 处的区间CRC32校验失败")
+            received = 0
+        
+        with self.parallel_lock:
+            if received == transfer["ranges"][offset]:
+                transfer["done"].add(offset)
+            else:
+                # 区间中断或校验失败，允许客户端重新连接发送
+                transfer["claimed"].discard(offset)
+        return received
+    
+    def handle_data_connection(self, data_socket, reader, message):
+        """
+        处理并行上传的数据连接：把区间内的原始字节写入文件并确认
+        
+        Args:
+            data_socket: 数据连接套接字
+            reader: 该连接的 FrameReader
+            message: DATA_CONNECT 消息
+        """
+        claim = self.claim_data_range(message)
+        if not claim:
+            SocketUtils.send_message(data_socket, MessageType.ERROR, "无效的传输令牌或区间")
+            return
+        
+        transfer, offset, length, expected_crc = claim
+        received = 0
+        crc = 0
+        fd = self.open_data_range(transfer)
+        try:
+            def write(data):
+                nonlocal received, crc
+                self.write_at(fd, data, offset + received)
+                if expected_crc is not None:
+                    crc = zlib.crc32(data, crc)
+                received += len(data)
+            
+            reader.read_raw(length, write)
+        finally:
+            os.close(fd)
+            received = self.finish_data_range(transfer, offset, received, crc, expected_crc)
+        
+        SocketUtils.send_message(data_socket, MessageType.DATA_CONNECT, "", {
+            "offset": offset,
+            "received": received
+        })
+    
+    def complete_parallel_upload(self, client_socket, token, expected_sha256=None):
+        """
+        完成并行上传
+        
+        Args:
+            client_socket: 控制连接
+            token: 传输令牌
+            expected_sha256: 发送方在 FILE_COMPLETE 中给出的整个文件的SHA-256
+            
+        Returns:
+            保存的文件路径，有区间未收齐或SHA-256不一致时删除文件并返回None
+        """
+        import time
+        with self.parallel_lock:
+            transfer = self.parallel_uploads.get(token)
+            if not transfer or transfer["client_socket"] is not client_socket:
+                return None
+            del self.parallel_uploads[token]
+        
+        if len(transfer["done"]) != len(transfer["ranges"]):
+            print(f"❌ 文件 '{transfer['filename']}' 并行上传不完整: "
+                  f"{len(transfer['done'])}/{len(transfer['ranges'])} 个区间")
+            self.blob_store.discard(transfer["file_path"])
+            return None
+        
+        # 各区间乱序写入，无法边收边计算摘要；读取一次文件，校验和存入 BlobStore 共用这个摘要
+        sha256 = SocketUtils.file_sha256(transfer["file_path"])
+        if expected_sha256 and expected_sha256 != sha256:
+            print(f"❌ 文件 '{transfer['filename']}' 校验失败: SHA-256 不一致")
+            self.blob_store.discard(transfer["file_path"])
+            return None
+        
+        file_path = self.blob_store.commit(transfer["file_path"], transfer["username"], transfer["filename"], sha256)
+        
+        total_time = time.time() - transfer["start_time"]
+        print(f"✅ 文件接收完成: {transfer['filename']}")
+        print(f"💾 保存位置: {file_path}")
+        print(f"⏱️  接收时间: {SocketUtils.format_time(total_time)}")
+        if total_time > 0:
+            print(f"🚀 平均速度: {SocketUtils.format_transfer_speed(transfer['size'] / total_time)}")
+        return file_path
+    
+    def abort_parallel_uploads(self, client_socket):
+        """
+        控制连接断开时放弃其未完成的并行上传
+        
+        Args:
+            client_socket: 控制连接
+        """
+        with self.parallel_lock:
+            tokens = [token for token, transfer in self.parallel_uploads.items()
+                      if transfer["client_socket"] is client_socket]
+            transfers = [self.parallel_uploads.pop(token) for token in tokens]
+        
+        for transfer in transfers:
+            print(f"❌ 文件 '{transfer['filename']}' 并行上传中断")
+            self.blob_store.discard(transfer["file_path"])
 
 
 def main():
@@ -837,8 +1978,34 @@ def main():
     if len(sys.argv) >= 3:
         host = sys.argv[2]
     
+    policy = SlowConsumerPolicy.BACKPRESSURE
+    if len(sys.argv) >= 4:
+        policy = sys.argv[3]
+        if policy not in SlowConsumerPolicy.ALL:
+            print(f"慢客户端策略必须是: {', '.join(SlowConsumerPolicy.ALL)}")
+            return
+    
+    relay_mode = RelayMode.STORE
+    if len(sys.argv) >= 5:
+        relay_mode = sys.argv[4]
+        if relay_mode not in RelayMode.ALL:
+            print(f"文件转发模式必须是: {', '.join(RelayMode.ALL)}")
+            return
+    
+    history_size = 50
+    if len(sys.argv) >= 6:
+        try:
+            history_size = int(sys.argv[5])
+        except ValueError:
+            print("历史消息条数必须是数字")
+            return
+    
+    # 指定日志文件时历史消息在重启后保留
+    history_path = sys.argv[6] if len(sys.argv) >= 7 else None
+    
     # 创建并启动服务器
-    server = ChatServer(host, port)
+    server = ChatServer(host, port, slow_consumer_policy=policy, relay_mode=relay_mode,
+                        history_size=history_size, history_path=history_path)
     
     try:
         server.start()
@@ -851,4 +2018,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,106 @@
+"""
+在线用户索引
+按用户名直接查找连接，按子串搜索用户名，不再遍历所有客户端
+"""
+
+import bisect
+from typing import List
+
+
+class UsernameIndex:
+    """
+    用户名索引（调用方负责加锁）
+    
+    用户名 → 连接列表的字典提供O(1)精确查找；同名的多个连接按加入顺序保存，
+    查找时返回最早加入的连接，与原来遍历客户端字典的结果一致。
+    子串搜索使用后缀数组：每个用户名的所有后缀（小写）按字典序保存在有序列表中，
+    包含某个子串的用户名就是以该子串为前缀的后缀，二分查找定位后只访问匹配项。
+    每个后缀只保存前 MAX_SUFFIX_LENGTH 个字符，索引大小与用户名长度成线性关系；
+    更长的搜索串用截断后的前缀定位候选项，再逐个核对完整用户名。
+    """
+    
+    MAX_SUFFIX_LENGTH = 64
+    
+    def __init__(self):
+        """初始化空索引"""
+        self.sockets = {}    # {用户名: [套接字, ...]}
+        self.suffixes = []   # 有序的 (小写后缀, 用户名) 列表
+    
+    def add(self, username: str, client_socket):
+        """
+        登记一个连接
+        
+        Args:
+            username: 用户名
+            client_socket: 客户端套接字
+        """
+        sockets = self.sockets.get(username)
+        if sockets:
+            sockets.append(client_socket)
+            return
+        
+        self.sockets[username] = [client_socket]
+        lowered = username.lower()
+        for start in range(len(lowered)):
+            bisect.insort(self.suffixes, (lowered[start:start + self.MAX_SUFFIX_LENGTH], username))
+    
+    def remove(self, username: str, client_socket):
+        """
+        移除一个连接（同名的最后一个连接移除后才从子串索引中删除）
+        
+        Args:
+            username: 用户名
+            client_socket: 客户端套接字
+        """
+        sockets = self.sockets.get(username)
+        if not sockets or client_socket not in sockets:
+            return
+        
+        sockets.remove(client_socket)
+        if sockets:
+            return
+        
+        del self.sockets[username]
+        lowered = username.lower()
+        for start in range(len(lowered)):
+            entry = (lowered[start:start + self.MAX_SUFFIX_LENGTH], username)
+            position = bisect.bisect_left(self.suffixes, entry)
+            if position < len(self.suffixes) and self.suffixes[position] == entry:
+                del self.suffixes[position]
+    
+    def get(self, username: str):
+        """
+        查找用户名对应的连接
+        
+        Args:
+            username: 用户名
+            
+        Returns:
+            最早加入的同名连接，不在线返回None
+        """
+        sockets = self.sockets.get(username)
+        return sockets[0] if sockets else None
+    
+    def search(self, pattern: str) -> List[str]:
+        """
+        搜索包含指定子串的用户名（不区分大小写）
+        
+        Args:
+            pattern: 搜索的子串
+            
+        Returns:
+            匹配的用户名列表（按字母顺序）
+        """
+        pattern = pattern.lower()
+        if not pattern:
+            return sorted(self.sockets)
+        
+        key = pattern[:self.MAX_SUFFIX_LENGTH]
+        matches = set()
+        position = bisect.bisect_left(self.suffixes, (key,))
+        while position < len(self.suffixes) and self.suffixes[position][0].startswith(key):
+            username = self.suffixes[position][1]
+            if len(pattern) <= self.MAX_SUFFIX_LENGTH or pattern in username.lower():
+                matches.add(username)
+            position += 1
+        return sorted(matches)
@@ -3,11 +3,20 @@
 包含文件传输和消息处理的共用功能
 """
 
-import json
+import hashlib
 import struct
 import os
+import queue
+import socket
+import threading
+import time
+import weakref
+import zlib
+from collections import deque
 from typing import Dict, Any, Optional
 
+from codec import JSON_CODEC, COMPACT_CODEC
+
 
 class MessageType:
     """消息类型常量"""
@@ -16,11 +25,35 @@ class MessageType:
     FILE_REQUEST = "FILE_REQUEST"
     FILE_DATA = "FILE_DATA"
     FILE_COMPLETE = "FILE_COMPLETE"
+    FILE_RESUME = "FILE_RESUME"
+    TRANSFER_TOKEN = "TRANSFER_TOKEN"
+    DATA_CONNECT = "DATA_CONNECT"
     USER_JOIN = "USER_JOIN"
     USER_LEAVE = "USER_LEAVE"
+    SEARCH = "SEARCH"            # 客户端发送查询词，服务器回复搜索结果
+    FILE_ACK = "FILE_ACK"        # 接收方对请求确认的 FILE_DATA 数据块的确认
     ERROR = "ERROR"
 
 
+class Feature:
+    """
+    协议扩展特性常量
+    
+    客户端在 USER_JOIN 的 metadata["features"] 中声明自己支持的特性（逗号分隔字符串），
+    服务器在欢迎消息的 metadata["features"] 中回复双方都支持的特性。
+    未声明特性的对端（如C++版本）继续使用原有的JSON+十六进制协议。
+    """
+    BINARY_FILE_DATA = "binary_file_data"  # FILE_DATA 使用二进制帧传输原始字节
+    RAW_STREAM = "raw_stream"              # 服务器文件在 FILE 头之后以原始字节流发送
+    ZLIB = "zlib"                          # 消息帧和文件数据块可使用zlib压缩
+    RESUME = "resume"                      # 上传带内容哈希，服务器回复 FILE_RESUME 指明续传位置
+    PARALLEL_UPLOAD = "parallel_upload"    # 大文件分段经多个数据连接并行上传
+    INTEGRITY = "integrity"                # 数据块带CRC32，FILE_COMPLETE 带整个文件的SHA-256
+    ROUTED_HEADER = "routed_header"        # 消息以二进制路由头（类型、标志、对方用户名）开始，服务器按头部路由
+    COMPACT_CODEC = "compact_codec"        # 消息使用紧凑二进制编码（codec.CompactCodec）代替JSON
+    ADAPTIVE_CHUNKS = "adaptive_chunks"    # FILE_DATA 数据块大小可变（最大1MB），接收方按请求回复 FILE_ACK
+
+
 class SocketUtils:
     """套接字工具类（增强版）"""
     
@@ -28,6 +61,165 @@ class SocketUtils:
     MAX_BUFFER_SIZE = 64 * 1024  # 最大缓冲区大小64KB
     MIN_BUFFER_SIZE = 4 * 1024   # 最小缓冲区大小4KB
     
+    # 本实现支持的协议扩展特性
+    SUPPORTED_FEATURES = frozenset({Feature.BINARY_FILE_DATA, Feature.RAW_STREAM, Feature.ZLIB,
+                                    Feature.RESUME, Feature.PARALLEL_UPLOAD, Feature.INTEGRITY,
+                                    Feature.ROUTED_HEADER, Feature.COMPACT_CODEC, Feature.ADAPTIVE_CHUNKS})
+    
+    # 二进制帧：长度前缀最高位置1，消息体以固定头开始，后接原始数据
+    BINARY_FRAME_FLAG = 0x80000000
+    LENGTH_MASK = 0x7FFFFFFF
+    MAX_FRAME_SIZE = 16 * 1024 * 1024  # 单帧上限，限制每个连接的内存占用
+    FRAME_FILE_DATA = 1
+    # 帧类型(1) 标志(1) bytes_sent(8) total_size(8) chunk_index(4)
+    FILE_DATA_HEADER = struct.Struct('!BBQQI')
+    FILE_DATA_COMPRESSED = 0x01  # 标志位：数据块经过压缩
+    FILE_DATA_CRC = 0x02         # 标志位：固定头之后是4字节的数据块CRC32（按压缩前的数据计算）
+    FILE_DATA_ACK = 0x04         # 标志位：发送方请求接收方对该数据块回复 FILE_ACK
+    CRC_FIELD = struct.Struct('!I')
+    
+    # 压缩帧：帧类型(1) 压缩算法(1)，后接压缩后的JSON消息体
+    FRAME_COMPRESSED = 2
+    COMPRESSED_HEADER = struct.Struct('!BB')
+    CODEC_ZLIB = 1
+    
+    # 路由帧：帧类型(1) 消息类型编号(1) 标志(1) 对方用户名长度(2)，后接对方用户名(UTF-8)和JSON消息体
+    # 对方用户名在客户端发出时是接收者（空表示发给聊天室），在服务器转发时是发送者
+    FRAME_ROUTED = 3
+    ROUTED_HEADER = struct.Struct('!BBBH')
+    ROUTED_COMPRESSED = 0x01  # 标志位：消息体经过压缩
+    ROUTED_COMPACT = 0x02     # 标志位：消息体为紧凑编码（否则为JSON）
+    ROUTED_TYPES = (MessageType.TEXT, MessageType.FILE, MessageType.FILE_REQUEST, MessageType.FILE_DATA,
+                    MessageType.FILE_COMPLETE, MessageType.FILE_RESUME, MessageType.TRANSFER_TOKEN,
+                    MessageType.DATA_CONNECT, MessageType.USER_JOIN, MessageType.USER_LEAVE,
+                    MessageType.SEARCH, MessageType.ERROR,
+                    MessageType.FILE_ACK)  # 消息类型编号为在此元组中的位置 + 1，只能在末尾追加
+    
+    # 紧凑编码帧：帧类型(1) 标志(1)，后接紧凑编码的消息 {"type", "data", "metadata"}
+    FRAME_COMPACT = 4
+    COMPACT_HEADER = struct.Struct('!BB')
+    COMPACT_COMPRESSED = 0x01  # 标志位：消息体经过压缩
+    
+    COMPRESS_MIN_SIZE = 256       # 小于该大小的消息不压缩
+    COMPRESS_SAMPLE_SIZE = 4096   # 压缩率采样大小
+    COMPRESS_MAX_RATIO = 0.9      # 压缩后大小超过原大小的该比例视为不可压缩
+    COMPRESS_LEVEL = 1            # 优先压缩速度，文本类数据在低级别下压缩率已经足够
+    
+    # 并行上传：超过该大小的文件分段经多个数据连接发送
+    PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+    PARALLEL_STREAMS = 4          # 客户端请求的数据连接数
+    MAX_PARALLEL_STREAMS = 8      # 服务器允许的数据连接数上限
+    MIN_RANGE_SIZE = 4 * 1024 * 1024
+    RANGE_SLICE_SIZE = 1024 * 1024  # 数据连接每次 sendfile 的字节数（用于更新进度）
+    
+    @staticmethod
+    def encode_features(features) -> str:
+        """
+        将特性集合编码为metadata中的逗号分隔字符串
+        
+        Args:
+            features: 特性集合
+            
+        Returns:
+            逗号分隔的特性字符串
+        """
+        return ",".join(sorted(features))
+    
+    @staticmethod
+    def parse_features(value) -> frozenset:
+        """
+        解析metadata中的特性字段
+        
+        Args:
+            value: 逗号分隔的特性字符串（也接受列表）
+            
+        Returns:
+            特性集合
+        """
+        if not value:
+            return frozenset()
+        if isinstance(value, str):
+            value = value.split(",")
+        return frozenset(item.strip() for item in value if item and item.strip())
+    
+    @staticmethod
+    def negotiate_features(offered) -> frozenset:
+        """
+        计算与对端共同支持的特性
+        
+        Args:
+            offered: 对端声明的特性（字符串或集合）
+            
+        Returns:
+            双方都支持的特性集合
+        """
+        return SocketUtils.parse_features(offered) & SocketUtils.SUPPORTED_FEATURES
+    
+    @staticmethod
+    def is_compressible(data) -> bool:
+        """
+        用开头的一段数据采样估计压缩率，跳过已压缩的内容（图片、压缩包等）
+        
+        Args:
+            data: 待压缩数据
+            
+        Returns:
+            是否值得压缩
+        """
+        if len(data) < SocketUtils.COMPRESS_MIN_SIZE:
+            return False
+        sample = memoryview(data)[:SocketUtils.COMPRESS_SAMPLE_SIZE]
+        compressed = zlib.compress(sample, SocketUtils.COMPRESS_LEVEL)
+        return len(compressed) <= len(sample) * SocketUtils.COMPRESS_MAX_RATIO
+    
+    @staticmethod
+    def compress_payload(data) -> Optional[bytes]:
+        """
+        压缩数据，不值得压缩时返回None
+        
+        Args:
+            data: 待压缩数据
+            
+        Returns:
+            压缩后的数据，采样或实际压缩率不理想时返回None
+        """
+        if not SocketUtils.is_compressible(data):
+            return None
+        
+        compressed = zlib.compress(data, SocketUtils.COMPRESS_LEVEL)
+        
+        # 采样只覆盖开头部分，整体压缩率不理想时仍发送原始数据
+        if len(compressed) > len(data) * SocketUtils.COMPRESS_MAX_RATIO:
+            return None
+        return compressed
+    
+    @staticmethod
+    def decompress_payload(data, codec: int = CODEC_ZLIB) -> bytes:
+        """
+        解压数据，解压后大小不超过单帧上限
+        
+        Args:
+            data: 压缩数据
+            codec: 压缩算法
+            
+        Returns:
+            解压后的数据
+            
+        Raises:
+            ValueError: 未知压缩算法、压缩数据无效或解压后数据过大
+        """
+        if codec != SocketUtils.CODEC_ZLIB:
+            raise ValueError(f"未知的压缩算法: {codec}")
+        
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(data, SocketUtils.MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ValueError(f"压缩数据无效: {e}")
+        if decompressor.unconsumed_tail:
+            raise ValueError("解压后的消息过大")
+        return result
+    
     @staticmethod
     def get_optimal_buffer_size(file_size: int) -> int:
         """
@@ -49,105 +241,401 @@ class SocketUtils:
             return SocketUtils.MAX_BUFFER_SIZE
     
     @staticmethod
-    def send_message(sock, message_type: str, data: Any, metadata: Optional[Dict] = None):
+    def encode_message(message_type: str, data: Any, metadata: Optional[Dict] = None,
+                       compress: bool = False, compact: bool = False) -> tuple:
         """
-        发送消息到套接字
+        将消息编码为带长度前缀的完整帧
         
         Args:
-            sock: 套接字对象
             message_type: 消息类型
             data: 消息数据
             metadata: 元数据
+            compress: 是否尝试压缩（对端须已协商 zlib 特性）
+            compact: 是否使用紧凑编码（对端须已协商 compact_codec 特性）
+            
+        Returns:
+            帧的缓冲区元组 (长度前缀, JSON消息体)，发送时由 FrameWriter 合并写出；
+            压缩后为 (长度前缀+压缩帧头, 压缩数据)，紧凑编码为 (长度前缀+紧凑帧头, 消息体)
         """
-        try:
-            message = {
-                "type": message_type,
-                "data": data,
-                "metadata": metadata or {}
-            }
+        message = {
+            "type": message_type,
+            "data": data,
+            "metadata": metadata or {}
+        }
+        
+        if compact:
+            return SocketUtils.encode_compact(message, compress)
+        
+        # 将消息序列化为JSON
+        message_bytes = JSON_CODEC.encode(message)
+        
+        if compress:
+            compressed = SocketUtils.compress_payload(message_bytes)
+            if compressed is not None:
+                header = SocketUtils.COMPRESSED_HEADER.pack(SocketUtils.FRAME_COMPRESSED, SocketUtils.CODEC_ZLIB)
+                frame_length = (len(header) + len(compressed)) | SocketUtils.BINARY_FRAME_FLAG
+                return struct.pack('!I', frame_length) + header, compressed
+        
+        # 消息长度（4字节）+ 消息内容
+        return struct.pack('!I', len(message_bytes)), message_bytes
+    
+    @staticmethod
+    def encode_compact(message: Dict[str, Any], compress: bool = False) -> tuple:
+        """
+        将消息字典编码为紧凑编码帧
+        
+        Args:
+            message: 消息字典 {"type", "data", "metadata"}
+            compress: 是否尝试压缩（对端须已协商 zlib 特性）
+            
+        Returns:
+            帧的缓冲区元组 (长度前缀+紧凑帧头, 消息体)
+        """
+        body = COMPACT_CODEC.encode(message)
+        flags = 0
+        if compress:
+            compressed = SocketUtils.compress_payload(body)
+            if compressed is not None:
+                body = compressed
+                flags |= SocketUtils.COMPACT_COMPRESSED
+        header = SocketUtils.COMPACT_HEADER.pack(SocketUtils.FRAME_COMPACT, flags)
+        frame_length = (len(header) + len(body)) | SocketUtils.BINARY_FRAME_FLAG
+        return struct.pack('!I', frame_length) + header, body
+    
+    @staticmethod
+    def encode_routed(message_type: str, data: Any, metadata: Optional[Dict] = None, peer: str = "",
+                      compress: bool = False, compact: bool = False) -> tuple:
+        """
+        将消息编码为路由帧（对端须已协商 routed_header 特性）
+        
+        Args:
+            message_type: 消息类型
+            data: 消息数据
+            metadata: 元数据
+            peer: 对方用户名（客户端发出时为接收者，空表示发给聊天室）
+            compress: 是否尝试压缩消息体（对端须已协商 zlib 特性）
+            compact: 消息体是否使用紧凑编码（对端须已协商 compact_codec 特性）
             
-            # 将消息序列化为JSON
-            json_message = json.dumps(message, ensure_ascii=False)
-            message_bytes = json_message.encode('utf-8')
+        Returns:
+            帧的缓冲区元组 (长度前缀+路由头, 消息体)
+        """
+        codec = COMPACT_CODEC if compact else JSON_CODEC
+        body = codec.encode({"data": data, "metadata": metadata or {}})
+        flags = SocketUtils.ROUTED_COMPACT if compact else 0
+        if compress:
+            compressed = SocketUtils.compress_payload(body)
+            if compressed is not None:
+                body = compressed
+                flags |= SocketUtils.ROUTED_COMPRESSED
+        return SocketUtils.routed_frame(message_type, peer, flags, body)
+    
+    @staticmethod
+    def routed_frame(message_type: str, peer: str, flags: int, body) -> tuple:
+        """
+        用已编码的消息体组成路由帧（转发时消息体原样使用）
+        
+        Args:
+            message_type: 消息类型
+            peer: 对方用户名
+            flags: 路由头标志
+            body: 消息体
             
-            # 发送消息长度（4字节）
-            message_length = len(message_bytes)
-            sock.send(struct.pack('!I', message_length))
+        Returns:
+            帧的缓冲区元组 (长度前缀+路由头, 消息体)
+        """
+        peer_bytes = peer.encode('utf-8')
+        header = SocketUtils.ROUTED_HEADER.pack(
+            SocketUtils.FRAME_ROUTED,
+            SocketUtils.ROUTED_TYPES.index(message_type) + 1,
+            flags,
+            len(peer_bytes)
+        ) + peer_bytes
+        frame_length = (len(header) + len(body)) | SocketUtils.BINARY_FRAME_FLAG
+        return struct.pack('!I', frame_length) + header, body
+    
+    @staticmethod
+    def encode_file_data(chunk, metadata: Dict, binary: bool = False, compress: bool = False,
+                         compact: bool = False) -> tuple:
+        """
+        将文件数据块编码为完整帧
+        
+        对端协商了 binary_file_data 特性时编码为二进制帧（原始字节，不做十六进制编码和JSON序列化），
+        协商了 compact_codec 特性时编码为紧凑编码消息（原始字节直接放入消息），
+        否则回退到原有的十六进制JSON消息。
+        
+        Args:
+            chunk: 文件数据块（bytes，或转发时原样保留的十六进制字符串）
+            metadata: 元数据（bytes_sent, total_size, chunk_index）
+            binary: 是否使用二进制帧
+            compress: 是否尝试压缩数据块（仅二进制帧，对端须已协商 zlib 特性）
+            compact: 不使用二进制帧时是否使用紧凑编码
             
-            # 发送消息内容
-            sock.send(message_bytes)
+        Returns:
+            帧的缓冲区元组，二进制帧为 (长度前缀+固定头, 原始数据)，数据块不做拼接复制
+        """
+        if not binary and compact:
+            raw = bytes.fromhex(chunk) if isinstance(chunk, str) else chunk
+            return SocketUtils.encode_message(MessageType.FILE_DATA, raw, metadata, compact=True)
+        if not binary:
+            hex_data = chunk if isinstance(chunk, str) else bytes(chunk).hex()
+            return SocketUtils.encode_message(MessageType.FILE_DATA, hex_data, metadata)
+        
+        if isinstance(chunk, str):
+            chunk = bytes.fromhex(chunk)
+        flags = 0
+        if compress:
+            compressed = SocketUtils.compress_payload(chunk)
+            if compressed is not None:
+                chunk = compressed
+                flags |= SocketUtils.FILE_DATA_COMPRESSED
+        
+        if metadata.get("ack"):
+            flags |= SocketUtils.FILE_DATA_ACK
+        
+        crc_field = b''
+        if metadata.get("crc32") is not None:
+            flags |= SocketUtils.FILE_DATA_CRC
+            crc_field = SocketUtils.CRC_FIELD.pack(int(metadata["crc32"]))
+        
+        header = SocketUtils.FILE_DATA_HEADER.pack(
+            SocketUtils.FRAME_FILE_DATA,
+            flags,
+            int(metadata.get("bytes_sent", 0) or 0),
+            int(metadata.get("total_size", 0) or 0),
+            int(metadata.get("chunk_index", 0) or 0)
+        ) + crc_field
+        frame_length = (len(header) + len(chunk)) | SocketUtils.BINARY_FRAME_FLAG
+        return struct.pack('!I', frame_length) + header, chunk
+    
+    @staticmethod
+    def send_message(sock, message_type: str, data: Any, metadata: Optional[Dict] = None,
+                     compress: bool = False, routed: bool = False, peer: str = "", compact: bool = False):
+        """
+        发送消息到套接字
+        
+        Args:
+            sock: 套接字对象
+            message_type: 消息类型
+            data: 消息数据
+            metadata: 元数据
+            compress: 是否尝试压缩（对端须已协商 zlib 特性）
+            routed: 是否编码为路由帧（对端须已协商 routed_header 特性）
+            peer: 路由帧的对方用户名
+            compact: 是否使用紧凑编码（对端须已协商 compact_codec 特性）
+        """
+        try:
+            if routed:
+                frame = SocketUtils.encode_routed(message_type, data, metadata, peer, compress, compact)
+            else:
+                frame = SocketUtils.encode_message(message_type, data, metadata, compress, compact)
+            SocketUtils.send_frame(sock, frame)
             
         except Exception as e:
             print(f"发送消息失败: {e}")
             raise
     
     @staticmethod
-    def receive_message(sock) -> Optional[Dict[str, Any]]:
+    def send_frame(sock, frame: tuple):
         """
-        从套接字接收消息
+        发送一个已编码的帧（长度前缀和消息体合并为一次 sendmsg，处理部分发送）
         
         Args:
             sock: 套接字对象
-            
-        Returns:
-            解析后的消息字典，如果连接断开返回None
+            frame: 帧的缓冲区元组
+        """
+        writer = FrameWriter(sock)
+        writer.add(frame)
+        writer.flush()
+    
+    @staticmethod
+    def send_file_data(sock, chunk, metadata: Dict, binary: bool = False, compress: bool = False,
+                       compact: bool = False):
+        """
+        发送文件数据块
+        
+        Args:
+            sock: 套接字对象
+            chunk: 文件数据块（bytes）
+            metadata: 元数据（bytes_sent, total_size, chunk_index）
+            binary: 是否使用二进制帧
+            compress: 是否尝试压缩数据块
+            compact: 不使用二进制帧时是否使用紧凑编码
         """
         try:
-            # 接收消息长度（4字节）
-            length_data = SocketUtils._receive_all(sock, 4)
-            if not length_data:
-                return None
-            
-            message_length = struct.unpack('!I', length_data)[0]
+            SocketUtils.send_frame(sock, SocketUtils.encode_file_data(chunk, metadata, binary, compress, compact))
+        
+        except Exception as e:
+            print(f"发送文件数据块失败: {e}")
+            raise
+    
+    @staticmethod
+    def decode_chunk(data) -> bytes:
+        """
+        获取FILE_DATA消息中的原始字节
+        
+        Args:
+            data: 二进制帧中的字节数据或JSON消息中的十六进制字符串
             
-            # 接收消息内容
-            message_data = SocketUtils._receive_all(sock, message_length)
-            if not message_data:
-                return None
+        Returns:
+            原始字节
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return bytes(data)
+        return bytes.fromhex(data)
+    
+    @staticmethod
+    def chunk_size(data) -> int:
+        """
+        FILE_DATA 数据块的原始字节数（十六进制字符串不解码）
+        
+        Args:
+            data: 原始字节或十六进制字符串
             
-            # 解析JSON消息
-            json_message = message_data.decode('utf-8')
-            message = json.loads(json_message)
+        Returns:
+            字节数
+        """
+        return len(data) // 2 if isinstance(data, str) else len(data)
+    
+    @staticmethod
+    def _decode_binary_frame(frame) -> Optional[Dict[str, Any]]:
+        """
+        解析二进制帧
+        
+        Args:
+            frame: 去掉长度前缀后的帧内容
             
-            return message
+        Returns:
+            与JSON消息结构相同的消息字典，未知帧类型返回None。
+            data 是 frame 的切片，来自 FrameReader 时只在下一次读取前有效
             
-        except Exception as e:
-            print(f"接收消息失败: {e}")
+        Raises:
+            ValueError: 帧为空、帧头不完整或内容无法解码
+        """
+        if len(frame) == 0:
+            raise ValueError("空的二进制帧")
+        
+        if frame[0] == SocketUtils.FRAME_COMPRESSED and len(frame) >= SocketUtils.COMPRESSED_HEADER.size:
+            # 压缩的JSON消息：解压后按普通消息解析
+            _, codec = SocketUtils.COMPRESSED_HEADER.unpack_from(frame)
+            payload = SocketUtils.decompress_payload(frame[SocketUtils.COMPRESSED_HEADER.size:], codec)
+            return SocketUtils.parse_frame(payload)
+        
+        if frame[0] == SocketUtils.FRAME_ROUTED:
+            return RoutedMessage.from_frame(frame)
+        
+        if frame[0] == SocketUtils.FRAME_COMPACT and len(frame) >= SocketUtils.COMPACT_HEADER.size:
+            _, flags = SocketUtils.COMPACT_HEADER.unpack_from(frame)
+            payload = frame[SocketUtils.COMPACT_HEADER.size:]
+            if flags & SocketUtils.COMPACT_COMPRESSED:
+                payload = SocketUtils.decompress_payload(payload)
+            return COMPACT_CODEC.decode(payload)
+        
+        header_size = SocketUtils.FILE_DATA_HEADER.size
+        if frame[0] != SocketUtils.FRAME_FILE_DATA or len(frame) < header_size:
+            print(f"未知的二进制帧类型: {frame[0]}")
             return None
+        
+        _, flags, bytes_sent, total_size, chunk_index = SocketUtils.FILE_DATA_HEADER.unpack_from(frame)
+        metadata = {
+            "bytes_sent": bytes_sent,
+            "total_size": total_size,
+            "chunk_index": chunk_index
+        }
+        
+        if flags & SocketUtils.FILE_DATA_CRC:
+            if len(frame) < header_size + SocketUtils.CRC_FIELD.size:
+                raise ValueError("FILE_DATA 帧的CRC32不完整")
+            metadata["crc32"] = SocketUtils.CRC_FIELD.unpack_from(frame, header_size)[0]
+            header_size += SocketUtils.CRC_FIELD.size
+        if flags & SocketUtils.FILE_DATA_ACK:
+            metadata["ack"] = True
+        
+        chunk = frame[header_size:]
+        if flags & SocketUtils.FILE_DATA_COMPRESSED:
+            chunk = SocketUtils.decompress_payload(chunk)
+        
+        return {
+            "type": MessageType.FILE_DATA,
+            "data": chunk,
+            "metadata": metadata
+        }
+    
+    @staticmethod
+    def verify_chunk(chunk, metadata: Dict) -> bool:
+        """
+        校验数据块的CRC32（没有携带CRC的数据块视为通过）
+        
+        Args:
+            chunk: 数据块原始字节
+            metadata: FILE_DATA 的元数据
+            
+        Returns:
+            是否通过校验
+        """
+        crc = metadata.get("crc32")
+        if crc is None:
+            return True
+        return zlib.crc32(chunk) == int(crc)
     
     @staticmethod
-    def _receive_all(sock, length: int) -> bytes:
+    def receive_message(sock) -> Optional[Dict[str, Any]]:
         """
-        确保接收指定长度的数据
+        从套接字接收消息
+        
+        使用该套接字的 FrameReader，一次读取中多出的帧会留给下一次调用。
         
         Args:
             sock: 套接字对象
-            length: 要接收的数据长度
             
         Returns:
-            接收到的数据
+            解析后的消息字典，如果连接断开返回None
         """
-        data = b''
-        while len(data) < length:
-            packet = sock.recv(length - len(data))
-            if not packet:
-                break
-            data += packet
-        return data
+        return FrameReader.for_socket(sock).read_message()
+    
+    @staticmethod
+    def parse_frame(frame, is_binary: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        解析一帧消息内容
+        
+        Args:
+            frame: 去掉长度前缀后的帧内容（bytes 或 memoryview）
+            is_binary: 长度前缀是否带有二进制帧标志
+            
+        Returns:
+            解析后的消息字典
+            
+        Raises:
+            ValueError: 帧内容无法解析
+        """
+        # 二进制帧不做JSON解析
+        if is_binary:
+            return SocketUtils._decode_binary_frame(frame)
+        
+        # 解析JSON消息
+        return JSON_CODEC.decode(frame)
     
     @staticmethod
-    def send_file(sock, file_path: str, username: str = "", show_progress: bool = True):
+    def send_file(sock, file_path: str, username: str = "", show_progress: bool = True,
+                  features: frozenset = frozenset(), wait_resume=None, recipients: Optional[str] = None,
+                  controller: Optional['TransferController'] = None):
         """
         发送文件到套接字（带进度显示和传输统计）
         
+        协商了 resume 特性并提供 wait_resume 时，FILE 消息带上文件内容的SHA-256，
+        再从服务器 FILE_RESUME 回复的位置开始发送。
+        提供 controller 时（对端须已协商 adaptive_chunks 特性）数据块大小和发送窗口由它调整，
+        否则固定按 BUFFER_SIZE 分块。
+        
         Args:
             sock: 套接字对象
             file_path: 文件路径
             username: 发送者用户名
             show_progress: 是否显示进度
+            features: 与对端协商好的协议特性
+            wait_resume: 等待 FILE_RESUME 回复的函数，参数为文件名，返回续传位置
+            recipients: 逗号分隔的接收者用户名或群组名，None 表示由服务器广播
+            controller: 自适应传输控制器，由调用方把收到的 FILE_ACK 交给它
         """
-        import time
-        
         try:
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"文件不存在: {file_path}")
@@ -161,8 +649,24 @@ class SocketUtils:
                 "size": file_size,
                 "sender": username
             }
+            if recipients:
+                file_info["to"] = recipients
+            
+            resume = Feature.RESUME in features and wait_resume is not None
+            if resume:
+                file_info["sha256"] = SocketUtils.file_sha256(file_path)
+            
+            compact = Feature.COMPACT_CODEC in features
+            SocketUtils.send_message(sock, MessageType.FILE, "", file_info, compact=compact)
             
-            SocketUtils.send_message(sock, MessageType.FILE, "", file_info)
+            offset = 0
+            if resume:
+                offset = min(wait_resume(filename), file_size)
+                if offset and show_progress:
+                    if offset == file_size:
+                        print("📦 服务器已有相同文件，跳过上传")
+                    else:
+                        print(f"🔁 从 {SocketUtils.format_file_size(offset)} 处继续上传")
             
             # 记录开始时间
             start_time = time.time()
@@ -172,22 +676,43 @@ class SocketUtils:
                 print(f"📤 开始发送文件: {filename}")
                 print(f"📊 文件大小: {SocketUtils.format_file_size(file_size)}")
             
-            # 发送文件数据
+            # 发送文件数据（压缩只用于二进制帧；文件开头采样不可压缩时整个文件都不再尝试）
+            binary = Feature.BINARY_FILE_DATA in features
+            compress = binary and Feature.ZLIB in features
+            
+            # 边发送边计算整个文件的摘要（续传时已在发送前算好）
+            integrity = Feature.INTEGRITY in features
+            hasher = hashlib.sha256() if integrity and "sha256" not in file_info else None
             with open(file_path, 'rb') as f:
-                bytes_sent = 0
+                f.seek(offset)
+                bytes_sent = offset
                 chunk_count = 0
                 
                 while bytes_sent < file_size:
-                    chunk = f.read(SocketUtils.BUFFER_SIZE)
+                    chunk = f.read(controller.chunk_size if controller else SocketUtils.BUFFER_SIZE)
                     if not chunk:
                         break
                     
-                    # 发送文件数据块
-                    SocketUtils.send_message(sock, MessageType.FILE_DATA, chunk.hex(), {
+                    if compress and chunk_count == 0:
+                        compress = SocketUtils.is_compressible(chunk)
+                    
+                    chunk_metadata = {
                         "bytes_sent": bytes_sent,
                         "total_size": file_size,
                         "chunk_index": chunk_count
-                    })
+                    }
+                    if controller:
+                        # 已发送未确认的数据超过窗口时等待确认
+                        controller.wait_window(bytes_sent)
+                        if controller.on_sent(chunk_count, bytes_sent, len(chunk)):
+                            chunk_metadata["ack"] = True
+                    if integrity:
+                        chunk_metadata["crc32"] = zlib.crc32(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                    
+                    # 发送文件数据块
+                    SocketUtils.send_file_data(sock, chunk, chunk_metadata, binary, compress, compact)
                     
                     bytes_sent += len(chunk)
                     chunk_count += 1
@@ -197,7 +722,7 @@ class SocketUtils:
                     if show_progress and (current_time - last_update_time >= 0.1 or bytes_sent >= file_size):
                         elapsed_time = current_time - start_time
                         if elapsed_time > 0:
-                            speed = bytes_sent / elapsed_time
+                            speed = (bytes_sent - offset) / elapsed_time
                             progress = (bytes_sent / file_size) * 100
                             
                             speed_str = SocketUtils.format_transfer_speed(speed)
@@ -212,16 +737,20 @@ class SocketUtils:
             end_time = time.time()
             total_time = end_time - start_time
             
-            SocketUtils.send_message(sock, MessageType.FILE_COMPLETE, "", {
+            complete_metadata = {
                 "filename": filename,
                 "total_size": file_size,
                 "transfer_time": total_time,
                 "chunk_count": chunk_count
-            })
+            }
+            if integrity:
+                complete_metadata["sha256"] = hasher.hexdigest() if hasher else file_info["sha256"]
+            
+            SocketUtils.send_message(sock, MessageType.FILE_COMPLETE, "", complete_metadata, compact=compact)
             
             if show_progress:
                 print()  # 换行
-                avg_speed = file_size / total_time if total_time > 0 else 0
+                avg_speed = (file_size - offset) / total_time if total_time > 0 else 0
                 print(f"✅ 文件发送完成: {filename}")
                 print(f"⏱️  传输时间: {SocketUtils.format_time(total_time)}")
                 print(f"🚀 平均速度: {SocketUtils.format_transfer_speed(avg_speed)}")
@@ -232,6 +761,116 @@ class SocketUtils:
                 print(f"\n❌ 发送文件失败: {e}")
             raise
     
+    @staticmethod
+    def split_ranges(file_size: int, streams: int) -> list:
+        """
+        把文件划分为并行上传的连续区间
+        
+        Args:
+            file_size: 文件大小
+            streams: 期望的区间数
+            
+        Returns:
+            [(偏移, 长度), ...]，每段不小于 MIN_RANGE_SIZE（最后一段除外）
+        """
+        streams = max(1, min(streams, SocketUtils.MAX_PARALLEL_STREAMS,
+                             file_size // SocketUtils.MIN_RANGE_SIZE or 1))
+        range_size = -(-file_size // streams)
+        return [(offset, min(range_size, file_size - offset))
+                for offset in range(0, file_size, range_size)]
+    
+    @staticmethod
+    def send_file_range(address, token: str, file_path: str, offset: int, length: int, progress=None,
+                        integrity: bool = False) -> int:
+        """
+        经独立的数据连接发送文件的一个区间
+        
+        数据连接先发送 DATA_CONNECT（携带控制连接上获得的令牌和区间），
+        随后用 sendfile 发送区间内的原始字节，最后等待服务器确认写入的字节数。
+        
+        Args:
+            address: 服务器地址 (host, port)
+            token: 传输令牌
+            file_path: 文件路径
+            offset: 区间起始偏移
+            length: 区间长度
+            progress: 每发送一段后调用的回调，参数为本次发送的字节数
+            integrity: 是否在 DATA_CONNECT 中携带区间的CRC32（对端须已协商 integrity 特性）
+            
+        Returns:
+            服务器确认收到的字节数（CRC32校验失败时为0）
+        """
+        connect_metadata = {
+            "token": token,
+            "offset": offset,
+            "length": length
+        }
+        if integrity:
+            # sendfile 不经过用户空间，发送前先读一遍区间计算CRC32（随后的 sendfile 命中页缓存）
+            connect_metadata["crc32"] = SocketUtils.range_crc32(file_path, offset, length)
+        
+        with socket.create_connection(address) as sock:
+            SocketUtils.send_message(sock, MessageType.DATA_CONNECT, "", connect_metadata)
+            
+            with open(file_path, 'rb') as f:
+                sent = 0
+                while sent < length:
+                    count = sock.sendfile(f, offset + sent, min(SocketUtils.RANGE_SLICE_SIZE, length - sent))
+                    if count == 0:
+                        break
+                    sent += count
+                    if progress:
+                        progress(count)
+            
+            reply = FrameReader(sock).read_message()
+            if not reply or reply.get("type") != MessageType.DATA_CONNECT:
+                return 0
+            return int(reply.get("metadata", {}).get("received", 0))
+    
+    @staticmethod
+    def range_crc32(file_path: str, offset: int, length: int) -> int:
+        """
+        计算文件中一个区间的CRC32
+        
+        Args:
+            file_path: 文件路径
+            offset: 区间起始偏移
+            length: 区间长度
+            
+        Returns:
+            CRC32值
+        """
+        crc = 0
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                block = f.read(min(SocketUtils.RANGE_SLICE_SIZE, length))
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                length -= len(block)
+        return crc
+    
+    @staticmethod
+    def file_sha256(file_path: str) -> str:
+        """
+        计算文件内容的SHA-256
+        
+        Args:
+            file_path: 文件路径
+            
+        Returns:
+            十六进制摘要
+        """
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest()
+    
     @staticmethod
     def receive_file(sock, save_dir: str = "./files") -> Optional[str]:
         """
@@ -278,8 +917,7 @@ class SocketUtils:
                 
                 elif msg_type == MessageType.FILE_DATA and file_handle:
                     # 接收文件数据
-                    chunk_hex = message.get("data", "")
-                    chunk = bytes.fromhex(chunk_hex)
+                    chunk = SocketUtils.decode_chunk(message.get("data", ""))
                     file_handle.write(chunk)
                     bytes_received += len(chunk)
                     
@@ -387,6 +1025,1045 @@ class SocketUtils:
         return f"[{bar}]"
 
 
+class FrameReader:
+    """
+    带缓冲的帧读取器（每个套接字一个）
+    
+    使用一块可复用的 bytearray 作为接收缓冲区，通过 recv_into 直接填充，
+    一次内核读取中包含的多个帧会依次从缓冲区中取出，不再为长度前缀和消息体分别读取。
+    返回的帧内容是缓冲区上的 memoryview，只在下一次读取前有效；
+    超过缓冲区大小的帧直接读入按帧长分配的独立缓冲区。
+    """
+    
+    HEADER = struct.Struct('!I')
+    
+    _readers = weakref.WeakKeyDictionary()
+    _readers_lock = threading.Lock()
+    
+    def __init__(self, sock, buffer_size: int = 64 * 1024):
+        """
+        初始化帧读取器
+        
+        Args:
+            sock: 套接字对象
+            buffer_size: 接收缓冲区大小
+        """
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # 未处理数据的起始位置
+        self.end = 0    # 未处理数据的结束位置
+    
+    @classmethod
+    def for_socket(cls, sock) -> 'FrameReader':
+        """
+        获取套接字对应的帧读取器（同一套接字始终返回同一个读取器）
+        
+        Args:
+            sock: 套接字对象
+            
+        Returns:
+            帧读取器
+        """
+        with cls._readers_lock:
+            reader = cls._readers.get(sock)
+            if reader is None:
+                reader = cls(sock)
+                cls._readers[sock] = reader
+            return reader
+    
+    def fill(self) -> int:
+        """
+        从套接字读取一次数据到缓冲区
+        
+        Returns:
+            读取的字节数，0 表示连接已关闭
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            # 缓冲区尾部已满，把未处理的数据移到开头
+            pending = self.end - self.start
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        
+        received = self.sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+    
+    def _peek_length(self):
+        """
+        读取缓冲区中下一帧的长度前缀
+        
+        Returns:
+            (是否二进制帧, 帧长度)，数据不足4字节返回None
+        """
+        if self.end - self.start < self.HEADER.size:
+            return None
+        
+        length = self.HEADER.unpack_from(self.buffer, self.start)[0]
+        is_binary = bool(length & SocketUtils.BINARY_FRAME_FLAG)
+        length &= SocketUtils.LENGTH_MASK
+        if length > SocketUtils.MAX_FRAME_SIZE:
+            raise ValueError(f"消息过大: {length} 字节")
+        return is_binary, length
+    
+    def next_frame(self):
+        """
+        从缓冲区中取出一个完整帧（不读取套接字）
+        
+        Returns:
+            (是否二进制帧, 帧内容memoryview)，缓冲区中没有完整帧返回None
+        """
+        header = self._peek_length()
+        if header is None:
+            return None
+        
+        is_binary, length = header
+        frame_start = self.start + self.HEADER.size
+        if self.end - frame_start < length:
+            return None
+        
+        self.start = frame_start + length
+        return is_binary, self.view[frame_start:self.start]
+    
+    def read_frame(self):
+        """
+        读取下一帧，缓冲区中没有完整帧时阻塞读取套接字
+        
+        Returns:
+            (是否二进制帧, 帧内容memoryview)，连接关闭返回None
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            
+            # 帧比缓冲区还大：直接读入独立的缓冲区
+            header = self._peek_length()
+            if header is not None and self.HEADER.size + header[1] > len(self.buffer):
+                return self._read_large_frame(*header)
+            
+            if self.fill() == 0:
+                return None
+    
+    def _read_large_frame(self, is_binary: bool, length: int):
+        """
+        读取超过缓冲区大小的帧
+        
+        Args:
+            is_binary: 是否二进制帧
+            length: 帧长度
+            
+        Returns:
+            (是否二进制帧, 帧内容memoryview)，连接关闭返回None
+        """
+        frame = bytearray(length)
+        frame_view = memoryview(frame)
+        
+        # 先取出缓冲区中已有的部分，剩余部分直接读入帧缓冲区
+        self.start += self.HEADER.size
+        received = self.end - self.start
+        frame_view[:received] = self.view[self.start:self.end]
+        self.start = self.end = 0
+        
+        while received < length:
+            count = self.sock.recv_into(frame_view[received:])
+            if count == 0:
+                return None
+            received += count
+        
+        return is_binary, frame_view
+    
+    def fill_nonblocking(self) -> Optional[int]:
+        """
+        非阻塞套接字可读时读取一次数据
+        
+        下一帧超过缓冲区大小时先把缓冲区扩大到能容纳整帧（不超过 MAX_FRAME_SIZE），
+        该帧取出后缓冲区恢复原大小。
+        
+        Returns:
+            读取的字节数，0 表示连接已关闭，暂时没有数据返回None
+            
+        Raises:
+            ValueError: 帧长度超过上限
+        """
+        header = self._peek_length()
+        if header is not None and self.HEADER.size + header[1] > len(self.buffer):
+            self._resize(self.HEADER.size + header[1])
+        
+        try:
+            return self.fill()
+        except (BlockingIOError, InterruptedError):
+            return None
+    
+    def _resize(self, size: int):
+        """
+        更换接收缓冲区，保留未处理的数据
+        
+        Args:
+            size: 新缓冲区大小
+        """
+        pending = self.end - self.start
+        buffer = bytearray(max(size, pending))
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
+    
+    def next_message(self) -> Optional[Dict[str, Any]]:
+        """
+        从缓冲区中取出并解析一条完整的消息（不读取套接字）
+        
+        FILE_DATA 的数据复制为 bytes，消息在之后的读取中仍然有效。
+        
+        Returns:
+            消息字典，缓冲区中没有完整帧返回None
+            
+        Raises:
+            ValueError: 帧无法解析
+        """
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        
+        is_binary, body = frame
+        message = SocketUtils.parse_frame(body, is_binary)
+        if message is None:
+            raise ValueError("无法解析的消息")
+        if not isinstance(message, (dict, RoutedMessage)):
+            raise ValueError("消息不是字典")
+        if message.get("type") == MessageType.FILE_DATA and isinstance(message.get("data"), memoryview):
+            message["data"] = bytes(message["data"])
+        
+        # 为超大帧扩大的缓冲区在处理完后恢复原大小
+        if self.start == self.end and len(self.buffer) > self.buffer_size:
+            self._resize(self.buffer_size)
+        return message
+    
+    def read_raw(self, count: int, sink, progress=None) -> int:
+        """
+        读取紧跟在帧之后的原始字节流（不带帧头）
+        
+        先交出缓冲区中已读到的部分，剩余部分直接读入缓冲区后交给sink，
+        每次读取不超过剩余字节数，不会多读到下一帧。
+        
+        Args:
+            count: 原始字节数
+            sink: 接收数据的回调（如文件对象的write），参数在回调返回后失效
+            progress: 每读取一块后调用的回调，参数为已读取的字节数
+            
+        Returns:
+            实际读取的字节数，小于count表示连接已关闭
+        """
+        received = 0
+        buffered = min(self.end - self.start, count)
+        if buffered:
+            sink(self.view[self.start:self.start + buffered])
+            self.start += buffered
+            received = buffered
+            if progress:
+                progress(received)
+        
+        if self.start == self.end:
+            self.start = self.end = 0
+        
+        while received < count:
+            # 缓冲区此时为空，整块用于读取原始数据
+            n = self.sock.recv_into(self.view, min(len(self.buffer), count - received))
+            if n == 0:
+                break
+            sink(self.view[:n])
+            received += n
+            if progress:
+                progress(received)
+        
+        return received
+    
+    def read_message(self) -> Optional[Dict[str, Any]]:
+        """
+        读取并解析下一条消息
+        
+        Returns:
+            解析后的消息字典，如果连接断开返回None
+        """
+        try:
+            frame = self.read_frame()
+            if frame is None:
+                return None
+            
+            is_binary, body = frame
+            return SocketUtils.parse_frame(body, is_binary)
+        
+        except Exception as e:
+            print(f"接收消息失败: {e}")
+            return None
+
+
+class StreamHasher:
+    """
+    随数据块到达增量计算整个文件的SHA-256，完成时不需要重新读取文件
+    
+    大文件的数据块交给工作线程计算（hashlib 计算时释放GIL），
+    接收线程只负责写盘；队列有界，工作线程跟不上时接收线程等待。
+    """
+    
+    WORKER_THRESHOLD = 64 * 1024 * 1024  # 超过该大小的文件使用工作线程
+    QUEUE_SIZE = 64
+    
+    def __init__(self, expected_size: int = 0):
+        """
+        初始化增量摘要
+        
+        Args:
+            expected_size: 文件大小，用于决定是否使用工作线程
+        """
+        self.digest = hashlib.sha256()
+        self.queue = None
+        self.worker = None
+        
+        if expected_size >= self.WORKER_THRESHOLD:
+            self.queue = queue.Queue(self.QUEUE_SIZE)
+            self.worker = threading.Thread(target=self._run)
+            self.worker.daemon = True
+            self.worker.start()
+    
+    def update(self, data: bytes):
+        """
+        加入一个数据块
+        
+        Args:
+            data: 数据块（bytes，交给工作线程后不能再被修改）
+        """
+        if self.queue is None:
+            self.digest.update(data)
+        else:
+            self.queue.put(data)
+    
+    def _run(self):
+        """工作线程：依次计算队列中的数据块"""
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.digest.update(data)
+    
+    def close(self):
+        """停止工作线程"""
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.worker = None
+            self.queue = None
+    
+    def hexdigest(self) -> str:
+        """
+        等待所有数据块计算完成并返回摘要
+        
+        Returns:
+            十六进制摘要
+        """
+        self.close()
+        return self.digest.hexdigest()
+
+
+class TransferController:
+    """
+    文件发送的自适应数据块大小和发送窗口
+    
+    发送方每隔约四分之一个窗口请求一次确认，记录该数据块的发送时间；接收方回复 FILE_ACK 后
+    得到一个往返时间样本，两次确认之间确认的字节数除以间隔时间得到实际吞吐量样本（指数平滑）：
+    - 数据块大小取按当前吞吐量发送约 TARGET_CHUNK_TIME 的字节数（2的幂，
+      MIN_CHUNK_SIZE 到 MAX_CHUNK_SIZE）
+    - 窗口（已发送未确认的字节数上限）取吞吐量与往返时间之积（带宽时延积）的2倍，且至少容纳4个数据块。
+      受窗口限制时测得的吞吐量随窗口增长，窗口随之扩大，直到吞吐量不再增长；
+      往返时间按不超过最小往返时间的2倍计算，排队造成的延迟增长不会让窗口无限扩大
+    不请求确认时（acked=False，如服务器经有界的出站队列发送）只按实际发送速度调整数据块大小。
+    """
+    
+    MIN_CHUNK_SIZE = 4 * 1024
+    MAX_CHUNK_SIZE = 1024 * 1024       # 远小于 MAX_FRAME_SIZE，十六进制编码后也能放入一帧
+    MIN_WINDOW = 64 * 1024
+    MAX_WINDOW = 16 * 1024 * 1024
+    TARGET_CHUNK_TIME = 0.01           # 一个数据块约占的发送时间（秒），同一连接上的聊天消息最多等待这么久
+    SAMPLE_INTERVAL = 0.05             # 不请求确认时测量发送速度的间隔（秒）
+    ACK_TIMEOUT = 5.0                  # 等待确认超时后不再等待（如接收方已放弃该文件）
+    
+    def __init__(self, chunk_size: int = SocketUtils.BUFFER_SIZE, acked: bool = True):
+        """
+        初始化传输控制器
+        
+        Args:
+            chunk_size: 初始数据块大小
+            acked: 接收方是否按请求回复 FILE_ACK
+        """
+        self.chunk_size = chunk_size
+        self.window = self.MIN_WINDOW
+        self.acked = acked
+        self.rtt = None             # 平滑后的往返时间（秒）
+        self.min_rtt = None
+        self.throughput = None      # 平滑后的吞吐量（字节/秒）
+        
+        self.pending = {}           # 请求确认的数据块：chunk_index -> (发送时间, 数据块结束位置)
+        self.acked_offset = 0       # 已确认的位置
+        self.next_ack_offset = 0    # 到达该位置的数据块请求确认
+        self.sample_time = None     # 上一个吞吐量样本的时间和位置（发送第一个数据块前为None）
+        self.sample_offset = 0
+        self.ack_lost = False
+        self.condition = threading.Condition()
+    
+    def on_sent(self, chunk_index: int, offset: int, length: int) -> bool:
+        """
+        记录即将发送的数据块
+        
+        Args:
+            chunk_index: 数据块序号
+            offset: 数据块在文件中的位置
+            length: 数据块字节数
+            
+        Returns:
+            是否请求接收方确认该数据块
+        """
+        now = time.monotonic()
+        end = offset + length
+        with self.condition:
+            if self.sample_time is None:
+                # 第一个数据块（续传时从中间开始）
+                self.sample_time = now
+                self.sample_offset = self.acked_offset = self.next_ack_offset = offset
+            
+            if not self.acked:
+                elapsed = now - self.sample_time
+                if elapsed >= self.SAMPLE_INTERVAL:
+                    self._update(offset - self.sample_offset, elapsed)
+                    self.sample_time, self.sample_offset = now, offset
+                return False
+            
+            if self.ack_lost or end < self.next_ack_offset:
+                return False
+            self.pending[chunk_index] = (now, end)
+            self.next_ack_offset = end + max(self.window // 4, self.chunk_size)
+            return True
+    
+    def on_ack(self, metadata: Dict):
+        """
+        处理接收方的 FILE_ACK（由接收消息的线程调用）
+        
+        Args:
+            metadata: FILE_ACK 的元数据（chunk_index, bytes_received）
+        """
+        now = time.monotonic()
+        with self.condition:
+            entry = self.pending.pop(metadata.get("chunk_index"), None)
+            if entry is None or entry[1] != metadata.get("bytes_received"):
+                return  # 之前的传输遗留的确认
+            sent_time, end = entry
+            
+            sample = now - sent_time
+            self.rtt = sample if self.rtt is None else self.rtt * 0.875 + sample * 0.125
+            self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+            # 成批到达的确认间隔过短，吞吐量样本至少跨越一个最小往返时间
+            if now - self.sample_time >= self.min_rtt:
+                self._update(end - self.sample_offset, now - self.sample_time)
+                self.sample_time, self.sample_offset = now, end
+            self.acked_offset = end
+            self.condition.notify_all()
+    
+    def _update(self, count: int, elapsed: float):
+        """加入一个吞吐量样本并调整窗口和数据块大小（调用方持有条件变量）"""
+        if elapsed <= 0 or count <= 0:
+            return
+        rate = count / elapsed
+        self.throughput = rate if self.throughput is None else self.throughput * 0.75 + rate * 0.25
+        
+        target = int(self.throughput * self.TARGET_CHUNK_TIME)
+        if self.min_rtt is not None:
+            bdp = self.throughput * min(self.rtt, self.min_rtt * 2)
+            self.window = int(min(max(bdp * 2, target * 4, self.MIN_WINDOW), self.MAX_WINDOW))
+            target = min(target, self.window // 4)
+        # 取2的幂，拆分给未协商的接收方时各段大小一致
+        target = 1 << (target.bit_length() - 1) if target > 0 else 0
+        self.chunk_size = min(max(target, self.MIN_CHUNK_SIZE), self.MAX_CHUNK_SIZE)
+    
+    def wait_window(self, offset: int):
+        """
+        已发送未确认的数据达到窗口大小时等待确认
+        
+        Args:
+            offset: 下一个数据块的位置
+        """
+        if not self.acked or self.sample_time is None:
+            return
+        deadline = time.monotonic() + self.ACK_TIMEOUT
+        with self.condition:
+            while not self.ack_lost and offset - self.acked_offset >= self.window:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # 接收方不再确认，之后按不受窗口限制的方式发送
+                    self.ack_lost = True
+                    self.pending.clear()
+                    break
+                self.condition.wait(remaining)
+
+
+class FrameWriter:
+    """
+    合并写出的帧发送器
+    
+    待发送的帧以缓冲区列表的形式排队，发送时用 sendmsg（writev）一次写出多个缓冲区：
+    长度前缀与消息体不再分两次 send，排队的多条小消息也合并为一次系统调用。
+    sendmsg 只发送了一部分时，从未发送完的位置继续。
+    """
+    
+    MAX_BATCH_BUFFERS = 64          # 单次 sendmsg 的缓冲区个数上限
+    MAX_BATCH_BYTES = 256 * 1024    # 单次 sendmsg 的字节数上限
+    
+    def __init__(self, sock):
+        """
+        初始化发送器
+        
+        Args:
+            sock: 套接字对象
+        """
+        self.sock = sock
+        self.pending = deque()  # 待发送的 memoryview
+        self.pending_bytes = 0
+        self.syscalls = 0
+    
+    def add(self, frame: tuple):
+        """
+        加入一个帧
+        
+        Args:
+            frame: 帧的缓冲区元组
+        """
+        for buffer in frame:
+            if len(buffer):
+                self.pending.append(memoryview(buffer).cast('B'))
+                self.pending_bytes += len(buffer)
+    
+    def _send_batch(self) -> int:
+        """
+        用一次系统调用发送尽量多的待发送数据
+        
+        Returns:
+            实际发送的字节数
+        """
+        batch = []
+        batch_bytes = 0
+        for buffer in self.pending:
+            batch.append(buffer)
+            batch_bytes += len(buffer)
+            if len(batch) >= self.MAX_BATCH_BUFFERS or batch_bytes >= self.MAX_BATCH_BYTES:
+                break
+        
+        self.syscalls += 1
+        if hasattr(self.sock, 'sendmsg'):
+            sent = self.sock.sendmsg(batch)
+        else:
+            # 不支持 sendmsg 的平台（如Windows）先拼接再发送
+            sent = self.sock.send(b''.join(batch))
+        
+        self._consume(sent)
+        return sent
+    
+    def _consume(self, sent: int):
+        """
+        移除已发送的数据，部分发送的缓冲区保留剩余部分
+        
+        Args:
+            sent: 已发送的字节数
+        """
+        self.pending_bytes -= sent
+        while sent:
+            buffer = self.pending[0]
+            if sent >= len(buffer):
+                sent -= len(buffer)
+                self.pending.popleft()
+            else:
+                self.pending[0] = buffer[sent:]
+                sent = 0
+    
+    def flush(self):
+        """发送全部待发送数据（阻塞套接字）"""
+        while self.pending:
+            self._send_batch()
+    
+    def flush_nonblocking(self) -> bool:
+        """
+        在非阻塞套接字上尽量发送待发送数据
+        
+        Returns:
+            是否已全部发送
+        """
+        try:
+            while self.pending:
+                if self._send_batch() == 0:
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+        return not self.pending
+
+
+class PreparedMessage:
+    """
+    预先编码的消息
+    
+    一次广播只序列化一次：帧（长度前缀 + 消息体）在第一次需要时编码并缓存，
+    之后所有接收方的出站队列共享同一组缓冲区。
+    按接收方是否支持二进制帧（仅 FILE_DATA）、压缩和紧凑编码各缓存一种编码。
+    超过 BUFFER_SIZE 的 FILE_DATA 数据块发给未协商 adaptive_chunks 的接收方（如C++版本）时
+    拆分为多个 BUFFER_SIZE 的数据块帧（共用原数据块的 chunk_index）。
+    """
+    
+    __slots__ = ("msg_type", "data", "metadata", "_frames")
+    
+    def __init__(self, msg_type: str, data: Any, metadata: Optional[Dict] = None):
+        """
+        初始化预编码消息
+        
+        Args:
+            msg_type: 消息类型
+            data: 消息数据（FILE_DATA 为原始字节）
+            metadata: 元数据
+        """
+        self.msg_type = msg_type
+        self.data = data
+        self.metadata = metadata or {}
+        self._frames = {}
+    
+    def frame(self, features=frozenset()) -> tuple:
+        """
+        获取适合指定接收方的完整帧
+        
+        Args:
+            features: 接收方协商好的协议特性
+            
+        Returns:
+            帧的缓冲区元组（同一编码方式的接收方得到同一个对象）
+        """
+        if self.msg_type == MessageType.FILE_DATA:
+            binary = Feature.BINARY_FILE_DATA in features
+            compress = binary and Feature.ZLIB in features
+        else:
+            binary = False
+            compress = Feature.ZLIB in features
+        compact = not binary and Feature.COMPACT_CODEC in features
+        split = (self.msg_type == MessageType.FILE_DATA and Feature.ADAPTIVE_CHUNKS not in features and
+                 SocketUtils.chunk_size(self.data) > SocketUtils.BUFFER_SIZE)
+        
+        key = (binary, compress, compact, split)
+        frame = self._frames.get(key)
+        if frame is None:
+            if split:
+                frame = self._split_frame(binary, compress, compact)
+            elif self.msg_type == MessageType.FILE_DATA:
+                frame = SocketUtils.encode_file_data(self.data, self.metadata, binary, compress, compact)
+            else:
+                frame = SocketUtils.encode_message(self.msg_type, self.data, self.metadata, compress, compact)
+            self._frames[key] = frame
+        return frame
+    
+    def _split_frame(self, binary: bool, compress: bool, compact: bool) -> tuple:
+        """
+        把数据块按 BUFFER_SIZE 拆分编码，各帧的缓冲区依次放在同一个元组中
+        
+        Returns:
+            帧的缓冲区元组
+        """
+        chunk = self.data
+        if isinstance(chunk, str):
+            chunk = bytes.fromhex(chunk)
+        view = memoryview(chunk)
+        bytes_sent = int(self.metadata.get("bytes_sent", 0) or 0)
+        buffers = []
+        for start in range(0, len(view), SocketUtils.BUFFER_SIZE):
+            piece = view[start:start + SocketUtils.BUFFER_SIZE]
+            metadata = dict(self.metadata, bytes_sent=bytes_sent + start)
+            if metadata.get("crc32") is not None:
+                metadata["crc32"] = zlib.crc32(piece)
+            buffers.extend(SocketUtils.encode_file_data(piece, metadata, binary, compress, compact))
+        return tuple(buffers)
+    
+    @classmethod
+    def from_frame(cls, frame: bytes) -> 'PreparedMessage':
+        """
+        由一个完整的JSON消息帧（长度前缀 + 消息体）恢复预编码消息
+        
+        该帧直接作为不压缩编码的缓存，发给不支持压缩的接收方时不重新编码。
+        
+        Args:
+            frame: 完整帧
+            
+        Returns:
+            PreparedMessage
+            
+        Raises:
+            ValueError: 帧内容不是有效的JSON消息
+        """
+        message = SocketUtils.parse_frame(memoryview(frame)[FrameReader.HEADER.size:])
+        prepared = cls(message.get("type"), message.get("data", ""), message.get("metadata"))
+        prepared._frames[(False, False, False, False)] = (frame,)
+        return prepared
+
+
+class RoutedMessage:
+    """
+    路由帧解析出的消息（消息体延迟解析）
+    
+    消息类型和对方用户名来自固定的路由头，按类型分派和按用户名路由都不解析消息体；
+    第一次读取 data 或 metadata 时才解压并解析（JSON或紧凑编码）。
+    服务器转发私信时直接把消息体放入新的路由帧，不做解析和重新编码。
+    支持与消息字典相同的 get / [] / in 访问方式，"peer" 为路由头中的对方用户名。
+    """
+    
+    __slots__ = ("msg_type", "peer", "flags", "body", "_content")
+    
+    def __init__(self, msg_type: str, peer: str, flags: int, body: bytes):
+        """
+        初始化路由消息
+        
+        Args:
+            msg_type: 消息类型
+            peer: 对方用户名
+            flags: 路由头标志
+            body: 消息体（按 flags 可能经过压缩）
+        """
+        self.msg_type = msg_type
+        self.peer = peer
+        self.flags = flags
+        self.body = body
+        self._content = None
+    
+    @classmethod
+    def from_frame(cls, frame) -> Optional['RoutedMessage']:
+        """
+        解析路由帧（消息体复制为 bytes，之后的读取不会覆盖）
+        
+        Args:
+            frame: 去掉长度前缀后的帧内容
+            
+        Returns:
+            RoutedMessage，帧头无效返回None
+        """
+        header = SocketUtils.ROUTED_HEADER
+        if len(frame) < header.size:
+            return None
+        _, code, flags, peer_size = header.unpack_from(frame)
+        if not 1 <= code <= len(SocketUtils.ROUTED_TYPES) or len(frame) < header.size + peer_size:
+            print(f"无效的路由帧: 消息类型 {code}")
+            return None
+        
+        peer = str(frame[header.size:header.size + peer_size], 'utf-8')
+        return cls(SocketUtils.ROUTED_TYPES[code - 1], peer, flags, bytes(frame[header.size + peer_size:]))
+    
+    def plain_body(self) -> bytes:
+        """未压缩的消息体"""
+        if self.flags & SocketUtils.ROUTED_COMPRESSED:
+            return SocketUtils.decompress_payload(self.body)
+        return self.body
+    
+    def content(self) -> Dict[str, Any]:
+        """解析后的消息体 {"data", "metadata"}（第一次调用时解析）"""
+        if self._content is None:
+            codec = COMPACT_CODEC if self.flags & SocketUtils.ROUTED_COMPACT else JSON_CODEC
+            self._content = codec.decode(self.plain_body())
+        return self._content
+    
+    @property
+    def parsed(self) -> bool:
+        """消息体是否已经解析"""
+        return self._content is not None
+    
+    def relay_frame(self, peer: str, compress: bool = False, compact: bool = False) -> tuple:
+        """
+        把消息体原样放入新的路由帧
+        
+        Args:
+            peer: 新的对方用户名（服务器转发时为发送者）
+            compress: 接收方是否支持压缩（不支持时解压后转发）
+            compact: 接收方是否支持紧凑编码（不支持时重新编码为JSON）
+            
+        Returns:
+            帧的缓冲区元组
+        """
+        if self.flags & SocketUtils.ROUTED_COMPACT and not compact:
+            content = self.content()
+            return SocketUtils.encode_routed(self.msg_type, content.get("data"), content.get("metadata"), peer,
+                                             compress)
+        if self.flags & SocketUtils.ROUTED_COMPRESSED and not compress:
+            return SocketUtils.routed_frame(self.msg_type, peer, 0, self.plain_body())
+        return SocketUtils.routed_frame(self.msg_type, peer, self.flags, self.body)
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        """按消息字典的键读取（只有 data、metadata 会触发解析）"""
+        if key == "type":
+            return self.msg_type
+        if key == "peer":
+            return self.peer or default
+        return self.content().get(key, default)
+    
+    def __getitem__(self, key: str) -> Any:
+        """按消息字典的键读取，键不存在时抛出 KeyError"""
+        if key == "type":
+            return self.msg_type
+        if key == "peer" and self.peer:
+            return self.peer
+        return self.content()[key]
+    
+    def __setitem__(self, key: str, value: Any):
+        """修改消息体中的字段"""
+        self.content()[key] = value
+    
+    def __contains__(self, key: str) -> bool:
+        """是否包含该键"""
+        return key == "type" or (key == "peer" and bool(self.peer)) or key in self.content()
+
+
+class FileRegion:
+    """
+    出站队列中的一段文件内容
+    
+    写线程用 socket.sendfile 直接把文件从页缓存发送到套接字（Linux 上即 os.sendfile），
+    数据不经过 Python 内存，也不做任何编码。
+    """
+    
+    __slots__ = ("path", "offset", "count")
+    
+    def __init__(self, path: str, offset: int, count: int):
+        """
+        初始化文件区间
+        
+        Args:
+            path: 文件路径
+            offset: 起始偏移
+            count: 发送的字节数
+        """
+        self.path = path
+        self.offset = offset
+        self.count = count
+    
+    def send(self, sock) -> int:
+        """
+        将文件区间发送到阻塞套接字
+        
+        Args:
+            sock: 套接字对象
+            
+        Returns:
+            发送的字节数
+            
+        Raises:
+            OSError: 发送失败，或文件在发送过程中被截断
+        """
+        with open(self.path, 'rb') as f:
+            sent = sock.sendfile(f, self.offset, self.count)
+        
+        # 接收方按 FILE 头中的大小读取原始字节，少发会破坏后续的帧边界
+        if sent != self.count:
+            raise OSError(f"文件在发送过程中被截断: {self.path}")
+        return sent
+
+
+class SlowConsumerPolicy:
+    """出站队列已满（客户端接收过慢）时的处理策略"""
+    DROP = "drop"                  # 丢弃新消息，连接保持
+    DISCONNECT = "disconnect"      # 断开慢客户端
+    BACKPRESSURE = "backpressure"  # 发送方等待队列腾出空间，超时后断开
+    
+    ALL = (DROP, DISCONNECT, BACKPRESSURE)
+
+
+class RelayMode:
+    """服务器转发客户端上传文件时的存储方式"""
+    STORE = "store"  # 先写入磁盘再转发，接收完成后存入 BlobStore
+    RELAY = "relay"  # 只转发不保存，不做磁盘读写
+    SPOOL = "spool"  # 先转发，再由后台线程异步写入磁盘
+    
+    ALL = (STORE, RELAY, SPOOL)
+
+
+class OutboundQueue:
+    """
+    每个连接一个的有界出站队列
+    
+    消息只在队列中排队，由该连接自己的写线程发送到套接字，
+    因此一个读取缓慢的客户端不会阻塞其他客户端的发送和广播。
+    """
+    
+    MAX_BYTES = 8 * 1024 * 1024    # 队列中帧的总字节数上限
+    BACKPRESSURE_TIMEOUT = 10      # 背压等待的超时时间（秒）
+    
+    def __init__(self, sock, max_messages: int = 1024, policy: str = SlowConsumerPolicy.BACKPRESSURE):
+        """
+        初始化出站队列
+        
+        Args:
+            sock: 套接字对象
+            max_messages: 队列中的消息数上限
+            policy: 队列已满时的处理策略（SlowConsumerPolicy）
+        """
+        self.sock = sock
+        self.max_messages = max_messages
+        self.policy = policy
+        
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer_thread = None
+    
+    def start(self):
+        """启动写线程"""
+        self.writer_thread = threading.Thread(target=self._run)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+    
+    def _full(self) -> bool:
+        """队列是否已满（空队列总能放入一帧）"""
+        if not self.queue:
+            return False
+        return len(self.queue) >= self.max_messages or self.queued_bytes >= self.MAX_BYTES
+    
+    def _append(self, frame):
+        """放入一帧并唤醒写线程（调用方持有条件变量）"""
+        # 文件区间由写线程从文件直接发送，不占用队列内存
+        size = 0 if isinstance(frame, FileRegion) else sum(len(buffer) for buffer in frame)
+        self.queue.append((frame, size))
+        self.queued_bytes += size
+        self.condition.notify_all()
+    
+    def offer(self, frame: tuple) -> bool:
+        """
+        尝试放入一帧，不等待也不执行慢客户端策略
+        
+        Args:
+            frame: 帧的缓冲区元组
+            
+        Returns:
+            是否已放入队列
+        """
+        with self.condition:
+            if self.closed or self._full():
+                return False
+            self._append(frame)
+            return True
+    
+    def put(self, frame: tuple, wait: bool = False) -> bool:
+        """
+        放入一帧，队列已满时执行慢客户端策略
+        
+        Args:
+            frame: 帧的缓冲区元组
+            wait: 是否无视策略等待队列腾出空间（用于服务器主动发送文件等可以阻塞的场景）
+            
+        Returns:
+            是否已放入队列（DROP 策略下丢弃返回False）
+            
+        Raises:
+            ConnectionError: 连接已关闭或因策略被断开
+        """
+        with self.condition:
+            if self._full() and not self.closed:
+                if self.policy == SlowConsumerPolicy.DROP and not wait:
+                    self.dropped += 1
+                    return False
+                
+                if self.policy == SlowConsumerPolicy.DISCONNECT and not wait:
+                    self._close_locked()
+                else:
+                    self.condition.wait_for(lambda: self.closed or not self._full(),
+                                            timeout=self.BACKPRESSURE_TIMEOUT)
+                    if self._full():
+                        self._close_locked()
+            
+            if self.closed:
+                raise ConnectionError("客户端接收过慢或连接已关闭")
+            
+            self._append(frame)
+            return True
+    
+    def put_sequence(self, items: list) -> bool:
+        """
+        连续放入多个帧或文件区间，中间不会插入其他帧
+        
+        用于原始字节流传输：FILE 头、文件区间和 FILE_COMPLETE 必须在流中相邻。
+        队列已满时无视策略等待。
+        
+        Args:
+            items: 帧的缓冲区元组或 FileRegion 的列表
+            
+        Returns:
+            是否已放入队列
+            
+        Raises:
+            ConnectionError: 连接已关闭
+        """
+        with self.condition:
+            if self._full() and not self.closed:
+                self.condition.wait_for(lambda: self.closed or not self._full(),
+                                        timeout=self.BACKPRESSURE_TIMEOUT)
+                if self._full():
+                    self._close_locked()
+            
+            if self.closed:
+                raise ConnectionError("客户端接收过慢或连接已关闭")
+            
+            for item in items:
+                self._append(item)
+            return True
+    
+    def _run(self):
+        """写线程：把队列中积压的帧一起取出，合并为尽量少的 sendmsg 调用发送"""
+        writer = FrameWriter(self.sock)
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.closed)
+                if self.closed:
+                    return
+                
+                region = None
+                while self.queue and writer.pending_bytes < FrameWriter.MAX_BATCH_BYTES:
+                    frame, size = self.queue.popleft()
+                    self.queued_bytes -= size
+                    if isinstance(frame, FileRegion):
+                        # 先发完之前的帧，再发送文件区间
+                        region = frame
+                        break
+                    writer.add(frame)
+                self.condition.notify_all()
+            
+            try:
+                writer.flush()
+                if region is not None:
+                    region.send(self.sock)
+            except OSError:
+                self.close()
+                return
+    
+    def _close_locked(self):
+        """关闭队列并中断套接字（调用方持有条件变量）"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.condition.notify_all()
+        
+        # 让阻塞在该套接字上的读线程尽快退出
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def close(self):
+        """关闭队列，丢弃未发送的帧"""
+        with self.condition:
+            self._close_locked()
+
+
 def format_message(username: str, message: str) -> str:
     """
     格式化聊天消息